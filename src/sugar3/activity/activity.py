@@ -58,6 +58,7 @@ import gettext
 import logging
 import os
 import time
+import threading
 from hashlib import sha1
 from functools import partial
 import StringIO
@@ -74,28 +75,19 @@ from gi.repository import Gdk
 from gi.repository import Gtk
 import dbus
 import dbus.service
-from dbus import PROPERTIES_IFACE
-from telepathy.server import DBusProperties
-from telepathy.interfaces import CHANNEL, \
-    CHANNEL_TYPE_TEXT, \
-    CLIENT, \
-    CLIENT_HANDLER
-from telepathy.constants import CONNECTION_HANDLE_TYPE_CONTACT
-from telepathy.constants import CONNECTION_HANDLE_TYPE_ROOM
 
+# The presence service, telepathy, the datastore and the modules only
+# needed when sharing, saving or closing are imported when first used,
+# to keep the startup of activities short.
 from sugar3 import util
-from sugar3 import power
 from sugar3.profile import get_nick_name, get_color
-from sugar3.presence import presenceservice
 from sugar3.activity.activityservice import ActivityService
 from sugar3.graphics import style
 from sugar3.graphics.window import Window
-from sugar3.graphics.alert import Alert
 from sugar3.graphics.icon import Icon
-from sugar3.datastore import datastore
 from sugar3.bundle.activitybundle import get_bundle_instance
-from sugar3.bundle.helpers import bundle_from_dir
 from sugar3 import env
+from sugar3 import logger
 from errno import EEXIST
 
 from gi.repository import SugarExt
@@ -118,6 +110,11 @@ CONN_INTERFACE_ACTIVITY_PROPERTIES = 'org.laptop.Telepathy.ActivityProperties'
 
 PREVIEW_SIZE = style.zoom(300), style.zoom(225)
 
+# Formats of the preview, see Activity.set_preview_format().  JPEG is
+# cheaper to encode, but some versions of the Journal only display PNG.
+PREVIEW_FORMAT_PNG = 'png'
+PREVIEW_FORMAT_JPEG = 'jpeg'
+
 
 class _ActivitySession(GObject.GObject):
 
@@ -366,20 +363,16 @@ class Activity(Window, Gtk.Container):
         self.connect('realize', self.__realize_cb)
         self.connect('delete-event', self.__delete_event_cb)
 
-        self._active = False
-        self._active_time = None
-        self._spent_time = 0
         self._activity_id = handle.activity_id
         self.shared_activity = None
         self._join_id = None
-        self._updating_jobject = False
-        self._closing = False
-        self._quit_requested = False
+        self._init_save_state()
         self._deleting = False
         self._max_participants = None
         self._invites_queue = []
         self._jobject = None
         self._read_file_called = False
+        self._init_preview()
 
         self._session = _get_session()
         self._session.register(self)
@@ -391,13 +384,15 @@ class Activity(Window, Gtk.Container):
         self.sugar_accel_group = accel_group
         self.add_accel_group(accel_group)
 
-        self._bus = ActivityService(self)
-        self._owns_file = False
+        with logger.startup_phase('D-Bus setup'):
+            self._bus = ActivityService(self)
 
         share_scope = SCOPE_PRIVATE
 
         if handle.object_id:
-            self._jobject = datastore.get(handle.object_id)
+            with logger.startup_phase('journal object get'):
+                from sugar3.datastore import datastore
+                self._jobject = datastore.get(handle.object_id)
 
             if 'share-scope' in self._jobject.metadata:
                 share_scope = self._jobject.metadata['share-scope']
@@ -419,22 +414,27 @@ class Activity(Window, Gtk.Container):
 
         if handle.object_id is None:
             logging.debug('Creating a jobject.')
-            self._jobject = self._initialize_journal_object()
-
-        if handle.invited:
-            wait_loop = GObject.MainLoop()
-            self._client_handler = _ClientHandler(
-                self.get_bundle_id(),
-                partial(self.__got_channel_cb, wait_loop))
-            # FIXME: The current API requires that self.shared_activity is set
-            # before exiting from __init__, so we wait until we have got the
-            # shared activity. http://bugs.sugarlabs.org/ticket/2168
-            wait_loop.run()
-        else:
-            pservice = presenceservice.get_instance()
-            mesh_instance = pservice.get_activity(self._activity_id,
-                                                  warn_if_none=False)
-            self._set_up_sharing(mesh_instance, share_scope)
+            with logger.startup_phase('journal object create'):
+                self._jobject = self._initialize_journal_object()
+
+        with logger.startup_phase('sharing setup'):
+            if handle.invited:
+                from sugar3.activity.clienthandler import ClientHandler
+                wait_loop = GObject.MainLoop()
+                self._client_handler = ClientHandler(
+                    self.get_bundle_id(),
+                    partial(self.__got_channel_cb, wait_loop))
+                # FIXME: The current API requires that self.shared_activity
+                # is set before exiting from __init__, so we wait until we
+                # have got the shared activity.
+                # http://bugs.sugarlabs.org/ticket/2168
+                wait_loop.run()
+            else:
+                from sugar3.presence import presenceservice
+                pservice = presenceservice.get_instance()
+                mesh_instance = pservice.get_activity(self._activity_id,
+                                                      warn_if_none=False)
+                self._set_up_sharing(mesh_instance, share_scope)
 
         if self.shared_activity is not None:
             self._jobject.metadata['title'] = self.shared_activity.props.name
@@ -448,11 +448,16 @@ class Activity(Window, Gtk.Container):
         bundle = get_bundle_instance(get_bundle_path())
         self.set_icon_from_file(bundle.get_icon())
 
+        if logger.is_startup_traced():
+            self.connect('draw', self.__first_draw_cb)
+            self.connect_after('draw', self.__first_draw_after_cb)
 
     def run_main_loop(self):
         Gtk.main()
 
     def _initialize_journal_object(self):
+        from sugar3.datastore import datastore
+
         title = _('%s Activity') % get_bundle_name()
        
         icon_color = get_color().to_string()
@@ -513,6 +518,10 @@ class Activity(Window, Gtk.Container):
 
     def __got_channel_cb(self, wait_loop, connection_path, channel_path,
                          handle_type):
+        from telepathy.interfaces import CHANNEL
+        from telepathy.constants import CONNECTION_HANDLE_TYPE_ROOM
+        from sugar3.presence import presenceservice
+
         logging.debug('Activity.__got_channel_cb')
         pservice = presenceservice.get_instance()
 
@@ -574,6 +583,62 @@ class Activity(Window, Gtk.Container):
         type=int, default=0, getter=get_max_participants,
         setter=set_max_participants)
 
+    def _init_save_state(self):
+        self._active = False
+        self._active_time = None
+        self._spent_time = 0
+        self._owns_file = False
+        self._updating_jobject = False
+        self._save_pending = False
+        self._save_request_time = None
+        self._save_start_time = None
+        self._save_main_time = 0
+        self._copy_requested = False
+        self._save_stats = {'requests': 0, 'coalesced': 0, 'saved': 0,
+                            'failed': 0, 'last_snapshot_ms': None,
+                            'max_snapshot_ms': None, 'last_latency_ms': None,
+                            'max_latency_ms': None}
+        self._closing = False
+        self._quit_requested = False
+
+    def _init_preview(self):
+        self._preview = None
+        self._preview_damaged = True
+        self._preview_damage_handlers = []
+        self._preview_format = PREVIEW_FORMAT_PNG
+        self._preview_quality = None
+        self._preview_canvas_surface = None
+        self._preview_surface = None
+        self._preview_thread = None
+        self._rendering_preview = False
+
+    def get_preview_format(self):
+        '''
+        Returns:
+            tuple: the format and quality of the preview, see
+            set_preview_format()
+        '''
+        return self._preview_format, self._preview_quality
+
+    def set_preview_format(self, preview_format, quality=None):
+        '''
+        Sets the image format of the preview saved in the Journal.
+
+        Args:
+            preview_format (str): PREVIEW_FORMAT_PNG (the default) or
+                PREVIEW_FORMAT_JPEG, which is cheaper to encode but not
+                displayed by some versions of the Journal
+
+            quality (int): the zlib compression level of PNG, from 0 to
+                9, lower is faster, or the quality of JPEG, from 0 to 100.
+                None for the default of the format.
+        '''
+        if preview_format not in (PREVIEW_FORMAT_PNG, PREVIEW_FORMAT_JPEG):
+            raise ValueError('Unknown preview format %r' % preview_format)
+        self._preview_format = preview_format
+        self._preview_quality = quality
+        self._preview = None
+
     def get_id(self):
         '''
         Returns:
@@ -613,6 +678,7 @@ class Activity(Window, Gtk.Container):
         '''
 
         Window.set_canvas(self, canvas)
+        self._preview_damaged = True
         if not self._read_file_called:
             canvas.connect('map', self.__canvas_map_cb)
 
@@ -653,10 +719,20 @@ class Activity(Window, Gtk.Container):
         logging.debug('Activity.__canvas_map_cb')
         if self._jobject and self._jobject.file_path and \
                 not self._read_file_called:
-            self.read_file(self._jobject.file_path)
+            with logger.startup_phase('read_file'):
+                self.read_file(self._jobject.file_path)
             self._read_file_called = True
         canvas.disconnect_by_func(self.__canvas_map_cb)
 
+    def __first_draw_cb(self, window, cr):
+        self.disconnect_by_func(self.__first_draw_cb)
+        logger.start_startup_phase('first draw')
+
+    def __first_draw_after_cb(self, window, cr):
+        self.disconnect_by_func(self.__first_draw_after_cb)
+        logger.end_startup_phase('first draw')
+        logger.save_startup_trace(self.get_bundle_id())
+
     def __jobject_create_cb(self):
         pass
 
@@ -731,6 +807,44 @@ class Activity(Window, Gtk.Container):
         '''
         raise NotImplementedError
 
+    def get_save_snapshot(self):
+        '''
+        Activities can override this method, with write_snapshot(), to
+        serialise their document in a thread instead of in write_file().
+
+        It is called in the main thread when the activity is saved, and
+        should return a copy of the state to save, which is not modified
+        by the user interface afterwards.  When it returns None, the
+        default, write_file() is called instead.
+
+        Returns:
+            object: the snapshot passed to write_snapshot(), or None
+        '''
+        return None
+
+    def write_snapshot(self, snapshot, file_path):
+        '''
+        Write the snapshot returned by get_save_snapshot() to file_path,
+        like write_file() does.  It is called in a thread, so it must not
+        use the widgets or the metadata of the activity.
+
+        Args:
+            snapshot (object): the return value of get_save_snapshot()
+            file_path (str): complete path of the file to write
+        '''
+        raise NotImplementedError
+
+    def get_save_stats(self):
+        '''
+        Returns:
+            dict: the number of save requests, of requests coalesced into
+            a later save, of saves written and failed, and the last and
+            maximum latencies in milliseconds: snapshot is the time spent
+            in the main thread by a save, latency the time from the first
+            request to the reply of the datastore.
+        '''
+        return dict(self._save_stats)
+
     def notify_user(self, summary, body):
         '''
         Display a notification with the given summary and body.
@@ -749,6 +863,16 @@ class Activity(Window, Gtk.Container):
     def __save_cb(self):
         logging.debug('Activity.__save_cb')
         self._updating_jobject = False
+        self._record_save(True)
+        if self._save_pending:
+            # Save the latest state before quitting or closing
+            try:
+                self._start_save()
+                return
+            except Exception:
+                logging.exception('Error saving activity object to datastore')
+                self._save_failed()
+                return
         if self._quit_requested:
             self._session.will_quit(self, True)
         elif self._closing:
@@ -756,14 +880,47 @@ class Activity(Window, Gtk.Container):
 
     def __save_error_cb(self, err):
         logging.debug('Activity.__save_error_cb')
+        self._handle_save_error()
+        raise RuntimeError('Error saving activity object to datastore: %s' %
+                           err)
+
+    def _handle_save_error(self):
         self._updating_jobject = False
+        self._record_save(False)
+        if self._save_pending and not (self._closing or self._quit_requested):
+            # The latest state may still be saved
+            try:
+                self._start_save()
+                return
+            except Exception:
+                logging.exception('Error saving activity object to datastore')
+        self._save_failed()
+
+    def _save_failed(self):
+        self._save_pending = False
         if self._quit_requested:
             self._session.will_quit(self, False)
         if self._closing:
             self._show_keep_failed_dialog()
             self._closing = False
-        raise RuntimeError('Error saving activity object to datastore: %s' %
-                           err)
+
+    def _record_save(self, success):
+        stats = self._save_stats
+        if success:
+            stats['saved'] += 1
+        else:
+            stats['failed'] += 1
+
+        if self._save_start_time is None:
+            return
+        snapshot_ms = self._save_main_time * 1000.0
+        latency_ms = (time.time() - self._save_start_time) * 1000.0
+        stats['last_snapshot_ms'] = snapshot_ms
+        stats['max_snapshot_ms'] = max(stats['max_snapshot_ms'],
+                                       snapshot_ms)
+        stats['last_latency_ms'] = latency_ms
+        stats['max_latency_ms'] = max(stats['max_latency_ms'], latency_ms)
+        self._save_start_time = None
 
     def _cleanup_jobject(self):
         if self._jobject:
@@ -785,35 +942,156 @@ class Activity(Window, Gtk.Container):
         Activities can override this method, which should return a str with the
         binary content of a png image with a width of PREVIEW_SIZE pixels.
 
-        The method does create a cairo surface similar to that of the canvas'
-        window and draws on that. Then we create a cairo image surface with
-        the desired preview size and scale the canvas surface on that.
+        The method draws the canvas on an image surface, then scales it on
+        an image surface of the preview size, see set_preview_format() for
+        the encoding.  The surfaces are kept for the next previews, and the
+        previous preview is returned if the canvas has not been drawn,
+        reallocated or unmapped since.
+        '''
+        if not self._is_preview_damaged():
+            return self._preview
+
+        self._wait_preview()
+        canvas_surface = self._render_canvas()
+        if canvas_surface is None:
+            return None
+        self._preview = self._encode_preview(
+            self._scale_preview(canvas_surface))
+        return self._preview
+
+    # Only this implementation is replaced by _start_preview(), any other
+    # get_preview(), even a decorated or mixed in one, is called as it is
+    get_preview.threaded_preview = True
+
+    def _start_preview(self):
+        '''
+        Draw the canvas, then scale and encode the preview in a thread.
+        Returns a function returning the preview, waiting for the thread
+        if needed.
         '''
-        if self.canvas is None or not hasattr(self.canvas, 'get_window'):
+        if not getattr(self.get_preview, 'threaded_preview', False):
+            preview = self.get_preview()
+            return lambda: preview
+
+        if not self._is_preview_damaged():
+            preview = self._preview
+            return lambda: preview
+
+        self._wait_preview()
+        canvas_surface = self._render_canvas()
+        if canvas_surface is None:
+            return lambda: None
+
+        result = []
+
+        def encode():
+            try:
+                result.append(self._encode_preview(
+                    self._scale_preview(canvas_surface)))
+            except Exception:
+                logging.exception('Could not encode the preview')
+
+        self._preview_thread = threading.Thread(target=encode)
+        self._preview_thread.start()
+
+        def get_result():
+            self._wait_preview()
+            if result:
+                self._preview = result[0]
+            else:
+                self._preview_damaged = True
+            return self._preview
+
+        return get_result
+
+    def _wait_preview(self):
+        # The thread uses the surfaces, they can't be drawn meanwhile
+        if self._preview_thread is not None:
+            self._preview_thread.join()
+            self._preview_thread = None
+
+    def _is_preview_damaged(self):
+        if self._preview_damaged or self._preview is None:
+            return True
+
+        # Nothing is drawn while the canvas is unmapped or the window is
+        # iconified, changes made meanwhile are never seen as damage
+        window = self.get_window()
+        return not self.canvas.get_mapped() or window is None or \
+            bool(window.get_state() & Gdk.WindowState.ICONIFIED)
+
+    def _track_preview_damage(self):
+        for widget, handler_id in self._preview_damage_handlers:
+            widget.disconnect(handler_id)
+        self._preview_damage_handlers = []
+
+        def connect(widget, signal):
+            handler_id = widget.connect(signal, self.__preview_damage_cb)
+            self._preview_damage_handlers.append((widget, handler_id))
+
+        # Showing, hiding, adding or removing a widget inside the canvas
+        # reallocates it, the children are tracked again on the next render
+        connect(self.canvas, 'map')
+        connect(self.canvas, 'size-allocate')
+
+        # Widgets with their own window are drawn without the canvas
+        def track(widget):
+            if widget is self.canvas or widget.get_has_window():
+                connect(widget, 'draw')
+            if isinstance(widget, Gtk.Container):
+                widget.forall(track)
+
+        track(self.canvas)
+
+    def __preview_damage_cb(self, widget, *args):
+        if not self._rendering_preview:
+            self._preview_damaged = True
+        return False
+
+    def _render_canvas(self):
+        if self.canvas is None or not hasattr(self.canvas, 'get_window') \
+                or self.canvas.get_window() is None:
             return None
 
-        window = self.canvas.get_window()
         alloc = self.canvas.get_allocation()
+        if alloc.width <= 0 or alloc.height <= 0:
+            return None
+
+        self._track_preview_damage()
+        self._preview_damaged = False
 
-        dummy_cr = Gdk.cairo_create(window)
-        target = dummy_cr.get_target()
-        canvas_width, canvas_height = alloc.width, alloc.height
-        screenshot_surface = target.create_similar(cairo.CONTENT_COLOR,
-                                                   canvas_width, canvas_height)
-        del dummy_cr, target
+        surface = self._preview_canvas_surface
+        if surface is None or surface.get_width() != alloc.width or \
+                surface.get_height() != alloc.height:
+            surface = cairo.ImageSurface(cairo.FORMAT_RGB24,
+                                         alloc.width, alloc.height)
+            self._preview_canvas_surface = surface
 
-        cr = cairo.Context(screenshot_surface)
+        cr = cairo.Context(surface)
         r, g, b, a_ = style.COLOR_PANEL_GREY.get_rgba()
         cr.set_source_rgb(r, g, b)
         cr.paint()
-        self.canvas.draw(cr)
+        self._rendering_preview = True
+        try:
+            self.canvas.draw(cr)
+        finally:
+            self._rendering_preview = False
         del cr
 
+        surface.flush()
+        return surface
+
+    def _scale_preview(self, canvas_surface):
+        # Only uses image surfaces, can run in a thread
         preview_width, preview_height = PREVIEW_SIZE
-        preview_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                             preview_width, preview_height)
+        if self._preview_surface is None:
+            self._preview_surface = cairo.ImageSurface(
+                cairo.FORMAT_ARGB32, preview_width, preview_height)
+        preview_surface = self._preview_surface
         cr = cairo.Context(preview_surface)
 
+        canvas_width = canvas_surface.get_width()
+        canvas_height = canvas_surface.get_height()
         scale_w = preview_width * 1.0 / canvas_width
         scale_h = preview_height * 1.0 / canvas_height
         scale = min(scale_w, scale_h)
@@ -821,18 +1099,46 @@ class Activity(Window, Gtk.Container):
         translate_x = int((preview_width - (canvas_width * scale)) / 2)
         translate_y = int((preview_height - (canvas_height * scale)) / 2)
 
-        cr.translate(translate_x, translate_y)
-        cr.scale(scale, scale)
-
-        cr.set_source_rgba(1, 1, 1, 0)
+        # JPEG has no transparency for the borders
+        if self._preview_format == PREVIEW_FORMAT_JPEG:
+            cr.set_source_rgba(1, 1, 1, 1)
+        else:
+            cr.set_source_rgba(1, 1, 1, 0)
         cr.set_operator(cairo.OPERATOR_SOURCE)
         cr.paint()
-        cr.set_source_surface(screenshot_surface)
+
+        cr.set_operator(cairo.OPERATOR_OVER)
+        cr.translate(translate_x, translate_y)
+        cr.scale(scale, scale)
+        cr.set_source_surface(canvas_surface)
         cr.paint()
+        del cr
 
-        preview_str = StringIO.StringIO()
-        preview_surface.write_to_png(preview_str)
-        return preview_str.getvalue()
+        preview_surface.flush()
+        return preview_surface
+
+    def _encode_preview(self, preview_surface):
+        if self._preview_format == PREVIEW_FORMAT_PNG and \
+                self._preview_quality is None:
+            preview_str = StringIO.StringIO()
+            preview_surface.write_to_png(preview_str)
+            return preview_str.getvalue()
+
+        pixbuf = Gdk.pixbuf_get_from_surface(
+            preview_surface, 0, 0, preview_surface.get_width(),
+            preview_surface.get_height())
+        if self._preview_format == PREVIEW_FORMAT_PNG:
+            options = ['compression'], [str(self._preview_quality)]
+        else:
+            quality = self._preview_quality
+            if quality is None:
+                quality = 85
+            options = ['quality'], [str(quality)]
+        success, data = pixbuf.save_to_bufferv(self._preview_format,
+                                               *options)
+        if not success:
+            return None
+        return data
 
     def _get_buddies(self):
         if self.shared_activity is not None:
@@ -861,14 +1167,42 @@ class Activity(Window, Gtk.Container):
 
         logging.debug('Activity.save: %r' % self._jobject.object_id)
 
+        self._save_stats['requests'] += 1
+        if self._save_request_time is None:
+            self._save_request_time = time.time()
+
         if self._updating_jobject:
-            logging.info('Activity.save: still processing a previous request.')
+            # Coalesced with the other requests, into a save of the latest
+            # state when the previous one completes
+            logging.info('Activity.save: still processing a previous '
+                         'request, saving again afterwards.')
+            if self._save_pending:
+                self._save_stats['coalesced'] += 1
+            self._save_pending = True
+            return
+
+        self._start_save()
+
+    def _start_save(self):
+        '''
+        Snapshot the state of the activity in the main thread, then write
+        it to the datastore.  When the activity implements
+        get_save_snapshot(), the file is written in a thread.
+        '''
+        if self._jobject is None:
+            self._save_pending = False
+            self._save_request_time = None
             return
 
+        start_time = time.time()
+        self._save_pending = False
+        copy = self._copy_requested
+        self._copy_requested = False
+
         buddies_dict = self._get_buddies()
         if buddies_dict:
             self.metadata['buddies_id'] = json.dumps(buddies_dict.keys())
-            self.metadata['buddies'] = json.dumps(self._get_buddies())
+            self.metadata['buddies'] = json.dumps(buddies_dict)
 
         # update spent time before saving
         self._update_spent_time()
@@ -883,34 +1217,83 @@ class Activity(Window, Gtk.Container):
         self.metadata['spent-times'] = set_last_value(
             self.metadata['spent-times'], self._spent_time)
 
-        preview = self.get_preview()
-        if preview is not None:
-            self.metadata['preview'] = dbus.ByteArray(preview)
+        # The preview is scaled and encoded while the file is written
+        get_preview = self._start_preview()
 
         if not self.metadata.get('activity_id', ''):
             self.metadata['activity_id'] = self.get_id()
 
         file_path = os.path.join(get_activity_root(), 'instance',
                                  '%i' % time.time())
-        try:
-            self.write_file(file_path)
-        except NotImplementedError:
-            logging.debug('Activity.write_file is not implemented.')
-        else:
+
+        snapshot = self.get_save_snapshot()
+        if snapshot is None:
+            try:
+                self.write_file(file_path)
+            except NotImplementedError:
+                logging.debug('Activity.write_file is not implemented.')
+            except Exception:
+                get_preview()
+                self._save_request_time = None
+                self._copy_requested = copy
+                raise
+
+        self._save_start_time = self._save_request_time or start_time
+        self._save_request_time = None
+        self._save_main_time = time.time() - start_time
+        self._updating_jobject = True
+
+        if snapshot is None:
+            self._write_to_datastore(file_path, get_preview, copy)
+            return
+
+        def write():
+            error = None
+            try:
+                self.write_snapshot(snapshot, file_path)
+            except Exception, e:
+                logging.exception('Error writing the activity snapshot')
+                error = e
+            GObject.idle_add(self.__snapshot_written_cb, file_path,
+                             get_preview, copy, error)
+
+        thread = threading.Thread(target=write)
+        thread.daemon = True
+        thread.start()
+
+    def __snapshot_written_cb(self, file_path, get_preview, copy, error):
+        if error is not None:
+            get_preview()
             if os.path.exists(file_path):
-                self._owns_file = True
-                self._jobject.file_path = file_path
+                os.remove(file_path)
+            # Logged by the thread, raising would only reach the main loop
+            self._handle_save_error()
+            return False
 
-        # Cannot call datastore.write async for creates:
-        # https://dev.laptop.org/ticket/3071
-        if self._jobject.object_id is None:
-            datastore.write(self._jobject, transfer_ownership=True)
-        else:
-            self._updating_jobject = True
-            datastore.write(self._jobject,
-                            transfer_ownership=True,
-                            reply_handler=self.__save_cb,
-                            error_handler=self.__save_error_cb)
+        start_time = time.time()
+        self._write_to_datastore(file_path, get_preview, copy)
+        self._save_main_time += time.time() - start_time
+        return False
+
+    def _write_to_datastore(self, file_path, get_preview, copy=False):
+        if os.path.exists(file_path):
+            self._owns_file = True
+            self._jobject.file_path = file_path
+
+        preview = get_preview()
+        if preview is not None:
+            self.metadata['preview'] = dbus.ByteArray(preview)
+
+        from sugar3.datastore import datastore
+
+        datastore.write(self._jobject,
+                        transfer_ownership=True,
+                        reply_handler=self.__save_cb,
+                        error_handler=self.__save_error_cb)
+
+        if copy:
+            # The next saves create a new entry, see copy()
+            self._jobject.object_id = None
 
     def copy(self):
         '''
@@ -921,8 +1304,8 @@ class Activity(Window, Gtk.Container):
         copy work that needs to be done in write_file()
         '''
         logging.debug('Activity.copy: %r' % self._jobject.object_id)
+        self._copy_requested = True
         self.save()
-        self._jobject.object_id = None
 
     def __privacy_changed_cb(self, shared_activity, param_spec):
         logging.debug('__privacy_changed_cb %r' %
@@ -941,6 +1324,7 @@ class Activity(Window, Gtk.Container):
             logging.debug('Failed to join activity: %s' % err)
             return
 
+        from sugar3 import power
         power_manager = power.get_power_manager()
         if power_manager.suspend_breaks_collaboration():
             power_manager.inhibit_suspend()
@@ -978,6 +1362,7 @@ class Activity(Window, Gtk.Container):
 
         activity.props.name = self._jobject.metadata['title']
 
+        from sugar3 import power
         power_manager = power.get_power_manager()
         if power_manager.suspend_breaks_collaboration():
             power_manager.inhibit_suspend()
@@ -995,6 +1380,8 @@ class Activity(Window, Gtk.Container):
             logging.error('Invite failed: %s', error)
 
     def _send_invites(self):
+        from sugar3.presence import presenceservice
+
         while self._invites_queue:
             account_path, contact_id = self._invites_queue.pop()
             pservice = presenceservice.get_instance()
@@ -1043,11 +1430,14 @@ class Activity(Window, Gtk.Container):
         verb = private and 'private' or 'public'
         logging.debug('Requesting %s share of activity %s.' % (verb,
                       self._activity_id))
+        from sugar3.presence import presenceservice
         pservice = presenceservice.get_instance()
         pservice.connect('activity-shared', self.__share_cb)
         pservice.share_activity(self, private=private)
 
     def _show_keep_failed_dialog(self):
+        from sugar3.graphics.alert import Alert
+
         alert = Alert()
         alert.props.title = _('Keep error')
         alert.props.msg = _('Keep error: all changes will be lost')
@@ -1107,6 +1497,7 @@ class Activity(Window, Gtk.Container):
         dbus.service.Object.remove_from_connection(self._bus)
 
         self._session.unregister(self)
+        from sugar3 import power
         power.get_power_manager().shutdown()
 
     def close(self, skip_save=False):
@@ -1189,53 +1580,6 @@ class Activity(Window, Gtk.Container):
         async_err_cb(NotImplementedError())
 
 
-class _ClientHandler(dbus.service.Object, DBusProperties):
-    def __init__(self, bundle_id, got_channel_cb):
-        self._interfaces = set([CLIENT, CLIENT_HANDLER, PROPERTIES_IFACE])
-        self._got_channel_cb = got_channel_cb
-
-        bus = dbus.Bus()
-        name = CLIENT + '.' + bundle_id
-        bus_name = dbus.service.BusName(name, bus=bus)
-
-        path = '/' + name.replace('.', '/')
-        dbus.service.Object.__init__(self, bus_name, path)
-        DBusProperties.__init__(self)
-
-        self._implement_property_get(CLIENT, {
-            'Interfaces': lambda: list(self._interfaces),
-        })
-        self._implement_property_get(CLIENT_HANDLER, {
-            'HandlerChannelFilter': self.__get_filters_cb,
-        })
-
-    def __get_filters_cb(self):
-        logging.debug('__get_filters_cb')
-        filters = {
-            CHANNEL + '.ChannelType': CHANNEL_TYPE_TEXT,
-            CHANNEL + '.TargetHandleType': CONNECTION_HANDLE_TYPE_CONTACT,
-        }
-        filter_dict = dbus.Dictionary(filters, signature='sv')
-        logging.debug('__get_filters_cb %r' % dbus.Array([filter_dict],
-                      signature='a{sv}'))
-        return dbus.Array([filter_dict], signature='a{sv}')
-
-    @dbus.service.method(dbus_interface=CLIENT_HANDLER,
-                         in_signature='ooa(oa{sv})aota{sv}', out_signature='')
-    def HandleChannels(self, account, connection, channels, requests_satisfied,
-                       user_action_time, handler_info):
-        logging.debug('HandleChannels\n\t%r\n\t%r\n\t%r\n\t%r\n\t%r\n\t%r' %
-                      (account, connection, channels, requests_satisfied,
-                          user_action_time, handler_info))
-        try:
-            for object_path, properties in channels:
-                channel_type = properties[CHANNEL + '.ChannelType']
-                handle_type = properties[CHANNEL + '.TargetHandleType']
-                if channel_type == CHANNEL_TYPE_TEXT:
-                    self._got_channel_cb(connection, object_path, handle_type)
-        except Exception, e:
-            logging.exception(e)
-
 _session = None
 
 
@@ -1301,6 +1645,7 @@ def get_bundle(bundle_id='', object_id=''):
     journal = dbus.Interface(obj, J_DBUS_INTERFACE)
     bundle_path = journal.GetBundlePath(bundle_id, object_id)
     if bundle_path:
+        from sugar3.bundle.helpers import bundle_from_dir
         return bundle_from_dir(bundle_path)
     else:
         return None
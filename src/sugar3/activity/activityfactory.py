@@ -28,13 +28,16 @@ import dbus
 from gi.repository import GObject
 
 from sugar3.activity.activityhandle import ActivityHandle
+from sugar3.activity import zygote
 from sugar3 import util
 from sugar3 import env
 from sugar3.datastore import datastore
 
 from errno import EEXIST, ENOSPC
+from functools import partial
 
 import os
+import socket
 import tempfile
 import subprocess
 import pwd
@@ -227,6 +230,29 @@ class ActivityCreationHandler(GObject.GObject):
                               self._handle.object_id, self._handle.uri,
                               self._handle.invited)
 
+        if zygote.can_launch(command):
+            try:
+                zygote.launch(command, environ, self._bundle.get_path(),
+                              log_path,
+                              partial(self.__zygote_reply_cb, log_file),
+                              partial(self.__zygote_error_cb, command,
+                                      environ, log_file))
+                return
+            except (zygote.ZygoteError, socket.error), e:
+                logging.warning('Could not launch with the zygote: %s', e)
+
+        self._start_process(command, environ, log_file)
+
+    def __zygote_reply_cb(self, log_file, pid, sock):
+        GObject.io_add_watch(sock, GObject.IO_IN | GObject.IO_HUP,
+                             _zygote_watch_cb,
+                             (pid, log_file, self._handle.activity_id))
+
+    def __zygote_error_cb(self, command, environ, log_file, error):
+        logging.warning('Could not launch with the zygote: %s', error)
+        self._start_process(command, environ, log_file)
+
+    def _start_process(self, command, environ, log_file):
         dev_null = file('/dev/null', 'r')
         child = subprocess.Popen([str(s) for s in command],
                                  env=environ,
@@ -299,7 +325,34 @@ def create_with_object_id(bundle, object_id):
     return ActivityCreationHandler(bundle, activity_handle)
 
 
+def _zygote_watch_cb(sock, io_condition, user_data):
+    pid, log_file, activity_id = user_data
+
+    condition = zygote.read_status(sock)
+    if condition is None:
+        logging.error('The zygote exited before activity %s', activity_id)
+        log_file.close()
+        return False
+
+    # The child appended its output, the file position is stale
+    log_file.seek(0, os.SEEK_END)
+    # The child is reaped by the zygote, it is not ours to wait for
+    _report_exit(pid, condition, (log_file, activity_id))
+    return False
+
+
 def _child_watch_cb(pid, condition, user_data):
+    _report_exit(pid, condition, user_data)
+
+    # try to reap zombies in case SIGCHLD has not been set to SIG_IGN
+    try:
+        os.waitpid(pid, 0)
+    except OSError:
+        # SIGCHLD = SIG_IGN, no zombies
+        pass
+
+
+def _report_exit(pid, condition, user_data):
     log_file, activity_id = user_data
 
     if os.WIFEXITED(condition):
@@ -320,13 +373,6 @@ def _child_watch_cb(pid, condition, user_data):
     finally:
         log_file.close()
 
-    # try to reap zombies in case SIGCHLD has not been set to SIG_IGN
-    try:
-        os.waitpid(pid, 0)
-    except OSError:
-        # SIGCHLD = SIG_IGN, no zombies
-        pass
-
     if status or signum:
         # XXX have to recreate dbus object since we can't reuse
         # ActivityCreationHandler's one, see
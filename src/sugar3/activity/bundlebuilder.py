@@ -84,18 +84,30 @@ Example `activity.info`
 '''
 
 import argparse
+import bz2
+import collections
+import multiprocessing
 import operator
 import os
 import sys
+import time
+import zlib
+import Queue
+import threading
 import zipfile
 import tarfile
 import unittest
 import shutil
 import subprocess
 import re
+import json
+import struct
+import hashlib
+import tempfile
 import gettext
 import logging
 from glob import glob
+from multiprocessing.pool import ThreadPool, AsyncResult
 from fnmatch import fnmatch
 from ConfigParser import ConfigParser
 import xml.etree.cElementTree as ET
@@ -105,8 +117,18 @@ from sugar3 import env
 from sugar3.bundle.activitybundle import ActivityBundle
 
 
+# Content hashes of the inputs of the last build, used by incremental builds
+LOCALE_MANIFEST = '.locale-manifest'
+
 IGNORE_DIRS = ['dist', '.git', 'screenshots']
-IGNORE_FILES = ['.gitignore', 'MANIFEST', '*.pyc', '*~', '*.bak', 'pseudo.po']
+
+# Stored without compression in the .xo bundle
+STORED_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.ogg', '.oga', '.ogv',
+                     '.spx', '.mp3', '.mp4', '.webm', '.zip', '.xo', '.gz',
+                     '.bz2', '.xz']
+IGNORE_FILES = ['.gitignore', 'MANIFEST', '*.pyc', '*~', '*.bak', 'pseudo.po',
+                LOCALE_MANIFEST]
+_MANIFEST_VERSION = 1
 
 
 def list_files(base_dir, ignore_dirs=None, ignore_files=None):
@@ -128,7 +150,375 @@ def list_files(base_dir, ignore_dirs=None, ignore_files=None):
                 if ignore in dirs:
                     dirs.remove(ignore)
 
-    return result
+    return sorted(result)
+
+
+def _hash_file(path, data=''):
+    sha_hash = hashlib.sha1(data)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            sha_hash.update(chunk)
+    return sha_hash.hexdigest()
+
+
+def _read_manifest(path):
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    if not isinstance(manifest, dict) or \
+            manifest.get('version') != _MANIFEST_VERSION:
+        return {}
+    return manifest.get('files', {})
+
+
+def _write_manifest(path, files):
+    with open(path, 'w') as f:
+        json.dump({'version': _MANIFEST_VERSION, 'files': files}, f,
+                  indent=1, sort_keys=True)
+
+
+def _get_source_date_epoch():
+    try:
+        return int(os.environ['SOURCE_DATE_EPOCH'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _get_zip_info(path, arcname):
+    st = os.stat(path)
+    mtime = st.st_mtime
+    epoch = _get_source_date_epoch()
+    if epoch is not None:
+        date_time = time.gmtime(min(mtime, epoch))[:6]
+    else:
+        date_time = time.localtime(mtime)[:6]
+
+    # The zip format can't store dates older than 1980
+    info = zipfile.ZipInfo(arcname, max(date_time, (1980, 1, 1, 0, 0, 0)))
+    info.external_attr = (st.st_mode & 0xFFFF) << 16L
+    return info
+
+
+def _reset_tar_info(tarinfo):
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    epoch = _get_source_date_epoch()
+    if epoch is not None:
+        tarinfo.mtime = min(tarinfo.mtime, epoch)
+    return tarinfo
+
+
+class _BZ2Writer(object):
+    """File object compressing the data written to it into path, from a
+    separate thread.
+    """
+
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path, compression_level):
+        self._file = open(path, 'wb')
+        self._compressor = bz2.BZ2Compressor(compression_level)
+        self._queue = Queue.Queue(maxsize=8)
+        self._buffer = []
+        self._buffer_size = 0
+        self._position = 0
+        self._error = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self._position += len(data)
+        if self._buffer_size >= self._CHUNK_SIZE:
+            self._flush_buffer()
+
+    def tell(self):
+        return self._position
+
+    def _flush_buffer(self):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(''.join(self._buffer))
+        self._buffer = []
+        self._buffer_size = 0
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                self._file.write(self._compressor.compress(data))
+            except (IOError, OSError), e:
+                self._error = e
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            if self._buffer:
+                self._flush_buffer()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+
+        try:
+            if self._error is not None:
+                raise self._error
+            self._file.write(self._compressor.flush())
+        finally:
+            self._file.close()
+
+
+# Records of the zip format, see the .ZIP File Format Specification
+_ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_ZIP_CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+_ZIP_END_RECORD = struct.Struct('<4s4H2LH')
+_ZIP_MAX_SIZE = 0xffffffff
+_ZIP_MAX_ENTRIES = 0xffff
+_ZIP_CHUNK_SIZE = 65536
+
+
+def _get_dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return ((year - 1980) << 9 | month << 5 | day,
+            hour << 11 | minute << 5 | second // 2)
+
+
+def _encode_zip_name(info):
+    """Returns the name and the flags of the entry info, with the UTF-8
+    flag set for unicode names"""
+    if isinstance(info.filename, unicode):
+        return info.filename.encode('utf-8'), info.flag_bits | 0x800
+    return info.filename, info.flag_bits
+
+
+def _find_zip_data(zip_file, info):
+    """Returns the offset of the compressed data of the entry info in the
+    zip file opened as zip_file"""
+    # The sizes of the name and extra fields may differ from the ones
+    # of the central directory
+    zip_file.seek(info.header_offset)
+    header = _ZIP_LOCAL_HEADER.unpack(
+        zip_file.read(_ZIP_LOCAL_HEADER.size))
+    if header[0] != 'PK\003\004':
+        raise zipfile.BadZipfile('Bad local header of %s' % info.filename)
+    offset = zip_file.tell() + header[9] + header[10]
+    if offset + info.compress_size > os.fstat(zip_file.fileno()).st_size:
+        raise zipfile.BadZipfile('Truncated data of %s' % info.filename)
+    return offset
+
+
+class _ZipWriter(object):
+    """Write a zip file of entries compressed beforehand, which ZipFile
+    can't do.  The entries are described by ZipInfo objects, with their
+    compression type, CRC and sizes set, and their compressed data is
+    copied in chunks from a file object.  ZIP64 is not supported, like
+    ZipFile without allowZip64.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._entries = []
+
+    def write(self, info, data_file):
+        """Write the entry info, reading its compress_size bytes of
+        data from the current position of data_file"""
+        if len(self._entries) >= _ZIP_MAX_ENTRIES or \
+                max(info.file_size, info.compress_size,
+                    self._file.tell()) > _ZIP_MAX_SIZE:
+            raise zipfile.LargeZipFile('Zip file too large for %s' %
+                                       info.filename)
+
+        info.header_offset = self._file.tell()
+        name, flags = _encode_zip_name(info)
+        date, time_ = _get_dos_date_time(info.date_time)
+        self._file.write(_ZIP_LOCAL_HEADER.pack(
+            'PK\003\004', info.extract_version, flags, info.compress_type,
+            time_, date, info.CRC, info.compress_size, info.file_size,
+            len(name), 0))
+        self._file.write(name)
+
+        remaining = info.compress_size
+        while remaining > 0:
+            data = data_file.read(min(remaining, _ZIP_CHUNK_SIZE))
+            if not data:
+                raise IOError('Short data for %s' % info.filename)
+            self._file.write(data)
+            remaining -= len(data)
+        self._entries.append(info)
+
+    def close(self):
+        try:
+            start = self._file.tell()
+            for info in self._entries:
+                name, flags = _encode_zip_name(info)
+                date, time_ = _get_dos_date_time(info.date_time)
+                self._file.write(_ZIP_CENTRAL_HEADER.pack(
+                    'PK\001\002', info.create_system << 8 |
+                    info.create_version, info.extract_version, flags,
+                    info.compress_type, time_, date, info.CRC,
+                    info.compress_size, info.file_size, len(name), 0, 0, 0,
+                    0, info.external_attr, info.header_offset))
+                self._file.write(name)
+            end = self._file.tell()
+            if end > _ZIP_MAX_SIZE:
+                raise zipfile.LargeZipFile('Zip file too large')
+
+            count = len(self._entries)
+            self._file.write(_ZIP_END_RECORD.pack(
+                'PK\005\006', 0, 0, count, count, end - start, start, 0))
+        finally:
+            self._file.close()
+
+
+def _get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+_PO_STRING_RE = re.compile(r'"((?:[^"\\]|\\.)*)"$')
+_PO_ESCAPE_RE = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))')
+_PO_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'a': '\a', 'b': '\b',
+               'f': '\f', 'v': '\v', '\\': '\\', '"': '"'}
+
+
+def _parse_po_string(line, po_file, lineno):
+    """Unescape a quoted string of a PO file, with the C escape sequences
+    msgfmt accepts."""
+    match = _PO_STRING_RE.match(line)
+    if match is None:
+        raise ValueError('%s:%d: invalid string %s' % (po_file, lineno, line))
+
+    def unescape(match):
+        octal, hexadecimal, char = match.groups()
+        if octal is not None and int(octal, 8) < 256:
+            return chr(int(octal, 8))
+        if hexadecimal is not None:
+            return chr(int(hexadecimal, 16))
+        if char in _PO_ESCAPES:
+            return _PO_ESCAPES[char]
+        raise ValueError('%s:%d: invalid escape sequence %s' %
+                         (po_file, lineno, match.group()))
+
+    return _PO_ESCAPE_RE.sub(unescape, match.group(1))
+
+
+def compile_po(po_file, mo_file):
+    """Compile the gettext catalog po_file to mo_file, like msgfmt does.
+
+    Fuzzy and untranslated messages are left out, as msgfmt does by
+    default.  Raises ValueError if po_file cannot be parsed.
+    """
+    messages = {}
+    entry = {}
+    fuzzy = False
+    section = None
+
+    def add_entry(entry, fuzzy):
+        msgid = entry.get('msgid')
+        if msgid is None:
+            return
+        if 'msgid_plural' in entry:
+            msgid += '\0' + entry['msgid_plural']
+            msgstr = '\0'.join([entry[key] for key in sorted(entry)
+                                if isinstance(key, int)])
+        else:
+            msgstr = entry.get('msgstr', '')
+        if 'msgctxt' in entry:
+            msgid = entry['msgctxt'] + '\x04' + msgid
+        # The header is kept even if fuzzy
+        if msgid and fuzzy or not msgstr.strip('\0'):
+            return
+        messages[msgid] = msgstr
+
+    with open(po_file, 'r') as f:
+        lines = f.readlines()
+
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        keyword = line.split(None, 1)[0]
+
+        # Comments and msgctxt or msgid lines after a msgstr start the
+        # next entry
+        if (line.startswith('#') or keyword in ('msgctxt', 'msgid')) and \
+                (section == 'msgstr' or isinstance(section, int)):
+            add_entry(entry, fuzzy)
+            entry = {}
+            fuzzy = False
+            section = None
+
+        if line.startswith('#'):
+            if line.startswith('#,') and 'fuzzy' in line:
+                fuzzy = True
+            continue
+
+        if keyword in ('msgctxt', 'msgid'):
+            section = keyword
+        elif keyword == 'msgid_plural':
+            section = keyword
+        elif keyword.startswith('msgstr['):
+            try:
+                section = int(keyword[7:-1])
+            except ValueError:
+                raise ValueError('%s:%d: invalid keyword %s' %
+                                 (po_file, lineno, keyword))
+        elif keyword == 'msgstr':
+            section = keyword
+        elif line.startswith('"'):
+            if section is None:
+                raise ValueError('%s:%d: unexpected string' %
+                                 (po_file, lineno))
+            entry[section] += _parse_po_string(line, po_file, lineno)
+            continue
+        else:
+            raise ValueError('%s:%d: invalid keyword %s' %
+                             (po_file, lineno, keyword))
+
+        value = line[len(keyword):].strip()
+        entry[section] = _parse_po_string(value, po_file, lineno)
+
+    add_entry(entry, fuzzy)
+
+    # See the "MO Files" section of the gettext manual for the layout
+    keys = sorted(messages)
+    ids = strs = ''
+    offsets = []
+    for key in keys:
+        offsets.append((len(ids), len(key), len(strs), len(messages[key])))
+        ids += key + '\0'
+        strs += messages[key] + '\0'
+
+    keys_start = 7 * 4 + 16 * len(keys)
+    values_start = keys_start + len(ids)
+    key_offsets = []
+    value_offsets = []
+    for id_offset, id_length, str_offset, str_length in offsets:
+        key_offsets += [id_length, id_offset + keys_start]
+        value_offsets += [str_length, str_offset + values_start]
+
+    output = struct.pack('<7I', 0x950412de, 0, len(keys), 7 * 4,
+                         7 * 4 + len(keys) * 8, 0, 0)
+    output += struct.pack('<%dI' % (len(keys) * 4),
+                          *(key_offsets + value_offsets))
+    with open(mo_file, 'wb') as f:
+        f.write(output + ids + strs)
 
 
 class Config(object):
@@ -173,9 +563,13 @@ class Config(object):
 
 class Builder(object):
 
-    def __init__(self, config, no_fail=False):
+    def __init__(self, config, no_fail=False, incremental=False, jobs=None,
+                 builtin_msgfmt=False):
         self.config = config
         self._no_fail = no_fail
+        self._incremental = incremental
+        self._jobs = jobs or _get_cpu_count()
+        self._builtin_msgfmt = builtin_msgfmt
         self.locale_dir = os.path.join(self.config.build_dir, 'locale')
 
     def build(self):
@@ -188,10 +582,22 @@ class Builder(object):
             logging.warn('Missing po/ dir, cannot build_locale')
             return
 
-        if os.path.exists(self.locale_dir):
-            shutil.rmtree(self.locale_dir)
-
-        for f in os.listdir(po_dir):
+        manifest_path = os.path.join(self.config.build_dir, LOCALE_MANIFEST)
+        if self._incremental:
+            old_manifest = _read_manifest(manifest_path)
+        else:
+            old_manifest = {}
+            if os.path.exists(self.locale_dir):
+                shutil.rmtree(self.locale_dir)
+
+        # The activity.linfo files also depend on the untranslated strings
+        strings = '\0'.join([self.config.bundle_id,
+                             self.config.activity_name,
+                             self.config.summary or ''])
+        manifest = {}
+        catalogs = []
+
+        for f in sorted(os.listdir(po_dir)):
             if not f.endswith('.po') or f == 'pseudo.po':
                 continue
 
@@ -200,32 +606,92 @@ class Builder(object):
 
             localedir = os.path.join(self.config.build_dir, 'locale', lang)
             mo_path = os.path.join(localedir, 'LC_MESSAGES')
+            mo_file = os.path.join(mo_path, '%s.mo' % self.config.bundle_id)
+            linfo_file = os.path.join(localedir, 'activity.linfo')
+
+            po_hash = _hash_file(file_name, strings)
+            if old_manifest.get(lang) == po_hash and \
+                    os.path.exists(mo_file) and os.path.exists(linfo_file):
+                manifest[lang] = po_hash
+                continue
+
             if not os.path.isdir(mo_path):
                 os.makedirs(mo_path)
 
-            mo_file = os.path.join(mo_path, '%s.mo' % self.config.bundle_id)
-            args = ['msgfmt', '--output-file=%s' % mo_file, file_name]
-            retcode = subprocess.call(args)
+            catalogs.append((lang, file_name, mo_file, linfo_file, po_hash))
+
+        results = self._compile_catalogs([catalog[1:3]
+                                          for catalog in catalogs])
+
+        # Report in the order of the .po files, whatever the order in which
+        # the compilations finished
+        for catalog, (retcode, errors) in zip(catalogs, results):
+            lang, file_name, mo_file, linfo_file, po_hash = catalog
+            if errors:
+                sys.stderr.write(errors)
             if retcode:
                 print 'ERROR - msgfmt failed with return code %i.' % retcode
                 if self._no_fail:
                     continue
 
-            cat = gettext.GNUTranslations(open(mo_file, 'r'))
-            translated_name = cat.gettext(self.config.activity_name)
-            translated_summary = cat.gettext(self.config.summary)
-            if translated_summary is None:
-                translated_summary = ''
-            if translated_summary.find('\n') > -1:
-                translated_summary = translated_summary.replace('\n', '')
-                logging.warn(
-                    'Translation of summary on file %s have \\n chars. '
-                    'Should be removed' % file_name)
-            linfo_file = os.path.join(localedir, 'activity.linfo')
-            f = open(linfo_file, 'w')
-            f.write('[Activity]\nname = %s\n' % translated_name)
-            f.write('summary = %s\n' % translated_summary)
-            f.close()
+            self._write_linfo(file_name, mo_file, linfo_file)
+            manifest[lang] = po_hash
+
+        # Drop the output of .po files which have been removed since
+        for lang in set(old_manifest) - set(manifest):
+            localedir = os.path.join(self.locale_dir, lang)
+            if os.path.isdir(localedir):
+                shutil.rmtree(localedir)
+
+        _write_manifest(manifest_path, manifest)
+
+    def _compile_catalogs(self, catalogs):
+        """Compile the (po_file, mo_file) catalogs, returns a
+        (retcode, errors) tuple for each of them, in the same order.
+        """
+        if self._builtin_msgfmt:
+            results = []
+            for po_file, mo_file in catalogs:
+                try:
+                    compile_po(po_file, mo_file)
+                except (IOError, ValueError), e:
+                    results.append((1, '%s: %s\n' % (po_file, e)))
+                else:
+                    results.append((0, ''))
+            return results
+
+        # Run up to self._jobs msgfmt processes at a time, waiting for
+        # them in the order they were started
+        results = []
+        running = []
+        for po_file, mo_file in catalogs:
+            if len(running) == self._jobs:
+                results.append(self._wait_msgfmt(running.pop(0)))
+            args = ['msgfmt', '--output-file=%s' % mo_file, po_file]
+            running.append(subprocess.Popen(args, stderr=subprocess.PIPE))
+        for process in running:
+            results.append(self._wait_msgfmt(process))
+        return results
+
+    def _wait_msgfmt(self, process):
+        stdout_, errors = process.communicate()
+        return process.returncode, errors
+
+    def _write_linfo(self, file_name, mo_file, linfo_file):
+        cat = gettext.GNUTranslations(open(mo_file, 'r'))
+        translated_name = cat.gettext(self.config.activity_name)
+        translated_summary = cat.gettext(self.config.summary)
+        if translated_summary is None:
+            translated_summary = ''
+        if translated_summary.find('\n') > -1:
+            translated_summary = translated_summary.replace('\n', '')
+            logging.warn(
+                'Translation of summary on file %s have \\n chars. '
+                'Should be removed' % file_name)
+        f = open(linfo_file, 'w')
+        f.write('[Activity]\nname = %s\n' % translated_name)
+        f.write('summary = %s\n' % translated_summary)
+        f.close()
 
     def get_locale_files(self):
         return list_files(self.locale_dir, IGNORE_DIRS, IGNORE_FILES)
@@ -290,44 +756,213 @@ class Packager(object):
 
 
 class XOPackager(Packager):
-
-    def __init__(self, builder):
+    """Create the .xo bundle of the activity.
+
+    The files are compressed in chunks by a pool of jobs threads, each
+    into a temporary file, and copied to the bundle in a deterministic
+    order.  Files which are compressed already, see STORED_EXTENSIONS, are
+    stored as they are, copied straight from the source file.  The
+    modification time of the files is clamped to SOURCE_DATE_EPOCH, if set
+    in the environment, so that the bundle can be reproduced byte for byte.
+
+    In incremental mode the content hash of every file is recorded in a
+    manifest next to the bundle, and the compressed data of the files
+    which did not change since the last build are copied as they are from
+    the previous bundle, instead of being compressed again.
+    """
+
+    def __init__(self, builder, incremental=False, jobs=None,
+                 compression_level=None):
         Packager.__init__(self, builder.config)
 
         self.builder = builder
         self.builder.build_locale()
         self.package_path = os.path.join(self.config.dist_dir,
                                          self.config.xo_name)
+        self.manifest_path = os.path.join(self.config.dist_dir,
+                                          '.%s.manifest' % self.config.xo_name)
+        self._incremental = incremental
+        self._jobs = jobs or _get_cpu_count()
+        if compression_level is None:
+            compression_level = zlib.Z_DEFAULT_COMPRESSION
+        self._compression_level = compression_level
 
     def package(self):
-        bundle_zip = zipfile.ZipFile(self.package_path, 'w',
-                                     zipfile.ZIP_DEFLATED)
-
+        files = []
         for f in self.get_files_in_git():
-            bundle_zip.write(os.path.join(self.config.source_dir, f),
-                             os.path.join(self.config.bundle_root_dir, f))
+            files.append((os.path.join(self.config.source_dir, f),
+                          os.path.join(self.config.bundle_root_dir, f)))
+
+        for f in sorted(self.builder.get_locale_files()):
+            files.append((os.path.join(self.builder.locale_dir, f),
+                          os.path.join(self.config.bundle_root_dir,
+                                       'locale', f)))
+
+        old_manifest = {}
+        old_zip = None
+        old_file = None
+        if self._incremental and os.path.exists(self.package_path):
+            old_manifest = _read_manifest(self.manifest_path)
+            if old_manifest:
+                try:
+                    old_zip = zipfile.ZipFile(self.package_path, 'r')
+                    old_file = open(self.package_path, 'rb')
+                except (IOError, zipfile.BadZipfile):
+                    logging.warn('Packager: cannot reuse %s',
+                                 self.package_path)
+                    old_manifest = {}
+
+        # Write next to the old bundle, which is still being read from
+        fd, temp_path = tempfile.mkstemp(dir=self.config.dist_dir,
+                                         suffix='.xo')
+        os.close(fd)
+
+        # Entries reused from the old bundle are only valid if compressed
+        # with the same level
+        level = str(self._compression_level)
+
+        manifest = {}
+        pool = ThreadPool(self._jobs)
+        pending = collections.deque()
+        done = False
+        try:
+            bundle_zip = _ZipWriter(temp_path)
+
+            for path, arcname in files:
+                file_hash = _hash_file(path, level)
+                manifest[arcname] = file_hash
+
+                entry = None
+                if old_manifest.get(arcname) == file_hash:
+                    entry = self._read_entry(old_zip, old_file, path,
+                                             arcname)
+                if entry is None:
+                    entry = pool.apply_async(self._compress_entry,
+                                             (path, arcname))
+                pending.append(entry)
+
+                # Bound the number of files waiting to be written
+                while len(pending) > self._jobs * 2:
+                    self._write_entry(bundle_zip, old_file, pending.popleft())
+
+            while pending:
+                self._write_entry(bundle_zip, old_file, pending.popleft())
+
+            bundle_zip.close()
+            done = True
+        finally:
+            pool.terminate()
+            if old_zip is not None:
+                old_zip.close()
+            if old_file is not None:
+                old_file.close()
+            if not done:
+                os.unlink(temp_path)
+
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0666 & ~umask)
+        os.rename(temp_path, self.package_path)
+        _write_manifest(self.manifest_path, manifest)
+
+    def _compress_entry(self, path, arcname):
+        info = _get_zip_info(path, arcname)
+
+        extension = os.path.splitext(path)[1].lower()
+        if self._compression_level == 0 or extension in STORED_EXTENSIONS:
+            info.compress_type = zipfile.ZIP_STORED
+            compressor = None
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+            compressor = zlib.compressobj(self._compression_level,
+                                          zlib.DEFLATED, -15)
+            data_file = tempfile.TemporaryFile(dir=self.config.dist_dir)
+
+        crc = 0
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_ZIP_CHUNK_SIZE), ''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if compressor is not None:
+                    data_file.write(compressor.compress(chunk))
+
+        info.CRC = crc & 0xffffffff
+        info.file_size = size
+        if compressor is None:
+            # Copied from the file itself when written to the bundle
+            info.compress_size = size
+            data_file = open(path, 'rb')
+        else:
+            data_file.write(compressor.flush())
+            info.compress_size = data_file.tell()
+        return info, data_file, 0
 
-        for f in self.builder.get_locale_files():
-            bundle_zip.write(os.path.join(self.builder.locale_dir, f),
-                             os.path.join(self.config.bundle_root_dir,
-                                          'locale', f))
+    def _read_entry(self, old_zip, old_file, path, arcname):
+        try:
+            old_info = old_zip.getinfo(arcname)
+        except KeyError:
+            return None
 
-        bundle_zip.close()
+        # Neither encrypted entries nor other compression types
+        if old_info.compress_type not in (zipfile.ZIP_STORED,
+                                          zipfile.ZIP_DEFLATED) or \
+                old_info.flag_bits & 0x1:
+            return None
+
+        try:
+            offset = _find_zip_data(old_file, old_info)
+        except (IOError, struct.error, zipfile.BadZipfile), e:
+            logging.warn('Packager: cannot reuse %s: %s', arcname, e)
+            return None
+
+        info = _get_zip_info(path, arcname)
+        info.compress_type = old_info.compress_type
+        info.CRC = old_info.CRC
+        info.compress_size = old_info.compress_size
+        info.file_size = old_info.file_size
+        return info, old_file, offset
+
+    def _write_entry(self, bundle_zip, old_file, entry):
+        if isinstance(entry, AsyncResult):
+            entry = entry.get()
+        info, data_file, offset = entry
+        try:
+            data_file.seek(offset)
+            bundle_zip.write(info, data_file)
+        finally:
+            if data_file is not old_file:
+                data_file.close()
 
 
 class SourcePackager(Packager):
+    """Create the .tar.bz2 source package of the activity.
 
-    def __init__(self, config):
+    A bzip2 file holding more than one stream cannot be read by the
+    Python 2 bz2 module, so the compression can't be split in parallel
+    jobs.  It happens in a separate thread instead, while the files are
+    read.  As for the .xo bundle, the modification time of the files is
+    clamped to SOURCE_DATE_EPOCH and their owner is not recorded, to get
+    reproducible packages.
+    """
+
+    def __init__(self, config, compression_level=9):
         Packager.__init__(self, config)
         self.package_path = os.path.join(self.config.dist_dir,
                                          self.config.tar_name)
+        self._compression_level = compression_level
 
     def package(self):
-        tar = tarfile.open(self.package_path, 'w:bz2')
-        for f in self.get_files_in_git():
-            tar.add(os.path.join(self.config.source_dir, f),
-                    os.path.join(self.config.tar_root_dir, f))
-        tar.close()
+        writer = _BZ2Writer(self.package_path, self._compression_level)
+        try:
+            tar = tarfile.open(self.package_path, 'w', writer)
+            for f in self.get_files_in_git():
+                tar.add(os.path.join(self.config.source_dir, f),
+                        os.path.join(self.config.tar_root_dir, f),
+                        filter=_reset_tar_info)
+            tar.close()
+        finally:
+            writer.close()
 
 
 class Installer(Packager):
@@ -534,10 +1169,19 @@ def cmd_dev(config, options):
 def cmd_dist_xo(config, options):
     """Create a xo bundle package"""
     no_fail = False
+    incremental = False
+    jobs = None
+    builtin_msgfmt = False
+    compression_level = None
     if options is not None:
         no_fail = options.no_fail
+        incremental = options.incremental
+        jobs = options.jobs
+        builtin_msgfmt = options.builtin_msgfmt
+        compression_level = options.compression_level
 
-    packager = XOPackager(Builder(config, no_fail))
+    builder = Builder(config, no_fail, incremental, jobs, builtin_msgfmt)
+    packager = XOPackager(builder, incremental, jobs, compression_level)
     packager.package()
 
 
@@ -552,14 +1196,19 @@ def cmd_fix_manifest(config, options):
 def cmd_dist_source(config, options):
     """Create a tar source package"""
 
-    packager = SourcePackager(config)
+    compression_level = 9
+    if options is not None and options.compression_level is not None:
+        compression_level = options.compression_level
+
+    packager = SourcePackager(config, compression_level)
     packager.package()
 
 
 def cmd_install(config, options):
     """Install the activity in the system"""
 
-    installer = Installer(Builder(config))
+    installer = Installer(Builder(config, jobs=options.jobs,
+                                  builtin_msgfmt=options.builtin_msgfmt))
     installer.install(options.prefix, options.install_mime)
 
 
@@ -627,10 +1276,21 @@ def cmd_genpot(config, options):
 def cmd_build(config, options):
     """Build generated files"""
 
-    builder = Builder(config)
+    builder = Builder(config, jobs=options.jobs,
+                      builtin_msgfmt=options.builtin_msgfmt)
     builder.build()
 
 
+def _add_locale_arguments(parser):
+    parser.add_argument(
+        "--jobs", "-j", dest="jobs", type=int, default=None,
+        help="number of jobs to run at the same time")
+    parser.add_argument(
+        "--builtin-msgfmt", dest="builtin_msgfmt", action="store_true",
+        default=False,
+        help="compile translations without running msgfmt")
+
+
 def start():
     parser = argparse.ArgumentParser(prog='./setup.py')
     subparsers = parser.add_subparsers(
@@ -645,6 +1305,7 @@ def start():
         "--skip-install-mime", dest="install_mime",
         action="store_false", default=True,
         help="Skip the installation of custom mime types in the system")
+    _add_locale_arguments(install_parser)
 
     check_parser = subparsers.add_parser(
         "check", help="Run tests for the activity")
@@ -661,9 +1322,25 @@ def start():
     dist_parser.add_argument(
         "--no-fail", dest="no_fail", action="store_true", default=False,
         help="continue past failure when building xo file")
-
-    subparsers.add_parser("dist_source", help="Create a tar source package")
-    subparsers.add_parser("build", help="Build generated files")
+    dist_parser.add_argument(
+        "--incremental", dest="incremental", action="store_true",
+        default=False,
+        help="reuse the output of the previous build for unchanged files")
+    dist_parser.add_argument(
+        "--compression-level", dest="compression_level", type=int,
+        choices=range(0, 10), default=None,
+        help="zlib compression level, 0 to store the files uncompressed")
+    _add_locale_arguments(dist_parser)
+
+    dist_source_parser = subparsers.add_parser(
+        "dist_source", help="Create a tar source package")
+    dist_source_parser.add_argument(
+        "--compression-level", dest="compression_level", type=int,
+        choices=range(1, 10), default=None,
+        help="bzip2 compression level")
+    build_parser = subparsers.add_parser("build",
+                                         help="Build generated files")
+    _add_locale_arguments(build_parser)
     subparsers.add_parser(
         "fix_manifest", help="Add missing files to the manifest (OBSOLETE)")
     subparsers.add_parser("genpot", help="Generate the gettext pot file")
@@ -0,0 +1,471 @@
+# Copyright (C) 2016 Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Pre-initialised process forking the sugar-activity launches
+
+Most of the launch time of a python activity is spent importing GTK,
+dbus and the toolkit.  The zygote is a sugar-activity process which
+has imported them once, and forks a child for every launch:
+
+    sugar-activity --zygote $XDG_RUNTIME_DIR/sugar-activity-zygote
+
+The shell exports the socket path in SUGAR_ACTIVITY_ZYGOTE, then the
+launches whose command is sugar-activity are sent to the zygote by
+sugar3.activity.activityfactory, with the same command line, environment,
+working directory and log file as a new process would get.  Any other
+command, or a zygote which can't be reached or doesn't reply in time,
+falls back to running the command in a new process.  The reply is
+waited for from the main loop, so that a stuck zygote doesn't block the
+shell.
+
+The zygote must not hold connections or threads that the children would
+inherit, so the display is hidden while the modules are imported, the
+session bus is only connected by the children, and sugar3.graphics is not
+preloaded: its style module reads GSettings, which starts a dconf thread
+that would not survive the fork.
+
+UNSTABLE.
+"""
+
+import os
+import sys
+import json
+import errno
+import fcntl
+import random
+import select
+import signal
+import socket
+import logging
+import traceback
+
+_ZYGOTE_ENV = 'SUGAR_ACTIVITY_ZYGOTE'
+
+# Imported by the zygote, so that the children don't have to
+_PRELOAD_VERSIONS = [('Gtk', '3.0'), ('Gdk', '3.0'), ('GdkX11', '3.0'),
+                     ('Rsvg', '2.0')]
+_PRELOAD_MODULES = ['gi.repository.GObject',
+                    'gi.repository.GLib',
+                    'gi.repository.Gio',
+                    'gi.repository.Gtk',
+                    'gi.repository.Gdk',
+                    'gi.repository.GdkX11',
+                    'gi.repository.GdkPixbuf',
+                    'gi.repository.Pango',
+                    'gi.repository.Rsvg',
+                    'cairo',
+                    'dbus.service',
+                    'dbus.mainloop.glib',
+                    'sugar3.activity.activityhandle',
+                    'sugar3.activity.activityservice',
+                    'sugar3.bundle.activitybundle',
+                    'sugar3.datastore.datastore',
+                    'sugar3.presence.presenceservice']
+
+# Hidden while preloading, so that no display connection is inherited
+_DISPLAY_ENV = ['DISPLAY', 'WAYLAND_DISPLAY']
+
+# Connecting and sending the request block the caller, only for as long
+# as a zygote busy forking would take to accept
+_CONNECT_TIMEOUT = 0.5
+_REQUEST_TIMEOUT = 5
+
+
+class ZygoteError(Exception):
+    pass
+
+
+def get_socket_path():
+    """The socket of the running zygote, or None if there is none"""
+    path = os.environ.get(_ZYGOTE_ENV)
+    if path and os.path.exists(path):
+        return path
+    return None
+
+
+def can_launch(command):
+    """Whether the command, see activityfactory.get_command(), can be
+    launched by the zygote"""
+    return command[0] == 'sugar-activity' and get_socket_path() is not None
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _read_message(sock_file):
+    line = sock_file.readline()
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise ZygoteError('Malformed message %r' % line)
+
+
+def _write_message(sock, message):
+    sock.sendall(json.dumps(message) + '\n')
+
+
+class _LaunchRequest(object):
+
+    def __init__(self, sock, command, reply_handler, error_handler):
+        self._sock = sock
+        self._command = command
+        self._reply_handler = reply_handler
+        self._error_handler = error_handler
+        self._line = []
+
+        from gi.repository import GObject
+        self._watch_id = GObject.io_add_watch(
+            sock, GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+            self.__io_cb)
+        self._timeout_id = GObject.timeout_add_seconds(
+            _REQUEST_TIMEOUT, self.__timeout_cb)
+
+    def _finish(self, error, pid=None):
+        from gi.repository import GObject
+        GObject.source_remove(self._watch_id)
+        GObject.source_remove(self._timeout_id)
+
+        if error is not None:
+            self._sock.close()
+            self._error_handler(error)
+        else:
+            self._sock.setblocking(True)
+            self._reply_handler(pid, self._sock)
+
+    def __timeout_cb(self):
+        self._finish(ZygoteError('The zygote did not reply to %r' %
+                                 self._command))
+        return False
+
+    def __io_cb(self, sock, condition):
+        # Byte by byte, the wait status follows the reply
+        while True:
+            try:
+                char = sock.recv(1)
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] == errno.EAGAIN:
+                    return True
+                self._finish(e)
+                return False
+
+            if not char or char == '\n':
+                break
+            self._line.append(char)
+
+        try:
+            reply = json.loads(''.join(self._line))
+        except ValueError:
+            reply = None
+        if not isinstance(reply, dict) or 'pid' not in reply:
+            self._finish(ZygoteError('The zygote did not launch %r' %
+                                     self._command))
+        else:
+            self._finish(None, reply['pid'])
+        return False
+
+
+def launch(command, environ, cwd, log_path, reply_handler, error_handler):
+    """Ask the zygote to launch the activity command, with the
+    environ and working directory cwd, appending its output to the
+    file at log_path.
+
+    The reply of the zygote is waited for from the main loop.  Then
+    reply_handler is called with (pid, sock), where sock receives the
+    wait status of the child when it exits, see read_status().  If the
+    zygote can't launch the activity, error_handler is called with the
+    ZygoteError or socket.error.  Errors connecting to the zygote are
+    raised instead.
+    """
+    path = get_socket_path()
+    if path is None:
+        raise ZygoteError('No zygote is running')
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(_CONNECT_TIMEOUT)
+        sock.connect(path)
+        _write_message(sock, {'command': [str(s) for s in command],
+                              'environ': environ,
+                              'cwd': cwd,
+                              'log_path': log_path})
+    except socket.error:
+        sock.close()
+        raise
+
+    sock.setblocking(False)
+    _LaunchRequest(sock, command, reply_handler, error_handler)
+
+
+def read_status(sock):
+    """Read the wait status of a child launched by the zygote, or None
+    if the zygote exited without sending it.  Closes sock."""
+    try:
+        reply = _read_message(sock.makefile('r', 0))
+    except (socket.error, ZygoteError):
+        logging.exception('Could not read the status of the activity')
+        reply = None
+    finally:
+        sock.close()
+
+    if reply is None or 'status' not in reply:
+        return None
+    return reply['status']
+
+
+def _preload():
+    hidden = {}
+    for name in _DISPLAY_ENV:
+        if name in os.environ:
+            hidden[name] = os.environ.pop(name)
+
+    try:
+        try:
+            import gi
+        except ImportError:
+            logging.exception('Could not preload gi')
+        else:
+            for namespace, version in _PRELOAD_VERSIONS:
+                try:
+                    gi.require_version(namespace, version)
+                except ValueError:
+                    logging.exception('Could not preload %s', namespace)
+
+        # The children import whatever failed again, and report it
+        for name in _PRELOAD_MODULES:
+            try:
+                __import__(name)
+            except Exception:
+                logging.exception('Could not preload %s', name)
+    finally:
+        os.environ.update(hidden)
+
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class Zygote(object):
+    """Fork a child running main_cb for every request received on the
+    socket at path.  main_cb is called without arguments, with sys.argv
+    set to the command of the request.
+    """
+
+    def __init__(self, path, main_cb):
+        self._path = path
+        self._main_cb = main_cb
+        self._children = {}
+        self._server = None
+        self._wakeup_read = None
+        self._wakeup_write = None
+
+    def run(self):
+        _preload()
+
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            _set_cloexec(fd)
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, self.__sigchld_cb)
+
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _set_cloexec(self._server.fileno())
+        old_umask = os.umask(0077)
+        try:
+            self._server.bind(self._path)
+        finally:
+            os.umask(old_umask)
+        self._server.listen(16)
+
+        logging.debug('Zygote listening on %s', self._path)
+
+        try:
+            while True:
+                try:
+                    readable = select.select(
+                        [self._server, self._wakeup_read], [], [])[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if self._wakeup_read in readable:
+                    self._reap_children()
+                if self._server in readable:
+                    self._accept()
+        finally:
+            self._server.close()
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+    def __sigchld_cb(self, signum, frame):
+        try:
+            os.write(self._wakeup_write, '\0')
+        except OSError:
+            # The pipe is full, the children will be reaped anyway
+            pass
+
+    def _reap_children(self):
+        try:
+            while os.read(self._wakeup_read, 512):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+
+            conn = self._children.pop(pid, None)
+            if conn is None:
+                continue
+            try:
+                _write_message(conn, {'status': status})
+            except socket.error:
+                # The shell doesn't wait for the child anymore
+                pass
+            conn.close()
+
+    def _accept(self):
+        try:
+            conn = self._server.accept()[0]
+        except socket.error, e:
+            if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+        _set_cloexec(conn.fileno())
+
+        try:
+            conn.settimeout(_REQUEST_TIMEOUT)
+            request = _read_message(conn.makefile('r', 0))
+            if request is None:
+                conn.close()
+                return
+            pid = self._fork(request, conn)
+            conn.settimeout(None)
+            _write_message(conn, {'pid': pid})
+        except (socket.error, ZygoteError, KeyError, OSError):
+            logging.exception('Could not handle the zygote request')
+            conn.close()
+            return
+
+        self._children[pid] = conn
+
+    def _fork(self, request, conn):
+        command = [_to_str(s) for s in request['command']]
+        environ = dict((_to_str(key), _to_str(value))
+                       for key, value in request['environ'].items())
+        cwd = _to_str(request['cwd'])
+        log_path = _to_str(request['log_path'])
+
+        pid = os.fork()
+        if pid != 0:
+            return pid
+
+        status = 1
+        try:
+            self._setup_child(conn, command, environ, cwd, log_path)
+            status = self._run_child()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            # Never return to the loop of the zygote
+            os._exit(status)
+
+    def _setup_child(self, conn, command, environ, cwd, log_path):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self._server.close()
+        conn.close()
+        for other_conn in self._children.values():
+            other_conn.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+        dev_null = os.open('/dev/null', os.O_RDONLY)
+        os.dup2(dev_null, 0)
+        os.close(dev_null)
+
+        log_fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0644)
+        os.dup2(log_fd, 1)
+        os.dup2(log_fd, 2)
+        os.close(log_fd)
+
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(cwd)
+        sys.argv = command
+
+        # The random state is the same in all the children otherwise
+        random.seed()
+
+        from sugar3 import logger
+        logger.restart_startup_trace()
+        logger.mark_startup_event('zygote fork')
+
+    def _run_child(self):
+        import locale
+        from gi.repository import Gtk
+
+        try:
+            locale.setlocale(locale.LC_ALL, '')
+        except locale.Error:
+            pass
+
+        # The display was hidden when GTK was imported by the zygote
+        if not Gtk.init_check(sys.argv)[0]:
+            print >> sys.stderr, 'Cannot open the display'
+            return 1
+
+        try:
+            self._main_cb()
+        except SystemExit, e:
+            if e.code is None:
+                return 0
+            if isinstance(e.code, int):
+                return e.code
+            print >> sys.stderr, e.code
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        return 0
+
+
+def run(path, main_cb):
+    """Run a zygote listening on the socket at path, see Zygote"""
+    Zygote(path, main_cb).run()
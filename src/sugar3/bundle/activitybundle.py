@@ -86,6 +86,25 @@ def _expand_lang(locale):
     return ret
 
 
+def _get_languages():
+    # Using method from gettext.py, first find languages from environ
+    languages = []
+    for envar in ('LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG'):
+        val = os.environ.get(envar)
+        if val:
+            languages = val.split(':')
+            break
+
+    # Next, normalize and expand the languages
+    nelangs = []
+    for lang in languages:
+        for nelang in _expand_lang(lang):
+            if nelang not in nelangs:
+                nelangs.append(nelang)
+
+    return nelangs
+
+
 class ActivityBundle(Bundle):
     """A Sugar activity bundle
 
@@ -99,6 +118,14 @@ class ActivityBundle(Bundle):
     _unzipped_extension = '.activity'
     _infodir = 'activity'
 
+    # Attributes parsed from activity.info and activity.linfo, and the
+    # ones Bundle reads from the bundle itself, see get_metadata()
+    _METADATA_ATTRS = ('bundle_exec', '_name', '_icon', '_bundle_id',
+                       '_mime_types', '_show_launcher', '_tags',
+                       '_activity_version', '_summary', '_description',
+                       '_single_instance', '_max_participants',
+                       '_zip_root_dir', '_installation_time')
+
     def __init__(self, path, translated=True):
         Bundle.__init__(self, path)
         self.bundle_exec = None
@@ -212,23 +239,8 @@ class ActivityBundle(Bundle):
                     (self.get_path(), max_participants))
 
     def _get_linfo_file(self):
-        # Using method from gettext.py, first find languages from environ
-        languages = []
-        for envar in ('LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG'):
-            val = os.environ.get(envar)
-            if val:
-                languages = val.split(':')
-                break
-
-        # Next, normalize and expand the languages
-        nelangs = []
-        for lang in languages:
-            for nelang in _expand_lang(lang):
-                if nelang not in nelangs:
-                    nelangs.append(nelang)
-
-        # Finally, select a language
-        for lang in nelangs:
+        # Select the first language with a translation
+        for lang in _get_languages():
             linfo_path = os.path.join('locale', lang, 'activity.linfo')
             linfo_file = self.get_file(linfo_path)
             if linfo_file is not None:
@@ -254,6 +266,28 @@ class ActivityBundle(Bundle):
         except ParsingError as e:
             logging.exception('Exception reading linfo file: %s', e)
 
+    @classmethod
+    def from_metadata(cls, path, metadata):
+        """Create a bundle from metadata returned by get_metadata(),
+        without parsing the bundle files again.  Zipped bundles are only
+        opened when their files are accessed."""
+        bundle = cls.__new__(cls)
+        bundle._path = path
+        bundle._zipped = metadata['_zip_root_dir'] is not None
+        bundle._opened_zip_file = None
+        bundle._zip_index = None
+        for attr in cls._METADATA_ATTRS:
+            setattr(bundle, attr, metadata[attr])
+
+        _bundle_instances[path] = bundle
+        return bundle
+
+    def get_metadata(self):
+        """Get the parsed activity.info (and translated activity.linfo)
+        values, as a dictionary of plain values."""
+        return dict((attr, getattr(self, attr))
+                    for attr in self._METADATA_ATTRS)
+
     def get_locale_path(self):
         """Get the locale path inside the (installed) activity bundle."""
         if self._zip_file is not None:
@@ -333,10 +367,10 @@ class ActivityBundle(Bundle):
         """Get whether there should be a visible launcher for the activity"""
         return self._show_launcher
 
-    def install(self):
+    def install(self, progress_cb=None):
         install_dir = env.get_user_activities_path()
 
-        self._unzip(install_dir)
+        self._unzip(install_dir, progress_cb)
 
         install_path = os.path.join(install_dir, self._zip_root_dir)
         self.install_mime_type(install_path)
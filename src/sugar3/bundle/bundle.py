@@ -21,11 +21,19 @@ UNSTABLE.
 """
 
 import os
+import errno
+import stat
 import logging
 import shutil
 import StringIO
+import tempfile
+import threading
+import Queue
 import zipfile
 
+_EXTRACT_WORKERS = 4
+_EXTRACT_CHUNK_SIZE = 64 * 1024
+
 
 class AlreadyInstalledException(Exception):
     pass
@@ -51,6 +59,169 @@ class MalformedBundleException(Exception):
     pass
 
 
+class _ZipExtractor(object):
+    """Extracts zip members to a directory using a pool of threads, each
+    one reading the archive through its own ZipFile."""
+
+    def __init__(self, zip_path, members, dest_dir, progress_cb=None):
+        self._zip_path = zip_path
+        self._members = members
+        self._dest_dir = dest_dir
+        self._progress_cb = progress_cb
+        self._queue = Queue.Queue()
+        self._results = Queue.Queue()
+        self._stop = threading.Event()
+
+    def _get_mode(self, info):
+        return info.external_attr >> 16
+
+    def _worker(self):
+        try:
+            zip_file = zipfile.ZipFile(self._zip_path)
+        except Exception as e:
+            # extract() waits for a result, stop the other workers
+            self._results.put(e)
+            return
+
+        try:
+            while not self._stop.is_set():
+                try:
+                    info = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    self._extract_file(zip_file, info)
+                except Exception as e:
+                    self._results.put(e)
+                else:
+                    self._results.put(info.file_size)
+        finally:
+            zip_file.close()
+
+    def _extract_file(self, zip_file, info):
+        path = os.path.join(self._dest_dir, info.filename)
+        mode = self._get_mode(info)
+
+        if stat.S_ISLNK(mode):
+            os.symlink(zip_file.read(info), path)
+            return
+
+        # Never write through a link, nor over a file already extracted
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                     os.O_NOFOLLOW, 0644)
+        source = zip_file.open(info)
+        try:
+            with os.fdopen(fd, 'wb') as dest:
+                shutil.copyfileobj(source, dest, _EXTRACT_CHUNK_SIZE)
+        finally:
+            source.close()
+
+        if mode & 07777:
+            os.chmod(path, mode & 07777)
+
+    def extract(self):
+        files = []
+        dirs = []
+        for info in self._members:
+            if info.filename.endswith('/'):
+                dirs.append(info)
+            else:
+                files.append(info)
+
+        # Create the whole tree first, so that the workers don't race on it
+        dir_names = set(info.filename for info in dirs)
+        dir_names.update(os.path.dirname(info.filename) for info in files)
+        for dir_name in sorted(dir_names):
+            dir_path = os.path.join(self._dest_dir, dir_name)
+            if not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+
+        total = sum(info.file_size for info in files)
+        extracted = 0
+
+        for info in files:
+            self._queue.put(info)
+
+        threads = []
+        for i in range(min(_EXTRACT_WORKERS, len(files))):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        error = None
+        for i in range(len(files)):
+            result = self._results.get()
+            if isinstance(result, Exception):
+                error = result
+                self._stop.set()
+                break
+            extracted += result
+            if self._progress_cb is not None:
+                self._progress_cb(extracted, total)
+
+        for thread in threads:
+            thread.join()
+
+        if error is not None:
+            raise error
+
+        # The targets were checked by name, check where the links lead
+        # now that all of them exist
+        dest_dir = os.path.realpath(self._dest_dir)
+        for info in files:
+            if stat.S_ISLNK(self._get_mode(info)):
+                path = os.path.realpath(
+                    os.path.join(self._dest_dir, info.filename))
+                if not path.startswith(dest_dir + os.sep):
+                    raise ZipExtractException(
+                        'Link out of the bundle: %r' % info.filename)
+
+        # Directory permissions last, they could forbid writing the files
+        for info in dirs:
+            mode = self._get_mode(info) & 07777
+            if mode:
+                os.chmod(os.path.join(self._dest_dir, info.filename), mode)
+
+
+class _ZipIndex(object):
+    """Tree of the members of a zip file, built from its central directory.
+    Directories are dicts mapping names to their children, files are the
+    ZipInfo of the member."""
+
+    def __init__(self, infos):
+        self._root = {}
+        for info in infos:
+            parts = [part for part in info.filename.split('/') if part]
+            if not parts:
+                continue
+
+            node = self._root
+            for part in parts[:-1]:
+                child = node.setdefault(part, {})
+                if not isinstance(child, dict):
+                    # A file and a directory with the same name, the
+                    # directory wins
+                    child = node[part] = {}
+                node = child
+
+            if info.filename.endswith('/'):
+                node.setdefault(parts[-1], {})
+            elif not isinstance(node.get(parts[-1]), dict):
+                node[parts[-1]] = info
+
+    def lookup(self, path):
+        """Return the node at path, or None if there is none"""
+        node = self._root
+        for part in path.split('/'):
+            if part in ('', '.'):
+                continue
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+
 class Bundle(object):
     """A Sugar activity, content module, etc.
 
@@ -68,20 +239,29 @@ class Bundle(object):
     def __init__(self, path):
         self._path = path
         self._zip_root_dir = None
-        self._zip_file = None
+        self._zipped = not os.path.isdir(path)
+        self._opened_zip_file = None
+        self._zip_index = None
         self._installation_time = os.stat(path).st_mtime
 
-        if not os.path.isdir(self._path):
+        if self._zipped:
+            self._check_zip_bundle()
+
+    def __del__(self):
+        if self._opened_zip_file is not None:
+            self._opened_zip_file.close()
+
+    @property
+    def _zip_file(self):
+        """The ZipFile of a zipped bundle, opened on first use, or None
+        for bundles that are directories."""
+        if self._zipped and self._opened_zip_file is None:
             try:
-                self._zip_file = zipfile.ZipFile(self._path)
+                self._opened_zip_file = zipfile.ZipFile(self._path)
             except zipfile.error, exception:
                 raise MalformedBundleException('Error accessing zip file %r: '
                                                '%s' % (self._path, exception))
-            self._check_zip_bundle()
-
-    def __del__(self):
-        if self._zip_file is not None:
-            self._zip_file.close()
+        return self._opened_zip_file
 
     def _check_zip_bundle(self):
         file_names = self._zip_file.namelist()
@@ -130,29 +310,58 @@ class Bundle(object):
 
         return f
 
+    def _lookup_zip_member(self, filename):
+        if self._zip_index is None:
+            self._zip_index = _ZipIndex(self._zip_file.infolist())
+        return self._zip_index.lookup(
+            os.path.join(self._zip_root_dir, filename))
+
+    def open_file(self, filename):
+        """Open a file of the bundle for reading.  Unlike get_file(), the
+        contents of zipped bundles are decompressed as they are read.
+
+        Returns a file-like object, or None if there is no such file.
+        """
+        if self._zip_file is None:
+            path = os.path.join(self._path, filename)
+            try:
+                return open(path, 'rb')
+            except IOError:
+                logging.debug("cannot open path %s" % path)
+                return None
+        else:
+            info = self._lookup_zip_member(filename)
+            if info is None or isinstance(info, dict):
+                logging.debug('%s not found in zip %s.' %
+                              (filename, self._path))
+                return None
+            return self._zip_file.open(info)
+
     def is_file(self, filename):
         if self._zip_file is None:
             path = os.path.join(self._path, filename)
             return os.path.isfile(path)
         else:
-            path = os.path.join(self._zip_root_dir, filename)
-            try:
-                self._zip_file.getinfo(path)
-            except KeyError:
-                return False
-
-            return True
+            info = self._lookup_zip_member(filename)
+            return info is not None and not isinstance(info, dict)
 
     def is_dir(self, filename):
         if self._zip_file is None:
             path = os.path.join(self._path, filename)
             return os.path.isdir(path)
         else:
-            path = os.path.join(self._zip_root_dir, filename, "")
-            for f in self._zip_file.namelist():
-                if f.startswith(path):
-                    return True
-            return False
+            return isinstance(self._lookup_zip_member(filename), dict)
+
+    def listdir(self, filename):
+        """List the names of the entries of a directory of the bundle."""
+        if self._zip_file is None:
+            return os.listdir(os.path.join(self._path, filename))
+        else:
+            node = self._lookup_zip_member(filename)
+            if not isinstance(node, dict):
+                raise OSError(errno.ENOTDIR, 'Not a directory in bundle',
+                              filename)
+            return node.keys()
 
     def get_path(self):
         """Get the bundle path."""
@@ -166,24 +375,76 @@ class Bundle(object):
     def get_show_launcher(self):
         return True
 
-    def _unzip(self, install_dir):
+    def _check_member_path(self, file_name):
+        path = os.path.normpath(file_name)
+        if os.path.isabs(path) or path == '..' or \
+                path.startswith('..' + os.sep) or \
+                path.split(os.sep)[0] != self._zip_root_dir:
+            raise ZipExtractException('Invalid path in bundle: %r' %
+                                      file_name)
+
+    def _check_link_target(self, info):
+        target = self._zip_file.read(info)
+        path = os.path.normpath(os.path.join(os.path.dirname(info.filename),
+                                             target))
+        if os.path.isabs(target) or \
+                path.split(os.sep)[0] != self._zip_root_dir:
+            raise ZipExtractException('Invalid link in bundle: %r -> %r' %
+                                      (info.filename, target))
+
+    def _unzip(self, install_dir, progress_cb=None):
+        """Extract the bundle into install_dir.  The files are extracted
+        to a temporary directory first, and moved in place on success.
+
+        An installed copy of the bundle is replaced as a whole, not merged
+        with: files which are only in the previous version are removed,
+        and a failed extraction keeps the previous version untouched.  The
+        data of activities is kept in their profile directory, not here.
+
+        progress_cb -- will be called with the number of bytes extracted
+                       and the total number of bytes (default None)
+        """
         if self._zip_file is None:
             raise AlreadyInstalledException
 
         if not os.path.isdir(install_dir):
             os.mkdir(install_dir, 0775)
 
-        # zipfile provides API that in theory would let us do this
-        # correctly by hand, but handling all the oddities of
-        # Windows/UNIX mappings, extension attributes, deprecated
-        # features, etc makes it impractical.
-        if os.spawnlp(os.P_WAIT, 'unzip', 'unzip', '-o', self._path,
-                      '-x', 'mimetype', '-d', install_dir):
-            # clean up install dir after failure
-            shutil.rmtree(os.path.join(install_dir, self._zip_root_dir),
-                          ignore_errors=True)
-            # indicate failure.
-            raise ZipExtractException
+        members = [info for info in self._zip_file.infolist()
+                   if info.filename != 'mimetype']
+        names = set()
+        for info in members:
+            self._check_member_path(info.filename)
+            name = os.path.normpath(info.filename)
+            if name in names:
+                raise ZipExtractException('Duplicate path in bundle: %r' %
+                                          info.filename)
+            names.add(name)
+            if stat.S_ISLNK(info.external_attr >> 16):
+                self._check_link_target(info)
+
+        temp_dir = tempfile.mkdtemp(prefix='.extract-', dir=install_dir)
+        try:
+            extractor = _ZipExtractor(self._path, members, temp_dir,
+                                      progress_cb)
+            extractor.extract()
+
+            install_path = os.path.join(install_dir, self._zip_root_dir)
+            old_path = os.path.join(temp_dir, '.old')
+            if os.path.lexists(install_path):
+                os.rename(install_path, old_path)
+            try:
+                os.rename(os.path.join(temp_dir, self._zip_root_dir),
+                          install_path)
+            except OSError:
+                if os.path.lexists(old_path):
+                    os.rename(old_path, install_path)
+                raise
+        except Exception as e:
+            logging.exception('Error extracting %s', self._path)
+            raise ZipExtractException(e)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
     def _zip(self, bundle_path):
         if self._zip_file is not None:
@@ -0,0 +1,175 @@
+# Copyright (C) 2016 Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Persistent index of activity bundle metadata
+
+Parsing the activity.info and activity.linfo files of every installed
+activity means opening hundreds of files.  The index keeps the parsed
+metadata of each bundle in a single file in the profile, so that all of
+it can be loaded with one read.  An entry is parsed again only when the
+bundle changes on disk, or when the user language changes.
+
+UNSTABLE.
+"""
+
+import os
+import logging
+import marshal
+import tempfile
+
+from sugar3 import env
+from sugar3.bundle.activitybundle import ActivityBundle, _get_languages
+from sugar3.bundle.bundle import MalformedBundleException
+
+_INDEX_VERSION = 2
+
+
+def _get_stamp(path, languages):
+    """Identify the state on disk of the bundle, changes whenever the bundle
+    is replaced or its activity.info file, or the activity.linfo file
+    used for languages, is modified."""
+    stat = os.stat(path)
+    if not os.path.isdir(path):
+        return (stat.st_mtime, stat.st_size)
+
+    info_path = os.path.join(path, 'activity', 'activity.info')
+    stamp = (stat.st_mtime, os.stat(info_path).st_mtime)
+
+    # Like ActivityBundle, use the first language with a translation
+    for lang in languages:
+        linfo_path = os.path.join(path, 'locale', lang, 'activity.linfo')
+        try:
+            return stamp + (lang, os.stat(linfo_path).st_mtime)
+        except OSError:
+            pass
+    return stamp
+
+
+class BundleIndex(object):
+    """Index of the metadata of activity bundles, keyed by bundle path.
+
+    Keyword arguments:
+    path -- the index file (default 'bundle-index' in the profile)
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = env.get_profile_path('bundle-index')
+        self._path = path
+        self._entries = {}
+        self._dirty = False
+        self._loaded = False
+
+    def load(self):
+        """Read the whole index from disk, dropping it if unreadable"""
+        self._loaded = True
+        self._entries = {}
+
+        try:
+            with open(self._path, 'rb') as index_file:
+                version, entries = marshal.load(index_file)
+        except (IOError, EOFError, ValueError, TypeError) as e:
+            if os.path.exists(self._path):
+                logging.warning('Discarding bundle index %s: %s',
+                                self._path, e)
+            return
+
+        if version == _INDEX_VERSION:
+            self._entries = entries
+
+    def save(self):
+        """Write the index to disk, if it has been modified"""
+        if not self._dirty:
+            return
+
+        dir_path = os.path.dirname(self._path)
+        fd, temp_path = tempfile.mkstemp(dir=dir_path)
+        try:
+            with os.fdopen(fd, 'wb') as index_file:
+                marshal.dump((_INDEX_VERSION, self._entries), index_file)
+            os.rename(temp_path, self._path)
+        except (IOError, OSError):
+            logging.exception('Could not write bundle index %s', self._path)
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            return
+
+        self._dirty = False
+
+    def get_bundle(self, path, translated=True):
+        """Get the ActivityBundle at path, from the index if the entry is
+        still valid, parsing the bundle and updating the entry otherwise.
+
+        Raises MalformedBundleException if the bundle can't be parsed.
+        """
+        if not self._loaded:
+            self.load()
+
+        languages = _get_languages() if translated else []
+        try:
+            stamp = _get_stamp(path, languages)
+        except OSError as e:
+            raise MalformedBundleException('Cannot access bundle %s: %s' %
+                                           (path, e))
+
+        key = (stamp, languages)
+
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == key:
+            return ActivityBundle.from_metadata(path, entry[1])
+
+        bundle = ActivityBundle(path, translated=translated)
+        self._entries[path] = (key, bundle.get_metadata())
+        self._dirty = True
+        return bundle
+
+    def get_bundles(self, paths, translated=True):
+        """Get the ActivityBundles at paths, see get_bundle().  Malformed
+        bundles are logged and skipped.  Entries of bundles not in paths
+        are removed from the index.
+        """
+        if not self._loaded:
+            self.load()
+
+        bundles = []
+        for path in paths:
+            try:
+                bundles.append(self.get_bundle(path, translated))
+            except MalformedBundleException:
+                logging.exception('Skipping malformed bundle %s', path)
+                self.remove(path)
+
+        for path in set(self._entries) - set(paths):
+            self.remove(path)
+
+        return bundles
+
+    def remove(self, path):
+        """Remove the entry of the bundle at path"""
+        if path in self._entries:
+            del self._entries[path]
+            self._dirty = True
+
+
+def load_bundles(paths, translated=True):
+    """Get the ActivityBundles at paths using the index in the profile,
+    and save it back if any entry changed.
+    """
+    index = BundleIndex()
+    bundles = index.get_bundles(paths, translated)
+    index.save()
+    return bundles
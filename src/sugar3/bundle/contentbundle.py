@@ -153,9 +153,9 @@ class ContentBundle(Bundle):
     def get_tags(self):
         return None
 
-    def install(self):
+    def install(self, progress_cb=None):
         install_path = env.get_user_library_path()
-        self._unzip(install_path)
+        self._unzip(install_path, progress_cb)
         return os.path.join(install_path, self._zip_root_dir)
 
     def uninstall(self, force=False, delete_profile=False):
@@ -23,9 +23,12 @@ STABLE
 import logging
 import time
 from datetime import datetime
+from functools import partial
 import os
 import tempfile
+import threading
 from gi.repository import GObject
+from gi.repository import GLib
 from gi.repository import Gio
 import dbus
 
@@ -33,6 +36,7 @@ from sugar3 import env
 from sugar3 import mime
 from sugar3 import dispatch
 from sugar3.profile import get_color
+from sugar3.util import LRU
 
 DS_DBUS_SERVICE = 'org.laptop.sugar.DataStore'
 DS_DBUS_INTERFACE = 'org.laptop.sugar.DataStore'
@@ -40,6 +44,13 @@ DS_DBUS_PATH = '/org/laptop/sugar/DataStore'
 
 _data_store = None
 
+# Properties of recently used entries, kept up to date by the datastore
+# signals.  Large values, like the previews, are left out and fetched
+# again when used, see DSMetadata.
+_METADATA_CACHE_SIZE = 100
+_METADATA_CACHE_MAX_VALUE = 1024
+_metadata_cache = LRU(_METADATA_CACHE_SIZE)
+
 
 def _get_data_store():
     global _data_store
@@ -58,17 +69,55 @@ def _get_data_store():
 
 def __datastore_created_cb(object_id):
     metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
+    _cache_metadata(object_id, metadata)
     updated.send(None, object_id=object_id, metadata=metadata)
 
 
 def __datastore_updated_cb(object_id):
     metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
+    _cache_metadata(object_id, metadata)
     updated.send(None, object_id=object_id, metadata=metadata)
 
 
 def __datastore_deleted_cb(object_id):
+    _invalidate_metadata(object_id)
     deleted.send(None, object_id=object_id)
 
+
+def _invalidate_metadata(object_id):
+    if object_id in _metadata_cache:
+        del _metadata_cache[object_id]
+
+
+def _cache_metadata(object_id, metadata):
+    properties = {}
+    omitted = []
+    for key, value in metadata.items():
+        if isinstance(value, basestring) and \
+                len(value) > _METADATA_CACHE_MAX_VALUE:
+            omitted.append(key)
+        else:
+            properties[key] = value
+    _metadata_cache[object_id] = properties, frozenset(omitted)
+
+
+def _get_cached_metadata(object_id):
+    properties, omitted = _metadata_cache[object_id]
+    metadata = DSMetadata(dict(properties))
+    if omitted:
+        metadata._omit(object_id, omitted)
+    return metadata
+
+
+def _get_metadata(object_id, use_cache):
+    if use_cache and object_id in _metadata_cache:
+        return _get_cached_metadata(object_id)
+
+    metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
+    if use_cache:
+        _cache_metadata(object_id, metadata)
+    return DSMetadata(dict(metadata))
+
 created = dispatch.Signal()
 deleted = dispatch.Signal()
 updated = dispatch.Signal()
@@ -87,42 +136,79 @@ class DSMetadata(GObject.GObject):
         else:
             self._properties = properties
 
+        # Keys left out by the metadata cache, fetched when first used
+        self._object_id = None
+        self._omitted = frozenset()
+
         default_keys = ['activity', 'activity_id',
                         'mime_type', 'title_set_by_user']
         for key in default_keys:
             if key not in self._properties:
                 self._properties[key] = ''
 
+    def _omit(self, object_id, keys):
+        self._object_id = object_id
+        self._omitted = keys
+
+    def _load_omitted(self):
+        if not self._omitted:
+            return
+
+        omitted = self._omitted
+        self._omitted = frozenset()
+        try:
+            properties = _get_data_store().get_properties(self._object_id,
+                                                          byte_arrays=True)
+        except dbus.DBusException, e:
+            logging.warning('Could not get the properties of %s: %s',
+                            self._object_id, e)
+            return
+
+        for key in omitted:
+            if key in properties:
+                self._properties[key] = properties[key]
+
     def __getitem__(self, key):
+        if key in self._omitted:
+            self._load_omitted()
         return self._properties[key]
 
     def __setitem__(self, key, value):
+        if key in self._omitted:
+            self._omitted = self._omitted - set([key])
         if key not in self._properties or self._properties[key] != value:
             self._properties[key] = value
             self.emit('updated')
 
     def __delitem__(self, key):
+        if key in self._omitted:
+            self._omitted = self._omitted - set([key])
+            if key not in self._properties:
+                return
         del self._properties[key]
 
     def __contains__(self, key):
-        return self._properties.__contains__(key)
+        return key in self._omitted or key in self._properties
 
     def has_key(self, key):
         logging.warning(".has_key() is deprecated, use 'in'")
-        return key in self._properties
+        return key in self
 
     def keys(self):
+        self._load_omitted()
         return self._properties.keys()
 
     def get_dictionary(self):
+        self._load_omitted()
         return self._properties
 
     def copy(self):
+        self._load_omitted()
         return DSMetadata(self._properties.copy())
 
     def get(self, key, default=None):
-        if key in self._properties:
-            return self._properties[key]
+        if key in self:
+            return self[key]
         else:
             return default
 
@@ -138,6 +224,8 @@ class DSObject(object):
     def __init__(self, object_id, metadata=None, file_path=None):
         self._update_signal_match = None
         self._object_id = None
+        # Writes waiting for an asynchronous create to return the object id
+        self._pending_writes = None
 
         self.set_object_id(object_id)
 
@@ -157,6 +245,7 @@ class DSObject(object):
                 'Updated', self.__object_updated_cb, arg0=object_id)
 
         self._object_id = object_id
+        self._pending_writes = None
 
     object_id = property(get_object_id, set_object_id)
 
@@ -276,11 +365,14 @@ class RawObject(object):
             self.destroy()
 
 
-def get(object_id):
+def get(object_id, use_cache=True):
     """Get the properties of the object with the ID given.
 
     Keyword arguments:
     object_id -- unique identifier of the object
+    use_cache -- if the properties can be taken from the in-process
+                 cache, which is kept up to date by the datastore signals
+                 (default True)
 
     Return: a DSObject
 
@@ -290,10 +382,9 @@ def get(object_id):
     if object_id.startswith('/'):
         return RawObject(object_id)
 
-    metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
+    metadata = _get_metadata(object_id, use_cache)
 
-    ds_object = DSObject(object_id, DSMetadata(metadata), None)
-    # TODO: register the object for updates
+    ds_object = DSObject(object_id, metadata, None)
     return ds_object
 
 
@@ -316,6 +407,7 @@ def _update_ds_entry(uid, properties, filename, transfer_ownership=False,
         debug_properties['preview'] = '<omitted>'
     logging.debug('dbus_helpers.update: %s, %s, %s, %s', uid, filename,
                   debug_properties, transfer_ownership)
+    _invalidate_metadata(uid)
     if reply_handler and error_handler:
         _get_data_store().update(uid, dbus.Dictionary(properties), filename,
                                  transfer_ownership,
@@ -333,11 +425,53 @@ def _create_ds_entry(properties, filename, transfer_ownership=False):
     return object_id
 
 
+def _create_ds_entry_async(ds_object, properties, filename,
+                           transfer_ownership, reply_handler, error_handler,
+                           timeout):
+    # Writes to ds_object issued before the object id is known are queued
+    # here, and sent as updates once the create returns.
+    pending_writes = []
+    ds_object._pending_writes = pending_writes
+
+    def reply_cb(object_id):
+        if ds_object._pending_writes is pending_writes:
+            ds_object.object_id = object_id
+            ds_object.metadata['uid'] = object_id
+        logging.debug('Created object %s in the datastore.', object_id)
+        created.send(None, object_id=object_id)
+        if reply_handler is not None:
+            reply_handler()
+        for args in pending_writes:
+            _update_ds_entry(object_id, *args)
+
+    def error_cb(error):
+        if ds_object._pending_writes is pending_writes:
+            ds_object._pending_writes = None
+        logging.error('Could not create datastore entry: %s', error)
+        for callback in [error_handler] + \
+                [args[4] for args in pending_writes]:
+            if callback is not None:
+                callback(error)
+
+    _get_data_store().create(dbus.Dictionary(properties), filename,
+                             transfer_ownership,
+                             reply_handler=reply_cb,
+                             error_handler=error_cb,
+                             timeout=timeout)
+
+
 def write(ds_object, update_mtime=True, transfer_ownership=False,
           reply_handler=None, error_handler=None, timeout=-1):
     """Write the DSObject given to the datastore. Creates a new entry if
     the entry does not exist yet.
 
+    If handlers are given, the call is asynchronous for creates too: the
+    object id is set on the DSObject, the created signal is sent and then
+    reply_handler is called once the datastore replies.  Asynchronous
+    writes to the same DSObject issued in the meantime are queued and sent
+    as updates when the object id is known, synchronous ones wait for the
+    reply by iterating the main loop, see iter_find().
+
     Keyword arguments:
     update_mtime -- boolean if the mtime of the entry should be regenerated
                     (default True)
@@ -363,8 +497,19 @@ def write(ds_object, update_mtime=True, transfer_ownership=False,
     if file_path is None:
         file_path = ''
 
-    # FIXME: this func will be sync for creates regardless of the handlers
-    # supplied. This is very bad API, need to decide what to do here.
+    if ds_object._pending_writes is not None:
+        if reply_handler or error_handler:
+            logging.debug('Queueing write until the object is created.')
+            ds_object._pending_writes.append((properties, file_path,
+                                              transfer_ownership,
+                                              reply_handler, error_handler,
+                                              timeout))
+            return
+
+        # The caller expects the object id to be known on return
+        logging.debug('Waiting for the object to be created.')
+        _wait_until(lambda: ds_object._pending_writes is None)
+
     if ds_object.object_id:
         _update_ds_entry(ds_object.object_id,
                          properties,
@@ -373,14 +518,15 @@ def write(ds_object, update_mtime=True, transfer_ownership=False,
                          reply_handler=reply_handler,
                          error_handler=error_handler,
                          timeout=timeout)
+    elif reply_handler or error_handler:
+        _create_ds_entry_async(ds_object, properties, file_path,
+                               transfer_ownership, reply_handler,
+                               error_handler, timeout)
+        return
     else:
-        if reply_handler or error_handler:
-            logging.warning('datastore.write() cannot currently be called'
-                            'async for creates, see ticket 3071')
         ds_object.object_id = _create_ds_entry(properties, file_path,
                                                transfer_ownership)
         ds_object.metadata['uid'] = ds_object.object_id
-        # TODO: register the object for updates
     logging.debug('Written object %s to the datastore.', ds_object.object_id)
 
 
@@ -392,6 +538,7 @@ def delete(object_id):
 
     """
     logging.debug('datastore.delete')
+    _invalidate_metadata(object_id)
     _get_data_store().delete(object_id)
 
 
@@ -452,15 +599,297 @@ def find(query, sorting=None, limit=None, offset=None, properties=None,
     else:
         entries, total_count = _get_data_store().find(query, properties,
                                                       byte_arrays=True)
-    ds_objects = []
-    for entry in entries:
-        object_id = entry['uid']
-        del entry['uid']
 
-        ds_object = DSObject(object_id, DSMetadata(entry), None)
-        ds_objects.append(ds_object)
+    return _get_ds_objects(entries, properties), total_count
+
+
+_waiting = False
+
+
+def _wait_until(is_done):
+    # The replies are dispatched by the default main context, which only
+    # the main thread iterates.  The handlers run meanwhile could wait in
+    # turn, or resume the caller, which would then run nested in itself.
+    global _waiting
+
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        raise RuntimeError('The datastore can only be waited for in the '
+                           'main thread')
+    if _waiting:
+        raise RuntimeError('The datastore is already being waited for')
+
+    _waiting = True
+    try:
+        context = GLib.MainContext.default()
+        while not is_done():
+            context.iteration(True)
+    finally:
+        _waiting = False
+
+
+def _get_ds_object(entry, properties):
+    object_id = entry['uid']
+    if not properties:
+        # All the properties have been returned, cache them
+        _cache_metadata(object_id, entry)
+    del entry['uid']
+
+    return DSObject(object_id, DSMetadata(entry), None)
+
+
+def _get_ds_objects(entries, properties):
+    return [_get_ds_object(entry, properties) for entry in entries]
+
+
+class _FindRequest(object):
+    """An asynchronous find call for one page of results."""
+
+    def __init__(self, query, properties):
+        self._done = False
+        self._result = None
+        self._error = None
+
+        _get_data_store().find(query, properties,
+                               reply_handler=self.__reply_cb,
+                               error_handler=self.__error_cb,
+                               byte_arrays=True)
+
+    def __reply_cb(self, entries, total_count):
+        self._result = (entries, total_count)
+        self._done = True
+
+    def __error_cb(self, error):
+        self._error = error
+        self._done = True
+
+    def wait(self):
+        """Return the entries and total count, iterating the main loop
+        until the reply arrives if needed."""
+        _wait_until(lambda: self._done)
+
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def iter_find(query, sorting=None, page_size=100, properties=None):
+    """Iterate over the DS entries that match the query provided, fetching
+    them a page at a time.  The next page is requested asynchronously while
+    the current one is being consumed, and no more pages are requested once
+    the caller stops iterating.
+
+    The iterator must be used from the main thread: when a page hasn't
+    arrived yet, the main loop is iterated until it does.  The handlers
+    called meanwhile must not use the iterator, nor wait for the datastore
+    in turn, which raises RuntimeError.
+
+    Keyword arguments:
+    query -- a dictionary containing metadata key value pairs, see find()
+             (the limit and offset keys are managed by the iterator)
+    sorting -- key to order results by e.g. 'timestamp' (default None)
+    page_size -- number of entries fetched by each call (default 100)
+    properties -- you can specify here a list of metadata you want to be
+                  present in the result e.g. ['title, 'keep'] (default None)
+
+    Return: an iterator of DSObjects matching the query
+
+    """
+    query = query.copy()
+
+    if properties is None:
+        properties = []
+
+    if sorting:
+        query['order_by'] = sorting
+    query['limit'] = page_size
+
+    offset = query.pop('offset', 0)
+    query['offset'] = offset
+    request = _FindRequest(query.copy(), properties)
+
+    while request is not None:
+        entries, total_count = request.wait()
+        offset += len(entries)
+
+        if len(entries) == page_size and offset < total_count:
+            query['offset'] = offset
+            request = _FindRequest(query.copy(), properties)
+        else:
+            request = None
+
+        # One at a time, the caller destroys the objects it gets
+        for entry in entries:
+            yield _get_ds_object(entry, properties)
+
+
+class _BatchOperation(object):
+    """Runs an asynchronous datastore call for each item of a list, with
+    a bounded number of calls in flight, and collects the results."""
+
+    def __init__(self, items, start_call, max_in_flight, progress_handler,
+                 reply_handler):
+        self._items = list(items)
+        self._start_call = start_call
+        self._max_in_flight = max(max_in_flight, 1)
+        self._progress_handler = progress_handler
+        self._reply_handler = reply_handler
+
+        self._results = [None] * len(self._items)
+        self._errors = []
+        self._next_index = 0
+        self._in_flight = 0
+        self._completed = 0
+        self._starting = False
+
+    def start(self):
+        if not self._items:
+            self._finish()
+        else:
+            self._start_calls()
+
+    def _start_calls(self):
+        # Calls can complete synchronously, don't recurse in that case
+        if self._starting:
+            return
+
+        self._starting = True
+        while self._in_flight < self._max_in_flight and \
+                self._next_index < len(self._items):
+            index = self._next_index
+            self._next_index += 1
+            self._in_flight += 1
+            try:
+                self._start_call(self._items[index],
+                                 partial(self.__reply_cb, index),
+                                 partial(self.__error_cb, index))
+            except Exception as e:
+                self.__error_cb(index, e)
+        self._starting = False
+
+    def __reply_cb(self, index, result=None):
+        self._results[index] = result
+        self._call_done()
+
+    def __error_cb(self, index, error):
+        logging.error('Datastore batch call failed for %r: %s',
+                      self._items[index], error)
+        self._errors.append((self._items[index], error))
+        self._call_done()
+
+    def _call_done(self):
+        self._in_flight -= 1
+        self._completed += 1
+        if self._progress_handler is not None:
+            self._progress_handler(self._completed, len(self._items))
+
+        if self._completed == len(self._items):
+            self._finish()
+        else:
+            self._start_calls()
+
+    def _finish(self):
+        self._completed = len(self._items)
+        if self._reply_handler is not None:
+            self._reply_handler(self._results, self._errors)
+
+    def is_done(self):
+        return self._completed == len(self._items)
+
+    def wait(self):
+        _wait_until(self.is_done)
+        return self._results, self._errors
+
+
+def _run_batch(items, start_call, max_in_flight, progress_handler,
+               reply_handler):
+    operation = _BatchOperation(items, start_call, max_in_flight,
+                                progress_handler, reply_handler)
+    operation.start()
+    if reply_handler is None:
+        return operation.wait()
+
+
+def write_many(ds_objects, update_mtime=True, transfer_ownership=False,
+               max_in_flight=8, progress_handler=None, reply_handler=None):
+    """Write several DSObjects to the datastore, with up to max_in_flight
+    asynchronous calls pending at a time.
+
+    Keyword arguments:
+    update_mtime -- see write() (default True)
+    transfer_ownership -- see write() (default False)
+    max_in_flight -- maximum number of pending calls (default 8)
+    progress_handler -- will be called with the number of completed calls
+                        and the total number of calls (default None)
+    reply_handler -- will be called with the results and errors when all
+                     the calls are completed; if None, write_many() waits
+                     for them and returns the results and errors, which
+                     is only possible in the main thread and outside of
+                     other waits, see iter_find() (default None)
+
+    The results are the object ids of the written DSObjects, in order, or
+    None for the failed ones.  The errors are a list of (DSObject, error)
+    tuples.
+
+    """
+    def start_call(ds_object, reply_cb, error_cb):
+        write(ds_object, update_mtime, transfer_ownership,
+              reply_handler=lambda: reply_cb(ds_object.object_id),
+              error_handler=error_cb)
+
+    return _run_batch(ds_objects, start_call, max_in_flight,
+                      progress_handler, reply_handler)
+
+
+def delete_many(object_ids, max_in_flight=8, progress_handler=None,
+                reply_handler=None):
+    """Delete several datastore entries, with up to max_in_flight
+    asynchronous calls pending at a time.
+
+    See write_many() for the keyword arguments.  The results are all None,
+    the errors are a list of (object id, error) tuples.
+
+    """
+    def start_call(object_id, reply_cb, error_cb):
+        _invalidate_metadata(object_id)
+        _get_data_store().delete(object_id,
+                                 reply_handler=reply_cb,
+                                 error_handler=error_cb)
+
+    return _run_batch(object_ids, start_call, max_in_flight,
+                      progress_handler, reply_handler)
+
+
+def get_many(object_ids, use_cache=True, max_in_flight=8,
+             progress_handler=None, reply_handler=None):
+    """Get several DSObjects, with up to max_in_flight asynchronous calls
+    pending at a time.
+
+    See get() for use_cache and write_many() for the other keyword
+    arguments.  The results are the DSObjects, in order, or None for the
+    failed ones.  The errors are a list of (object id, error) tuples.
+
+    """
+    def start_call(object_id, reply_cb, error_cb):
+        if object_id.startswith('/'):
+            reply_cb(RawObject(object_id))
+            return
+
+        if use_cache and object_id in _metadata_cache:
+            reply_cb(DSObject(object_id, _get_cached_metadata(object_id),
+                              None))
+            return
+
+        def properties_cb(metadata):
+            if use_cache:
+                _cache_metadata(object_id, metadata)
+            reply_cb(DSObject(object_id, DSMetadata(dict(metadata)), None))
+
+        _get_data_store().get_properties(object_id, byte_arrays=True,
+                                         reply_handler=properties_cb,
+                                         error_handler=error_cb)
 
-    return ds_objects, total_count
+    return _run_batch(object_ids, start_call, max_in_flight,
+                      progress_handler, reply_handler)
 
 
 def copy(ds_object, mount_point):
@@ -89,8 +89,16 @@ and 85.0% on the Y axis.
 
 import re
 import math
+import mmap
+import struct
+import hashlib
 import logging
 import os
+import shutil
+import tempfile
+import threading
+import Queue
+from collections import OrderedDict
 from ConfigParser import ConfigParser
 
 import gi
@@ -102,38 +110,597 @@ from gi.repository import GdkPixbuf
 from gi.repository import Rsvg
 import cairo
 
+from sugar3 import env
 from sugar3.graphics import style
 from sugar3.graphics.xocolor import XoColor
-from sugar3.util import LRU
+from sugar3.util import TempFilePath
 
 _BADGE_SIZE = 0.45
 
+# Bump whenever the rendering code changes in a way that alters the pixels
+# stored in the on-disk surface cache.
+_SURFACE_CACHE_VERSION = 1
+_SURFACE_CACHE_MAGIC = 'SGIC'
+_SURFACE_CACHE_TRAILER = struct.Struct('<4sIiiii')
+_SURFACE_DISK_CACHE_BUDGET = 16 * 1024 * 1024
 
-class _SVGLoader(object):
 
-    def __init__(self):
-        self._cache = LRU(50)
+class _SurfaceDiskCache(object):
+    '''
+    Cache of rendered icon surfaces shared by all the activity processes.
 
-    def load(self, file_name, entities, cache):
-        if file_name in self._cache:
-            icon = self._cache[file_name]
+    Every entry is the raw ARGB32 (or RGB24) pixel data of a surface followed
+    by a small trailer describing its geometry.  Entries are memory-mapped
+    when loaded, so the pages are shared between processes until written.
+
+    When the entries grow over the budget, the least recently used ones
+    are removed, down to three quarters of the budget.
+    '''
+
+    def __init__(self, path, budget=_SURFACE_DISK_CACHE_BUDGET):
+        self._path = path
+        self._budget = budget
+        # Bytes on disk, counted on the first write
+        self._size = None
+        self._enabled = True
+
+    def _get_entry_path(self, key):
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self._path, digest[:2], digest[2:])
+
+    def _disable(self, reason):
+        logging.warning('Disabling icon surface disk cache: %s', reason)
+        self._enabled = False
+
+    def load(self, key):
+        if not self._enabled:
+            return None
+
+        path = self._get_entry_path(key)
+        try:
+            with open(path, 'rb') as entry_file:
+                data = mmap.mmap(entry_file.fileno(), 0,
+                                 access=mmap.ACCESS_COPY)
+        except (IOError, OSError, ValueError, mmap.error):
+            return None
+
+        try:
+            # The modification time tells the least recently used entries
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        trailer_size = _SURFACE_CACHE_TRAILER.size
+        if len(data) < trailer_size:
+            return None
+
+        magic, version, format_, width, height, stride = \
+            _SURFACE_CACHE_TRAILER.unpack(data[-trailer_size:])
+        if magic != _SURFACE_CACHE_MAGIC or \
+                version != _SURFACE_CACHE_VERSION or \
+                len(data) - trailer_size != stride * height:
+            return None
+
+        try:
+            return cairo.ImageSurface.create_for_data(
+                data, format_, width, height, stride)
+        except Exception as e:
+            logging.warning('Invalid icon cache entry %s: %s', path, e)
+            return None
+
+    def save(self, key, surface):
+        if not self._enabled:
+            return
+
+        surface.flush()
+        trailer = _SURFACE_CACHE_TRAILER.pack(
+            _SURFACE_CACHE_MAGIC, _SURFACE_CACHE_VERSION,
+            surface.get_format(), surface.get_width(), surface.get_height(),
+            surface.get_stride())
+
+        path = self._get_entry_path(key)
+        dir_path = os.path.dirname(path)
+        try:
+            if not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+            fd, temp_path = tempfile.mkstemp(prefix='.', dir=dir_path)
+        except OSError as e:
+            self._disable(e)
+            return
+
+        try:
+            with os.fdopen(fd, 'wb') as entry_file:
+                entry_file.write(surface.get_data())
+                entry_file.write(trailer)
+            # The rename is atomic, concurrent readers never see a
+            # partially written entry.
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            logging.warning('Could not write icon cache entry %s: %s',
+                            path, e)
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return
+
+        if self._size is None:
+            self._size = sum(size for path_, size, mtime_ in
+                             self._get_entries())
         else:
-            icon_file = open(file_name, 'r')
-            icon = icon_file.read()
-            icon_file.close()
+            self._size += len(surface.get_data()) + len(trailer)
+        if self._size > self._budget:
+            self.prune()
+
+    def _get_entries(self):
+        entries = []
+        for dir_path, dir_names_, file_names in os.walk(self._path):
+            for file_name in file_names:
+                if file_name.startswith('.'):
+                    # Being written
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    entry_stat = os.stat(path)
+                except OSError:
+                    # Removed by another process meanwhile
+                    continue
+                entries.append((path, entry_stat.st_size,
+                                entry_stat.st_mtime))
+        return entries
+
+    def prune(self):
+        '''
+        Remove the least recently used entries, until the cache fits in
+        three quarters of its budget.
+        '''
+        entries = self._get_entries()
+        entries.sort(key=lambda entry: entry[2])
+
+        size = sum(entry[1] for entry in entries)
+        for path, entry_size, mtime_ in entries:
+            if size <= self._budget * 3 / 4:
+                break
+            try:
+                # Processes which mapped the entry keep their copy
+                os.unlink(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+        self._size = size
+
 
-            if cache:
-                self._cache[file_name] = icon
+def _remove_old_disk_caches(path):
+    # The caches of the previous versions of the rendering code are never
+    # used again
+    for name in os.listdir(path):
+        if name != str(_SURFACE_CACHE_VERSION):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
 
-        for entity, value in entities.items():
-            if isinstance(value, basestring):
-                xml = '<!ENTITY %s "%s">' % (entity, value)
-                icon = re.sub('<!ENTITY %s .*>' % entity, xml, icon)
+
+_disk_cache = None
+
+
+def _get_disk_cache():
+    global _disk_cache
+    if _disk_cache is None:
+        path = os.environ.get('SUGAR_ICON_CACHE_DIR')
+        if path is None:
+            parent_path = env.get_profile_path('icon-cache')
+            try:
+                _remove_old_disk_caches(parent_path)
+            except OSError:
+                pass
+            path = os.path.join(parent_path, str(_SURFACE_CACHE_VERSION))
+        _disk_cache = _SurfaceDiskCache(path)
+    return _disk_cache
+
+
+_SURFACE_CACHE_BUDGET = 4 * 1024 * 1024
+_SVG_CACHE_BUDGET = 1024 * 1024
+# The memory held by a Rsvg handle isn't known, they are counted instead
+_SVG_HANDLE_CACHE_ENTRIES = 50
+
+
+class _SizedCache(object):
+    '''
+    Least recently used cache bounded by the total size of its values
+    rather than by their number.
+
+    Args:
+        budget (int): maximum number of bytes held by the cache
+        get_size (callable): returns the size in bytes of a value
+    '''
+
+    def __init__(self, budget, get_size):
+        self._budget = budget
+        self._get_size = get_size
+        self._entries = OrderedDict()
+        self._size = 0
+        # Icons can be rendered from the prefetch worker threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        '''
+        Like get(), but neither the statistics nor the order of the
+        entries are updated.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return entry[0]
+
+    def set(self, key, value):
+        size = self._get_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+
+            if size > self._budget:
+                return
+
+            self._entries[key] = (value, size)
+            self._size += size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self._budget:
+            key_, (value_, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+    def set_budget(self, budget):
+        with self._lock:
+            self._budget = budget
+            self._evict()
+
+    def flush(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {'budget': self._budget,
+                    'size': self._size,
+                    'entries': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def _get_surface_size(surface):
+    return surface.get_stride() * surface.get_height()
+
+
+_ENTITY_RE = re.compile('<!ENTITY (\\S+) .*>')
+
+
+class _SVGTemplate(object):
+    '''
+    The text of an SVG icon, split around its entity declarations so that
+    recolouring it is a matter of joining strings.
+    '''
+
+    def __init__(self, data):
+        self.size = len(data)
+        self._parts = []
+        self._slots = []
+
+        position = 0
+        for match in _ENTITY_RE.finditer(data):
+            self._parts.append(data[position:match.start()])
+            self._slots.append((match.group(1), match.group(0)))
+            position = match.end()
+        self._parts.append(data[position:])
+
+    def substitute(self, file_name, entities):
+        chunks = [self._parts[0]]
+        for (entity, original), part in zip(self._slots, self._parts[1:]):
+            value = entities.get(entity)
+            if value is None:
+                chunks.append(original)
+            elif isinstance(value, basestring):
+                chunks.append('<!ENTITY %s "%s">' % (entity, value))
             else:
                 logging.error(
                     'Icon %s, entity %s is invalid.', file_name, entity)
+                chunks.append(original)
+            chunks.append(part)
+
+        return ''.join(chunks)
+
+
+class _SVGLoader(object):
+    '''
+    Loads and recolours SVG icons.  The parsed templates are kept in a
+    cache charged with the size of the SVG source, the resulting Rsvg
+    handles in a cache bounded by their number.
+    '''
+
+    def __init__(self):
+        self._cache = _SizedCache(_SVG_CACHE_BUDGET,
+                                  lambda template: template.size)
+        self._handles = _SizedCache(_SVG_HANDLE_CACHE_ENTRIES,
+                                    lambda handle: 1)
+
+    def _get_template(self, file_name, cache):
+        if cache:
+            template = self._cache.get(file_name)
+        else:
+            # Not counted, the template won't be cached anyway
+            template = self._cache.peek(file_name)
+        if template is not None:
+            return template
+
+        icon_file = open(file_name, 'r')
+        template = _SVGTemplate(icon_file.read())
+        icon_file.close()
+
+        if cache:
+            self._cache.set(file_name, template)
+
+        return template
+
+    def load(self, file_name, entities, cache):
+        # Rsvg handles can't be shared between threads, the prefetch
+        # workers render from handles of their own
+        cache = cache and _in_main_thread()
+        if cache:
+            handle_key = (file_name, tuple(sorted(entities.items())))
+            handle = self._handles.get(handle_key)
+            if handle is not None:
+                return handle
+
+        template = self._get_template(file_name, cache)
+        icon = template.substitute(file_name, entities)
+        handle = Rsvg.Handle.new_from_data(icon.encode('utf-8'))
+
+        if cache:
+            self._handles.set(handle_key, handle)
+
+        return handle
+
+    def set_budget(self, svg=None, handles=None):
+        if svg is not None:
+            self._cache.set_budget(svg)
+        if handles is not None:
+            self._handles.set_budget(handles)
+
+    def flush(self):
+        self._cache.flush()
+        self._handles.flush()
+
+
+def _in_main_thread():
+    return isinstance(threading.current_thread(), threading._MainThread)
+
+
+_MAIN_THREAD_TIMEOUT = 5
+
+
+def _call_in_main_thread(function, *args):
+    # Gtk.IconTheme may only be used from the main thread, the prefetch
+    # workers hand their lookups over and wait for the result.  The main
+    # loop may not be running, so don't wait forever.
+    done = threading.Event()
+    result = []
+
+    def call_cb():
+        try:
+            result.append(function(*args))
+        finally:
+            done.set()
+        return False
+
+    GObject.idle_add(call_cb)
+    if not done.wait(_MAIN_THREAD_TIMEOUT):
+        raise RuntimeError('%r timed out in the main thread' % function)
+    if not result:
+        raise RuntimeError('%r failed in the main thread' % function)
+    return result[0]
+
+
+class _PrefetchBatch(object):
+
+    def __init__(self, count, callback):
+        self._count = count
+        self._callback = callback
+        if count == 0:
+            self._complete()
+
+    def _complete(self):
+        if self._callback is not None:
+            self._callback()
+
+    def done(self):
+        self._count -= 1
+        if self._count == 0:
+            self._complete()
+
+
+class _IconPrefetcher(object):
+    '''
+    Renders icons into the surface cache from a pool of worker threads.
+    '''
+
+    def __init__(self, workers=2):
+        self._workers = workers
+        self._threads = []
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        # cache key -> callbacks to run in the main thread when rendered
+        self._pending = {}
+
+    def _start_workers(self):
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            icon_buffer, cache_key = self._queue.get()
+            try:
+                icon_buffer.get_surface(block=True)
+            except Exception:
+                logging.exception('Error prefetching icon %s',
+                                  icon_buffer.icon_name or
+                                  icon_buffer.file_name)
+            finally:
+                # Not pending anymore even if the main loop doesn't run,
+                # so that get_surface() renders the icon if it failed
+                with self._lock:
+                    callbacks = self._pending.pop(cache_key, [])
+                GObject.idle_add(self._done_cb, callbacks)
+
+    def _done_cb(self, callbacks):
+        for callback in callbacks:
+            callback()
+        return False
+
+    def prefetch(self, icon_buffers, callback):
+        batch = _PrefetchBatch(len(icon_buffers), callback)
+        for icon_buffer in icon_buffers:
+            cache_key = icon_buffer._get_cache_key(True)
+            with self._lock:
+                if cache_key in self._pending:
+                    self._pending[cache_key].append(batch.done)
+                    continue
+                self._pending[cache_key] = [batch.done]
+            self._queue.put((icon_buffer, cache_key))
+        self._start_workers()
+
+    def is_pending(self, cache_key):
+        with self._lock:
+            return cache_key in self._pending
+
+    def add_waiter(self, cache_key, callback):
+        with self._lock:
+            if cache_key not in self._pending:
+                return False
+            # Widgets ask again on every draw until the icon is ready
+            if callback not in self._pending[cache_key]:
+                self._pending[cache_key].append(callback)
+            return True
+
+
+_prefetcher = _IconPrefetcher()
+
+
+def _draw_placeholder(context, x, y, width, height):
+    # Drawn in place of an icon being prefetched
+    red, green, blue, alpha_ = style.COLOR_BUTTON_GREY.get_rgba()
+    context.save()
+    context.set_source_rgba(red, green, blue, 0.3)
+    context.arc(x + width / 2.0, y + height / 2.0, min(width, height) / 4.0,
+                0, 2 * math.pi)
+    context.fill()
+    context.restore()
+
+
+class _ThemeLookupCache(object):
+    '''
+    Remembers the results of the icon theme lookups, until the theme
+    changes.  Only to be used from the main thread.
+    '''
+
+    def __init__(self):
+        self._theme = None
+        self._lookups = {}
+        self._has_icon = {}
+        # Changes whenever the lookups are cleared
+        self.serial = 0
+
+    def _get_theme(self):
+        theme = Gtk.IconTheme.get_default()
+        if theme is not self._theme:
+            self._theme = theme
+            self._theme.connect('changed', self.__theme_changed_cb)
+            self.clear()
+        return theme
+
+    def __theme_changed_cb(self, theme):
+        self.clear()
+
+    def clear(self):
+        self._lookups.clear()
+        self._has_icon.clear()
+        self.serial += 1
+
+    def _get_attach_points(self, info, size_request):
+        has_attach_points_, attach_points = info.get_attach_points()
+        attach_x = attach_y = 0
+        if attach_points:
+            # this works only for Gtk < 3.14
+            # https://developer.gnome.org/gtk3/stable/GtkIconTheme.html
+            # #gtk-icon-info-get-attach-points
+            attach_x = float(attach_points[0].x) / size_request
+            attach_y = float(attach_points[0].y) / size_request
+        elif info.get_filename():
+            # try read from the .icon file
+            icon_filename = info.get_filename().replace('.svg', '.icon')
+            if os.path.exists(icon_filename):
+                try:
+                    with open(icon_filename) as config_file:
+                        cp = ConfigParser()
+                        cp.readfp(config_file)
+                        attach_points_str = cp.get('Icon Data', 'AttachPoints')
+                        attach_points = attach_points_str.split(',')
+                        attach_x = float(attach_points[0].strip()) / 1000
+                        attach_y = float(attach_points[1].strip()) / 1000
+                except Exception as e:
+                    logging.exception('Exception reading icon info: %s', e)
+
+        return attach_x, attach_y
+
+    def lookup(self, icon_name, size):
+        '''
+        Returns a (file_name, attach_x, attach_y) tuple, file_name is None
+        if the icon is not in the theme.
+        '''
+        theme = self._get_theme()
+        key = (icon_name, int(size))
+        if key in self._lookups:
+            return self._lookups[key]
+
+        info = theme.lookup_icon(icon_name, int(size), 0)
+        if info:
+            attach_x, attach_y = self._get_attach_points(info, size)
+            result = (info.get_filename(), attach_x, attach_y)
+            del info
+        else:
+            result = (None, 0, 0)
+
+        self._lookups[key] = result
+        return result
+
+    def has_icon(self, icon_name):
+        theme = self._get_theme()
+        if icon_name not in self._has_icon:
+            self._has_icon[icon_name] = theme.has_icon(icon_name)
+        return self._has_icon[icon_name]
 
-        return Rsvg.Handle.new_from_data(icon.encode('utf-8'))
+
+_theme_cache = _ThemeLookupCache()
 
 
 class _IconInfo(object):
@@ -155,7 +722,7 @@ class _BadgeInfo(object):
 
 class _IconBuffer(object):
 
-    _surface_cache = LRU(50)
+    _surface_cache = _SizedCache(_SURFACE_CACHE_BUDGET, _get_surface_size)
     _loader = _SVGLoader()
 
     def __init__(self):
@@ -183,6 +750,49 @@ class _IconBuffer(object):
                 self.stroke_color, self.badge_name, self.width, self.height,
                 color, sensitive)
 
+    def _get_disk_cache_key(self, icon_info, sensitive, widget):
+        file_name = icon_info.file_name
+        if isinstance(file_name, TempFilePath):
+            # Temporary files are not worth keeping around
+            return None
+
+        try:
+            mtime = os.stat(file_name).st_mtime
+        except OSError:
+            return None
+
+        badge = None
+        if self.badge_name:
+            # The size of the badge depends on the size of the icon, which
+            # isn't known before it is loaded.  Theme icons are scalable,
+            # the file at the requested size is the one drawn.
+            badge_file_name = self._get_badge_file_name(
+                int(_BADGE_SIZE * (self.width or 50)))
+            if badge_file_name is None:
+                return None
+            try:
+                badge = (badge_file_name, os.stat(badge_file_name).st_mtime,
+                         icon_info.attach_x, icon_info.attach_y)
+            except OSError:
+                return None
+
+        style_key = None
+        if not sensitive and widget is not None:
+            # Insensitive icons are rendered by the GTK theme
+            if not _in_main_thread():
+                return None
+            settings = Gtk.Settings.get_default()
+            style_key = settings.props.gtk_theme_name
+
+        if self.background_color is None:
+            color = None
+        else:
+            color = (self.background_color.red, self.background_color.green,
+                     self.background_color.blue)
+
+        return (file_name, mtime, self.fill_color, self.stroke_color,
+                badge, self.width, self.height, color, sensitive, style_key)
+
     def _load_svg(self, file_name):
         entities = {}
         if self.fill_color:
@@ -192,64 +802,41 @@ class _IconBuffer(object):
 
         return self._loader.load(file_name, entities, self.cache)
 
-    def _get_attach_points(self, info, size_request):
-        has_attach_points_, attach_points = info.get_attach_points()
-        attach_x = attach_y = 0
-        if attach_points:
-            # this works only for Gtk < 3.14
-            # https://developer.gnome.org/gtk3/stable/GtkIconTheme.html
-            # #gtk-icon-info-get-attach-points
-            attach_x = float(attach_points[0].x) / size_request
-            attach_y = float(attach_points[0].y) / size_request
-        elif info.get_filename():
-            # try read from the .icon file
-            icon_filename = info.get_filename().replace('.svg', '.icon')
-            if os.path.exists(icon_filename):
-                try:
-                    with open(icon_filename) as config_file:
-                        cp = ConfigParser()
-                        cp.readfp(config_file)
-                        attach_points_str = cp.get('Icon Data', 'AttachPoints')
-                        attach_points = attach_points_str.split(',')
-                        attach_x = float(attach_points[0].strip()) / 1000
-                        attach_y = float(attach_points[1].strip()) / 1000
-                except Exception as e:
-                    logging.exception('Exception reading icon info: %s', e)
-
-        return attach_x, attach_y
-
     def _get_icon_info(self, file_name, icon_name):
+        if not file_name and icon_name and not _in_main_thread():
+            return _call_in_main_thread(self._get_icon_info, file_name,
+                                        icon_name)
+
         icon_info = _IconInfo()
 
         if file_name:
             icon_info.file_name = file_name
         elif icon_name:
-            theme = Gtk.IconTheme.get_default()
-
             size = 50
             if self.width is not None:
                 size = self.width
 
-            info = theme.lookup_icon(icon_name, int(size), 0)
-            if info:
-                attach_x, attach_y = self._get_attach_points(info, size)
-
-                icon_info.file_name = info.get_filename()
+            file_name, attach_x, attach_y = _theme_cache.lookup(icon_name,
+                                                                size)
+            if file_name:
+                icon_info.file_name = file_name
                 icon_info.attach_x = attach_x
                 icon_info.attach_y = attach_y
-
-                del info
             else:
                 logging.warning('No icon with the name %s was found in the '
                                 'theme.', icon_name)
 
         return icon_info
 
+    def _get_badge_file_name(self, size):
+        if not _in_main_thread():
+            return _call_in_main_thread(self._get_badge_file_name, size)
+
+        return _theme_cache.lookup(self.badge_name, size)[0]
+
     def _draw_badge(self, context, size, sensitive, widget):
-        theme = Gtk.IconTheme.get_default()
-        badge_info = theme.lookup_icon(self.badge_name, int(size), 0)
-        if badge_info:
-            badge_file_name = badge_info.get_filename()
+        badge_file_name = self._get_badge_file_name(size)
+        if badge_file_name:
             if badge_file_name.endswith('.svg'):
                 handle = self._loader.load(badge_file_name, {}, self.cache)
 
@@ -334,10 +921,15 @@ class _IconBuffer(object):
 
         return pixbuf
 
-    def get_surface(self, sensitive=True, widget=None):
+    def get_surface(self, sensitive=True, widget=None, block=False):
         cache_key = self._get_cache_key(sensitive)
-        if cache_key in self._surface_cache:
-            return self._surface_cache[cache_key]
+        surface = self._surface_cache.get(cache_key)
+        if surface is not None:
+            return surface
+
+        if not block and _prefetcher.is_pending(cache_key):
+            # Don't block, the icon is being rendered in a worker thread
+            return None
 
         if self.pixbuf:
             # We alredy have the pixbuf for this icon.
@@ -346,6 +938,7 @@ class _IconBuffer(object):
             icon_height = pixbuf.get_height()
             icon_info = self._get_icon_info(self.file_name, self.icon_name)
             is_svg = False
+            disk_key = None
         else:
             # We run two attempts at finding the icon. First, we try the icon
             # requested by the user. If that fails, we fall back on
@@ -359,6 +952,14 @@ class _IconBuffer(object):
 
                 is_svg = icon_info.file_name.endswith('.svg')
 
+                disk_key = self._get_disk_cache_key(icon_info, sensitive,
+                                                    widget)
+                if disk_key is not None:
+                    surface = _get_disk_cache().load(disk_key)
+                    if surface is not None:
+                        self._surface_cache.set(cache_key, surface)
+                        return surface
+
                 if is_svg:
                     try:
                         handle = self._load_svg(icon_info.file_name)
@@ -421,10 +1022,21 @@ class _IconBuffer(object):
             context.translate(badge_info.attach_x, badge_info.attach_y)
             self._draw_badge(context, badge_info.size, sensitive, widget)
 
-        self._surface_cache[cache_key] = surface
+        self._surface_cache.set(cache_key, surface)
+        if disk_key is not None:
+            _get_disk_cache().save(disk_key, surface)
 
         return surface
 
+    def connect_prefetch(self, sensitive, callback):
+        '''
+        Call `callback` once the surface being prefetched for the current
+        icon is ready, only once however many times it is connected.
+        Returns False if the surface isn't being prefetched.
+        '''
+        return _prefetcher.add_waiter(self._get_cache_key(sensitive),
+                                      callback)
+
     xo_color = property(_get_xo_color, _set_xo_color)
 
 
@@ -583,6 +1195,13 @@ class Icon(Gtk.Image):
         sensitive = (self.is_sensitive())
         surface = self._buffer.get_surface(sensitive, self)
         if surface is None:
+            if self._buffer.connect_prefetch(sensitive, self.queue_resize) \
+                    and self._buffer.width and self._buffer.height:
+                allocation = self.get_allocation()
+                _draw_placeholder(
+                    cr, (allocation.width - self._buffer.width) / 2,
+                    (allocation.height - self._buffer.height) / 2,
+                    self._buffer.width, self._buffer.height)
             return
 
         xpad, ypad = self.get_padding()
@@ -812,7 +1431,15 @@ class EventIcon(Gtk.EventBox):
     def do_draw(self, cr):
         '''Gtk widget implementation method'''
         surface = self._buffer.get_surface()
-        if surface:
+        if surface is None:
+            if self._buffer.connect_prefetch(True, self.queue_resize) and \
+                    self._buffer.width and self._buffer.height:
+                allocation = self.get_allocation()
+                _draw_placeholder(
+                    cr, (allocation.width - self._buffer.width) / 2,
+                    (allocation.height - self._buffer.height) / 2,
+                    self._buffer.width, self._buffer.height)
+        else:
             allocation = self.get_allocation()
 
             x = (allocation.width - surface.get_width()) / 2
@@ -1152,6 +1779,96 @@ if hasattr(CanvasIcon, 'set_css_name'):
     CanvasIcon.set_css_name('canvasicon')
 
 
+class _IconAtlas(object):
+    '''
+    A single surface holding every icon painted by a cell renderer, packed
+    in shelves.  The atlas grows as new icons are added, and it is started
+    over once it reaches its maximum size, or when the icon theme changes.
+    '''
+
+    _INITIAL_SIZE = 512
+    _MAX_SIZE = 4096
+
+    def __init__(self):
+        self.surface = None
+        self.clear()
+
+    def clear(self):
+        self.surface = None
+        self._theme_serial = _theme_cache.serial
+        self._width = 0
+        self._height = 0
+        self._regions = {}
+        self._shelf_x = 0
+        self._shelf_y = 0
+        self._shelf_height = 0
+
+    def _resize(self, width, height):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        if self.surface is not None:
+            context = cairo.Context(surface)
+            context.set_source_surface(self.surface, 0, 0)
+            context.paint()
+
+        self.surface = surface
+        self._width = width
+        self._height = height
+
+    def _allocate(self, width, height):
+        if self.surface is None:
+            self._resize(self._INITIAL_SIZE, self._INITIAL_SIZE)
+
+        if self._shelf_x + width > self._width:
+            self._shelf_x = 0
+            self._shelf_y += self._shelf_height
+            self._shelf_height = 0
+
+        while self._shelf_y + height > self._height:
+            if self._height * 2 > self._MAX_SIZE:
+                self.clear()
+                self._resize(self._INITIAL_SIZE, self._INITIAL_SIZE)
+            else:
+                self._resize(self._width, self._height * 2)
+
+        x, y = self._shelf_x, self._shelf_y
+        self._shelf_x += width
+        self._shelf_height = max(self._shelf_height, height)
+
+        return x, y
+
+    def get_region(self, icon_buffer):
+        '''
+        Returns the (x, y, width, height) region of the atlas holding the
+        icon, or None if it hasn't been added.
+        '''
+        if self._theme_serial != _theme_cache.serial:
+            # The icons were drawn from the previous theme
+            self.clear()
+        return self._regions.get(icon_buffer._get_cache_key(True))
+
+    def add(self, icon_buffer, surface):
+        '''
+        Add the surface of the icon to the atlas.  Returns its region, see
+        get_region(), or None if it is too large for the atlas.
+        '''
+        width = surface.get_width()
+        height = surface.get_height()
+        if width > self._INITIAL_SIZE or height > self._INITIAL_SIZE:
+            return None
+
+        x, y = self._allocate(width, height)
+
+        context = cairo.Context(self.surface)
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        context.set_source_surface(surface, x, y)
+        context.rectangle(x, y, width, height)
+        context.fill()
+
+        region = (x, y, width, height)
+        self._regions[icon_buffer._get_cache_key(True)] = region
+        return region
+
+
 class CellRendererIcon(Gtk.CellRenderer):
 
     __gtype_name__ = 'SugarCellRendererIcon'
@@ -1174,6 +1891,7 @@ class CellRendererIcon(Gtk.CellRenderer):
         self._prelit_stroke_color = None
         self._active_state = False
         self._cached_offsets = None
+        self._atlas = None
 
         Gtk.CellRenderer.__init__(self)
 
@@ -1258,6 +1976,26 @@ class CellRendererIcon(Gtk.CellRenderer):
 
     size = GObject.property(type=object, setter=set_size)
 
+    def set_use_atlas(self, value):
+        '''
+        Paint the icons from a single atlas surface holding all the icon
+        variants rendered so far, instead of one surface per icon.  This
+        is faster for tree views with many rows.
+
+        Args:
+            value (bool): if True, the atlas will be used
+        '''
+        if value and self._atlas is None:
+            self._atlas = _IconAtlas()
+        elif not value:
+            self._atlas = None
+
+    def get_use_atlas(self):
+        return self._atlas is not None
+
+    use_atlas = GObject.property(type=bool, default=False,
+                                 getter=get_use_atlas, setter=set_use_atlas)
+
     def do_get_size(self, widget, cell_area, x_offset=None, y_offset=None,
                     width=None, height=None):
         width = self._buffer.width + self.props.xpad * 2
@@ -1354,20 +2092,39 @@ class CellRendererIcon(Gtk.CellRenderer):
                 self._buffer.fill_color = self._fill_color
                 self._buffer.stroke_color = self._stroke_color
 
-        surface = self._buffer.get_surface()
-        if surface is None:
-            return
+        region = None
+        if self._atlas is not None:
+            region = self._atlas.get_region(self._buffer)
+
+        if region is None:
+            surface = self._buffer.get_surface()
+            if surface is None:
+                if self._buffer.connect_prefetch(True, widget.queue_draw) \
+                        and self._buffer.width and self._buffer.height:
+                    _draw_placeholder(cr, cell_area.x, cell_area.y,
+                                      cell_area.width, cell_area.height)
+                return
+            if self._atlas is not None:
+                region = self._atlas.add(self._buffer, surface)
 
         xoffset, yoffset = self._get_offsets(widget, cell_area)
 
-        x = cell_area.x + xoffset
-        y = cell_area.y + yoffset
+        x = math.floor(cell_area.x + xoffset)
+        y = math.floor(cell_area.y + yoffset)
 
-        cr.set_source_surface(surface, math.floor(x), math.floor(y))
         cr.rectangle(cell_area.x, cell_area.y, cell_area.width,
                      cell_area.height)
         cr.clip()
-        cr.paint()
+
+        if region is None:
+            cr.set_source_surface(surface, x, y)
+            cr.paint()
+        else:
+            atlas_x, atlas_y, width, height = region
+            cr.set_source_surface(self._atlas.surface, x - atlas_x,
+                                  y - atlas_y)
+            cr.rectangle(x, y, width, height)
+            cr.fill()
 
 
 def get_icon_state(base_name, perc, step=5):
@@ -1406,11 +2163,10 @@ def get_icon_state(base_name, perc, step=5):
         str, icon name that represent given state, or None if not found
     '''
     strength = round(perc / step) * step
-    icon_theme = Gtk.IconTheme.get_default()
 
     while strength <= 100 and strength >= 0:
         icon_name = '%s-%03d' % (base_name, strength)
-        if icon_theme.has_icon(icon_name):
+        if _theme_cache.has_icon(icon_name):
             return icon_name
 
         strength = strength + step
@@ -1425,13 +2181,7 @@ def get_icon_file_name(icon_name):
     Returns:
         str, path to icon, or None is the icon is not found in the theme
     '''
-    icon_theme = Gtk.IconTheme.get_default()
-    info = icon_theme.lookup_icon(icon_name, Gtk.IconSize.LARGE_TOOLBAR, 0)
-    if not info:
-        return None
-    filename = info.get_filename()
-    del info
-    return filename
+    return _theme_cache.lookup(icon_name, Gtk.IconSize.LARGE_TOOLBAR)[0]
 
 
 def get_surface(**kwargs):
@@ -1445,4 +2195,74 @@ def get_surface(**kwargs):
     icon = _IconBuffer()
     for key, value in kwargs.items():
         icon.__setattr__(key, value)
-    return icon.get_surface()
+    return icon.get_surface(block=True)
+
+
+def prefetch(specs, callback=None):
+    '''
+    Render icons into the cache from worker threads, so that they are
+    ready by the time they are drawn.  Icons being prefetched are drawn
+    as a placeholder and redrawn as soon as they are ready, instead of
+    blocking the main loop.  Only the sensitive state of the icons is
+    prefetched.
+
+    Args:
+        specs (list): list of dicts, each one with the same arguments
+            as :any:`get_surface`, eg. `{'icon_name': 'go-next',
+            'width': style.STANDARD_ICON_SIZE,
+            'height': style.STANDARD_ICON_SIZE}`
+
+    Keyword Args:
+        callback (callable): called without arguments, in the main thread,
+            when all the icons have been rendered
+    '''
+    icon_buffers = []
+    for spec in specs:
+        icon = _IconBuffer()
+        for key, value in spec.items():
+            icon.__setattr__(key, value)
+        icon_buffers.append(icon)
+
+    _prefetcher.prefetch(icon_buffers, callback)
+
+
+def set_cache_budget(surfaces=None, svg=None, handles=None):
+    '''
+    Set the memory budget of the icon caches.  When a cache grows over its
+    budget the least recently used entries are evicted.
+
+    Keyword Args:
+        surfaces (int): bytes of rendered icon surfaces to keep, the
+            default is 4 MiB
+        svg (int): bytes of SVG source to keep as parsed icons, the
+            default is 1 MiB
+        handles (int): number of recoloured SVG icons to keep ready for
+            rendering, the default is 50
+    '''
+    if surfaces is not None:
+        _IconBuffer._surface_cache.set_budget(surfaces)
+    _IconBuffer._loader.set_budget(svg, handles)
+
+
+def get_cache_stats():
+    '''
+    Get statistics about the icon caches.
+
+    Returns:
+        dict, with a `surfaces`, a `svg` and a `handles` entry, each one a
+        dict with the `budget`, `size`, `entries`, `hits`, `misses` and
+        `evictions` of the cache.  The budget and size are in bytes, but
+        for the handles, which are counted.
+    '''
+    return {'surfaces': _IconBuffer._surface_cache.get_stats(),
+            'svg': _IconBuffer._loader._cache.get_stats(),
+            'handles': _IconBuffer._loader._handles.get_stats()}
+
+
+def flush_cache():
+    '''
+    Drop every icon held in memory by the icon caches.  The statistics
+    are preserved.
+    '''
+    _IconBuffer._surface_cache.flush()
+    _IconBuffer._loader.flush()
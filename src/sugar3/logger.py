@@ -22,12 +22,17 @@ STABLE.
 
 import array
 import collections
+import contextlib
+import ctypes
+import ctypes.util
 import errno
+import json
 import logging
 import sys
 import os
 import repr as repr_
 import decorator
+import thread
 import time
 
 from sugar3 import env
@@ -185,6 +190,112 @@ def start(log_filename=None):
     sys.excepthook = _except_hook
 
 
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+_CLOCK_MONOTONIC = 1
+
+try:
+    _libc_path = ctypes.util.find_library('c')
+    if _libc_path is None:
+        raise OSError('The C library was not found')
+    _clock_gettime = ctypes.CDLL(_libc_path, use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+except (OSError, AttributeError):
+    _clock_gettime = None
+
+
+def _get_monotonic_time():
+    """Microseconds from an arbitrary point, not affected by changes of the
+    system time.  Falls back to the system time if not available."""
+    if _clock_gettime is not None:
+        timespec = _Timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(timespec)) == 0:
+            return timespec.tv_sec * 1000000 + timespec.tv_nsec // 1000
+    return int(time.time() * 1000000)
+
+
+# Startup phases, recorded when SUGAR_STARTUP_TRACE is set, until
+# save_startup_trace() is called
+_startup_events = None
+if os.environ.get('SUGAR_STARTUP_TRACE'):
+    _startup_events = []
+
+
+def restart_startup_trace():
+    """Drop the recorded startup phases, and record them again if
+    SUGAR_STARTUP_TRACE is set, eg. in a process forked by the zygote"""
+    global _startup_events
+
+    _startup_events = None
+    if os.environ.get('SUGAR_STARTUP_TRACE'):
+        _startup_events = []
+
+
+def is_startup_traced():
+    """Whether the startup phases are being recorded"""
+    return _startup_events is not None
+
+
+def _add_startup_event(name, phase):
+    if _startup_events is not None:
+        _startup_events.append({'name': name,
+                                'cat': 'startup',
+                                'ph': phase,
+                                'ts': _get_monotonic_time(),
+                                'pid': os.getpid(),
+                                'tid': thread.get_ident()})
+
+
+def start_startup_phase(name):
+    """Record the beginning of the startup phase name"""
+    _add_startup_event(name, 'B')
+
+
+def end_startup_phase(name):
+    """Record the end of the startup phase name"""
+    _add_startup_event(name, 'E')
+
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """Record the startup phase name, for the duration of the with block"""
+    start_startup_phase(name)
+    try:
+        yield
+    finally:
+        end_startup_phase(name)
+
+
+def mark_startup_event(name):
+    """Record the instant event name"""
+    if _startup_events is not None:
+        _add_startup_event(name, 'i')
+        _startup_events[-1]['s'] = 'p'
+
+
+def save_startup_trace(name):
+    """Stop recording the startup phases, and write them in the Chrome
+    trace event format, to name-pid.trace.json in the logs directory.
+    Load it with chrome://tracing to view it.
+    """
+    global _startup_events
+
+    if _startup_events is None:
+        return
+    events = _startup_events
+    _startup_events = None
+
+    path = env.get_logs_path('%s-%d.trace.json' % (name, os.getpid()))
+    try:
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                      trace_file)
+    except IOError, e:
+        logging.warning('Could not write startup trace %s: %s', path, e)
+
+
 class TraceRepr(repr_.Repr):
 
     # better handling of subclasses of basic types, e.g. for DBus
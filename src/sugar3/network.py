@@ -20,9 +20,19 @@ STABLE.
 """
 
 import os
+import time
+import mmap
+import errno
+import ctypes
+import ctypes.util
+import select
+import socket
+import logging
+import hashlib
+import httplib
 import threading
 import urllib
-import fcntl
+import urllib2
 import tempfile
 
 from gi.repository import GObject
@@ -45,6 +55,67 @@ def _del_authinfo():
     del __authinfos[threading.currentThread()]
 
 
+# sendfile(2), os.sendfile() is not available before python 3.3.  Only
+# the Linux one is used, other systems have different arguments.
+try:
+    _libc_path = ctypes.util.find_library('c')
+    if _libc_path is None:
+        raise OSError('The C library was not found')
+    _sendfile = ctypes.CDLL(_libc_path, use_errno=True).sendfile64
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                          ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    _sendfile = None
+
+
+def _send_file_range(out_fd, in_fd, offset, count):
+    """Copy count bytes at offset of in_fd to out_fd, in the kernel.
+    Returns the number of bytes copied, raises OSError."""
+    c_offset = ctypes.c_int64(offset)
+    sent = _sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+    if sent < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return sent
+
+
+def _parse_range(header, size):
+    """Parse the value of a Range header, for a file of size bytes.
+
+    Returns the (first, last) positions of the requested bytes, or None
+    if the whole file should be sent, because the header is malformed or
+    requests several ranges.  Raises ValueError if the range is not
+    satisfiable.
+    """
+    unit, sep, byte_range = header.partition('=')
+    if unit.strip() != 'bytes' or not sep or ',' in byte_range:
+        return None
+
+    first, sep, last = byte_range.strip().partition('-')
+    if not sep or not (first or last):
+        return None
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None
+
+    if first is None:
+        # The last bytes of the file
+        if last == 0 or size == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - last, 0), size - 1
+
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        raise ValueError('Range starts after the end of the file')
+    if last is None or last >= size:
+        last = size - 1
+    return first, last
+
+
 class GlibTCPServer(SocketServer.TCPServer):
     """GlibTCPServer
 
@@ -82,33 +153,179 @@ class GlibTCPServer(SocketServer.TCPServer):
         pass
 
 
+_BUSY_RESPONSE = ('HTTP/1.1 503 Service Unavailable\r\n'
+                  'Retry-After: 1\r\n'
+                  'Content-Length: 0\r\n'
+                  'Connection: close\r\n'
+                  '\r\n')
+
+
+class ThreadedGlibTCPServer(GlibTCPServer):
+    """GlibTCPServer serving each connection in its own thread, so that
+    the transfers don't compete with the user interface for the mainloop.
+    Connections are still accepted in the mainloop.
+
+    ChunkedGlibHTTPRequestHandler then sends the files with blocking
+    writes and keeps HTTP/1.1 connections alive.  At most max_connections
+    connections are served at once, and at most max_client_connections
+    from the same address, so that a single client can't take all the
+    connections.  Connections beyond the limits get a 503 response,
+    asking the client to retry.
+
+    These are only caps on the number of connections: the connections
+    being served are not scheduled, and share the bandwidth as the
+    network gives it to them.
+    """
+
+    threaded = True
+    max_connections = 16
+    max_client_connections = 2
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 max_connections=None, max_client_connections=None):
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_client_connections is not None:
+            self.max_client_connections = max_client_connections
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._client_connections = {}
+        GlibTCPServer.__init__(self, server_address, RequestHandlerClass)
+
+    def get_connection_count(self):
+        """The number of connections being served"""
+        with self._lock:
+            return self._connections
+
+    def process_request(self, request, client_address):
+        host = client_address[0]
+        with self._lock:
+            client_count = self._client_connections.get(host, 0)
+            accepted = self._connections < self.max_connections and \
+                client_count < self.max_client_connections
+            if accepted:
+                self._connections += 1
+                self._client_connections[host] = client_count + 1
+
+        if not accepted:
+            logging.debug('Refusing connection from %s, too many connections',
+                          host)
+            try:
+                request.sendall(_BUSY_RESPONSE)
+            except socket.error:
+                pass
+            SocketServer.TCPServer.shutdown_request(self, request)
+            return
+
+        thread = threading.Thread(target=self._process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        thread.start()
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except socket.error, e:
+            logging.debug('Connection from %s failed: %s',
+                          client_address[0], e)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            SocketServer.TCPServer.shutdown_request(self, request)
+
+            host = client_address[0]
+            with self._lock:
+                self._connections -= 1
+                self._client_connections[host] -= 1
+                if self._client_connections[host] == 0:
+                    del self._client_connections[host]
+
+
 class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     """RequestHandler class that integrates with Glib mainloop.  It writes
        the specified file to the client in chunks, returning control to the
        mainloop between chunks.
+
+       Files are copied to the socket by the kernel with sendfile(2), or
+       written from a memory map if it is not available.  The chunks grow
+       from CHUNK_SIZE up to MAX_CHUNK_SIZE while the socket accepts them.
+       Range requests are supported, so that clients can resume
+       interrupted transfers.
+
+       When served by a ThreadedGlibTCPServer, the handler runs in its own
+       thread instead: the files are sent with blocking writes, and
+       HTTP/1.1 connections are kept alive for KEEP_ALIVE_TIMEOUT seconds.
     """
 
     CHUNK_SIZE = 4096
+    MAX_CHUNK_SIZE = 1024 * 1024
+    KEEP_ALIVE_TIMEOUT = 15
 
     def __init__(self, request, client_address, server):
         self._file = None
         self._srcid = 0
+        self._blocking = getattr(server, 'threaded', False)
+        self._reset_transfer()
         SimpleHTTPServer.SimpleHTTPRequestHandler.__init__(
             self, request, client_address, server)
 
+    def _reset_transfer(self):
+        self._offset = 0
+        self._end = None
+        self._chunk_size = self.CHUNK_SIZE
+        self._use_sendfile = _sendfile is not None
+        self._mmap = None
+        self._pending = ''
+
+    def setup(self):
+        if self._blocking:
+            self.protocol_version = 'HTTP/1.1'
+            self.timeout = self.KEEP_ALIVE_TIMEOUT
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+
     def log_request(self, code='-', size='-'):
         pass
 
     def do_GET(self):
         """Serve a GET request."""
+        self._reset_transfer()
         self._file = self.send_head()
-        if self._file:
+        if self._blocking:
+            if self._file:
+                try:
+                    self._send_blocking()
+                finally:
+                    self._close_file()
+        elif self._file:
+            # Never block the mainloop on a slow client
+            self.connection.setblocking(0)
             self._srcid = GObject.io_add_watch(self.wfile, GObject.IO_OUT |
                                                GObject.IO_ERR,
                                                self._send_next_chunk)
         else:
             self._cleanup()
 
+    def _send_blocking(self):
+        # The socket has a timeout, so its writes don't block
+        timeout = self.connection.gettimeout()
+        done = False
+        while not done:
+            try:
+                done = self._send_chunk()
+            except (IOError, OSError), e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.EAGAIN:
+                    logging.debug('Error sending %s: %s', self.path, e)
+                    break
+                if not select.select([], [self.connection], [], timeout)[1]:
+                    logging.debug('Timeout sending %s', self.path)
+                    break
+
+        if self._end is not None and self._offset < self._end:
+            # The client would wait for the missing bytes
+            self.close_connection = 1
+
     def _send_next_chunk(self, source, condition):
         if condition & GObject.IO_ERR:
             self._cleanup()
@@ -116,17 +333,78 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         if not (condition & GObject.IO_OUT):
             self._cleanup()
             return False
-        data = self._file.read(self.CHUNK_SIZE)
-        count = os.write(self.wfile.fileno(), data)
-        if count != len(data) or len(data) != self.CHUNK_SIZE:
+
+        try:
+            done = self._send_chunk()
+        except (IOError, OSError), e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            logging.debug('Error sending %s: %s', self.path, e)
+            done = True
+
+        if done:
             self._cleanup()
             return False
         return True
 
-    def _cleanup(self):
+    def _send_chunk(self):
+        if self._end is None:
+            return self._send_stream_chunk()
+        return self._send_file_chunk()
+
+    def _send_file_chunk(self):
+        count = min(self._chunk_size, self._end - self._offset)
+        if count <= 0:
+            return True
+
+        out_fd = self.wfile.fileno()
+        sent = None
+        if self._use_sendfile:
+            try:
+                sent = _send_file_range(out_fd, self._file.fileno(),
+                                        self._offset, count)
+            except OSError, e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                # Not supported for this file, eg. on some file systems
+                self._use_sendfile = False
+        if sent is None:
+            if self._mmap is None:
+                self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            sent = os.write(out_fd, buffer(self._mmap, self._offset, count))
+
+        if sent == 0:
+            # The file has been truncated
+            return True
+
+        self._offset += sent
+        if sent == count:
+            self._chunk_size = min(self._chunk_size * 2, self.MAX_CHUNK_SIZE)
+        else:
+            self._chunk_size = max(self._chunk_size // 2, self.CHUNK_SIZE)
+        return self._offset >= self._end
+
+    def _send_stream_chunk(self):
+        # Not a regular file, eg. a directory listing
+        if not self._pending:
+            self._pending = self._file.read(self.CHUNK_SIZE)
+            if not self._pending:
+                return True
+        count = os.write(self.wfile.fileno(), self._pending)
+        self._pending = self._pending[count:]
+        return False
+
+    def _close_file(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
         if self._file:
             self._file.close()
             self._file = None
+
+    def _cleanup(self):
+        self._close_file()
         if self._srcid > 0:
             GObject.source_remove(self._srcid)
             self._srcid = 0
@@ -137,7 +415,8 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def finish(self):
         """Close the sockets when we're done, not before"""
-        pass
+        if self._blocking:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.finish(self)
 
     def send_head(self):
         """Common code for GET and HEAD commands.
@@ -174,17 +453,112 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         except IOError:
             self.send_error(404, 'File not found')
             return None
-        self.send_response(200)
+
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        last_modified = self.date_time_string(stat.st_mtime)
+
+        byte_range = None
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and (not if_range or if_range == last_modified):
+            try:
+                byte_range = _parse_range(range_header, size)
+            except ValueError:
+                f.close()
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+
+        if byte_range is None:
+            self._offset, self._end = 0, size
+            self.send_response(200)
+        else:
+            first, last = byte_range
+            self._offset, self._end = first, last + 1
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (first, last, size))
         self.send_header('Content-type', ctype)
-        self.send_header('Content-Length', str(os.fstat(f.fileno())[6]))
+        self.send_header('Content-Length', str(self._end - self._offset))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', last_modified)
         self.send_header('Content-Disposition', 'attachment; filename="%s"' %
                          os.path.basename(path))
         self.end_headers()
         return f
 
 
+class _Cancelled(Exception):
+    pass
+
+
+class _Interrupted(IOError):
+    pass
+
+
+class _ChecksumMismatch(IOError):
+    pass
+
+
+class _Segment(object):
+    """Bytes [position, end) of the download, end is None until EOF"""
+
+    def __init__(self, position, end):
+        self.position = position
+        self.end = end
+
+
+def _parse_checksum(checksum):
+    algorithm, sep, digest = checksum.partition(':')
+    if not sep or not digest:
+        raise ValueError('Checksum %r is not algorithm:hexdigest' % checksum)
+    # Raises ValueError if the algorithm is not supported
+    hashlib.new(algorithm)
+    return algorithm, digest.lower()
+
+
+class DownloadProgress(long):
+    """The number of bytes downloaded, emitted by the progress signal of
+    GlibURLDownloader, with the attributes:
+
+    total -- the size of the download, or None if unknown
+    rate -- the throughput, in bytes per second
+    eta -- the estimated number of seconds left, or None if unknown
+    """
+
+    def __new__(cls, written, total=None, rate=0.0, eta=None):
+        progress = long.__new__(cls, written)
+        progress.total = total
+        progress.rate = rate
+        progress.eta = eta
+        return progress
+
+
 class GlibURLDownloader(GObject.GObject):
-    """Grabs a URL in chunks, returning to the mainloop after each chunk"""
+    """Downloads a URL in background threads, emitting the signals in the
+    mainloop.
+
+    Keyword arguments:
+    destdir -- directory of the downloaded file when start() is not given
+        a destination file (default the temporary directory)
+    buffer_size -- size of the reads (default CHUNK_SIZE)
+    connections -- number of connections downloading segments of large
+        files in parallel, if the server supports ranges (default 1)
+    checksum -- 'algorithm:hexdigest' the downloaded file is verified
+        against, eg. 'sha256:...', the error signal is emitted if it
+        does not match (default None)
+
+    Interrupted transfers are resumed with Range requests, up to
+    MAX_RETRIES times.  The progress signal is emitted every
+    PROGRESS_INTERVAL milliseconds with a DownloadProgress.
+
+    When the download fails, a destination file given to start() keeps
+    the data downloaded so far, so that start(resume=True) can continue
+    it.  It is removed by cancel(), or if the checksum does not match.
+    """
 
     __gsignals__ = {
         'finished': (GObject.SignalFlags.RUN_FIRST, None,
@@ -195,25 +569,48 @@ class GlibURLDownloader(GObject.GObject):
                      ([GObject.TYPE_PYOBJECT])),
     }
 
-    CHUNK_SIZE = 4096
+    CHUNK_SIZE = 64 * 1024
+    TIMEOUT = 30
+    MAX_RETRIES = 5
+    MAX_RETRY_DELAY = 30
+    MIN_SEGMENT_SIZE = 1024 * 1024
+    PROGRESS_INTERVAL = 250
 
-    def __init__(self, url, destdir=None):
+    def __init__(self, url, destdir=None, buffer_size=None, connections=1,
+                 checksum=None):
         self._url = url
         if not destdir:
             destdir = tempfile.gettempdir()
         self._destdir = destdir
-        self._srcid = 0
+        self._buffer_size = buffer_size or self.CHUNK_SIZE
+        self._connections = max(connections, 1)
+        self._checksum = None
+        if checksum is not None:
+            self._checksum = _parse_checksum(checksum)
         self._fname = None
         self._outf = None
+        self._temporary = False
         self._suggested_fname = None
-        self._info = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._running = False
+        self._resumable = False
+        self._validator = None
+        self._total = None
         self._written = 0
+        self._progress_id = 0
+        self._progress_time = 0
+        self._progress_written = 0
+        self._rate = 0.0
         GObject.GObject.__init__(self)
 
-    def start(self, destfile=None, destfd=None):
-        self._info = urllib.urlopen(self._url)
+    def start(self, destfile=None, destfd=None, resume=False):
+        """Start the download to destfile, or to a new file in destdir.
+        If resume is True, the download continues after the data already
+        in destfile, and finishes at once if destfile is complete."""
         self._outf = None
         self._fname = None
+        self._temporary = not destfile
         if destfd and not destfile:
             raise ValueError('Must provide destination file too when'
                              ' specifying file descriptor')
@@ -224,11 +621,11 @@ class GlibURLDownloader(GObject.GObject):
                 # Use the user-supplied destination file descriptor
                 self._outf = destfd
             else:
-                self._outf = os.open(self._fname, os.O_RDWR |
-                                     os.O_TRUNC | os.O_CREAT, 0644)
+                flags = os.O_RDWR | os.O_CREAT
+                if not resume:
+                    flags |= os.O_TRUNC
+                self._outf = os.open(self._fname, flags, 0644)
         else:
-            fname = self._get_filename_from_headers(self._info.headers)
-            self._suggested_fname = fname
             garbage_, path = urllib.splittype(self._url)
             garbage_, path = urllib.splithost(path or "")
             path, garbage_ = urllib.splitquery(path or "")
@@ -237,13 +634,24 @@ class GlibURLDownloader(GObject.GObject):
             (self._outf, self._fname) = tempfile.mkstemp(suffix=suffix,
                                                          dir=self._destdir)
 
-        fcntl.fcntl(self._info.fp.fileno(), fcntl.F_SETFD, os.O_NDELAY)
-        self._srcid = GObject.io_add_watch(self._info.fp.fileno(),
-                                           GObject.IO_IN | GObject.IO_ERR,
-                                           self._read_next_chunk)
+        position = 0
+        if resume:
+            position = os.fstat(self._outf).st_size
+        self._written = position
+        self._progress_written = position
+        self._progress_time = time.time()
+
+        self._stop.clear()
+        self._running = True
+        self._progress_id = GObject.timeout_add(self.PROGRESS_INTERVAL,
+                                                self.__progress_cb)
+
+        thread = threading.Thread(target=self._download, args=(position,))
+        thread.daemon = True
+        thread.start()
 
     def cancel(self):
-        if self._srcid == 0:
+        if not self._running:
             raise RuntimeError('Download already canceled or stopped')
         self.cleanup(remove=True)
 
@@ -263,46 +671,287 @@ class GlibURLDownloader(GObject.GObject):
             fname = fname[:len(fname) - 1]
         return fname
 
-    def _read_next_chunk(self, source, condition):
-        if condition & GObject.IO_ERR:
-            self.cleanup(remove=True)
-            self.emit('error', 'Error downloading file.')
-            return False
-        elif not (condition & GObject.IO_IN):
-            # shouldn't get here, but...
-            return True
-
+    def _download(self, position):
+        """Runs in a thread, and emits the signals in the mainloop"""
+        segments = []
         try:
-            data = self._info.fp.read(self.CHUNK_SIZE)
-            count = os.write(self._outf, data)
-            self._written += len(data)
-
-            # error writing data to file?
-            if count < len(data):
-                self.cleanup(remove=True)
-                self.emit('error', 'Error writing to download file.')
-                return False
-
-            self.emit('progress', self._written)
-
-            # done?
-            if len(data) < self.CHUNK_SIZE:
-                self.cleanup()
-                self.emit('finished', self._fname, self._suggested_fname)
-                return False
+            segment = _Segment(position, None)
+            response = self._open_first(segment)
+            if response is not None:
+                segments = self._split(segment)
+
+                threads = []
+                errors = []
+                for other in segments[1:]:
+                    thread = threading.Thread(target=self._fetch_segment,
+                                              args=(other, None, errors))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                self._fetch_segment(segment, response, errors)
+                for thread in threads:
+                    thread.join()
+
+                if errors:
+                    raise errors[0]
+            if self._checksum is not None:
+                self._verify_checksum()
+        except _Cancelled:
+            return
         except Exception, err:
-            self.cleanup(remove=True)
-            self.emit('error', 'Error downloading file: %r' % err)
-            return False
+            logging.debug('Error downloading %s: %r', self._url, err)
+            remove = self._temporary or isinstance(err, _ChecksumMismatch)
+            if not remove:
+                self._truncate_partial(segments)
+            GObject.idle_add(self.__error_cb,
+                             'Error downloading file: %s' % err, remove)
+            return
+
+        GObject.idle_add(self.__finished_cb)
+
+    def _open_first(self, segment):
+        """Request the bytes after the data already downloaded, returns
+        None if the file was downloaded completely"""
+        try:
+            return self._open(segment, first=True)
+        except urllib2.HTTPError, err:
+            if err.code != 416 or segment.position == 0:
+                raise
+
+            # Content-Range is 'bytes */length' in the 416 responses
+            content_range = err.info().get('Content-Range', '')
+            unit, sep, length = content_range.partition(' */')
+            if unit == 'bytes' and length.isdigit() and \
+                    int(length) == segment.position:
+                err.close()
+                self._total = segment.end = segment.position
+                return None
+
+            # The file is not the one partially downloaded
+            err.close()
+            self._restart(segment)
+            return self._open(segment, first=True)
+
+    def _open(self, segment, first=False):
+        """Request the bytes of the segment"""
+        request = urllib2.Request(self._url)
+        if segment.position > 0 or segment.end is not None:
+            last = ''
+            if segment.end is not None:
+                last = segment.end - 1
+            request.add_header('Range', 'bytes=%d-%s' %
+                               (segment.position, last))
+            if self._validator is not None:
+                request.add_header('If-Range', self._validator)
+
+        response = urllib2.urlopen(request, timeout=self.TIMEOUT)
+        headers = response.info()
+        partial = response.getcode() == 206
+
+        if partial:
+            content_range = headers.get('Content-Range', '')
+            start = content_range.partition(' ')[2].partition('-')[0]
+            if start != str(segment.position):
+                response.close()
+                raise IOError('Unexpected range %r' % content_range)
+        elif segment.position > 0 or segment.end is not None:
+            # The whole file is sent again
+            if not first or segment.end is not None:
+                response.close()
+                raise IOError('The server stopped accepting ranges')
+            self._restart(segment)
+
+        if first:
+            self._validator = headers.get('ETag') or \
+                headers.get('Last-Modified')
+            if self._suggested_fname is None:
+                self._suggested_fname = \
+                    self._get_filename_from_headers(headers)
+
+            length = headers.get('Content-Length')
+            if partial:
+                total = content_range.rpartition('/')[2]
+                self._total = int(total) if total.isdigit() else None
+            elif length is not None and length.isdigit():
+                self._total = int(length)
+            if self._total is not None:
+                segment.end = self._total
+
+            self._resumable = partial or \
+                headers.get('Accept-Ranges') == 'bytes'
+
+        return response
+
+    def _truncate_partial(self, segments):
+        """Drop the data after the first missing byte, the segments are
+        written in parallel and resuming continues at the end of the
+        file"""
+        if len(segments) < 2:
+            return
+        for segment in segments:
+            end = segment.position
+            if segment.position < segment.end:
+                break
+        with self._lock:
+            if self._outf is not None:
+                os.ftruncate(self._outf, end)
+
+    def _restart(self, segment):
+        """Download the file again from the beginning"""
+        with self._lock:
+            if self._outf is None:
+                raise _Cancelled()
+            os.ftruncate(self._outf, 0)
+            self._written = 0
+        segment.position = 0
+
+    def _split(self, segment):
+        """Split the remaining bytes in segments downloaded in parallel,
+        the first one being segment itself"""
+        if self._connections == 1 or not self._resumable or \
+                segment.end is None:
+            return [segment]
+
+        remaining = segment.end - segment.position
+        count = min(self._connections, remaining // self.MIN_SEGMENT_SIZE)
+        if count < 2:
+            return [segment]
+
+        size = remaining // count
+        segments = [segment]
+        end = segment.end
+        segment.end = segment.position + size
+        for i in range(1, count):
+            position = segments[-1].end
+            segments.append(_Segment(position,
+                                     position + size if i < count - 1
+                                     else end))
+        return segments
+
+    def _fetch_segment(self, segment, response, errors):
+        retries = 0
+        try:
+            while True:
+                try:
+                    if response is None:
+                        response = self._open(segment)
+                    self._copy(response, segment)
+                    return
+                except (IOError, socket.error, httplib.HTTPException), err:
+                    if response is not None:
+                        response.close()
+                        response = None
+                    if self._stop.is_set():
+                        raise _Cancelled()
+                    if not self._resumable or \
+                            isinstance(err, urllib2.HTTPError) or \
+                            retries >= self.MAX_RETRIES:
+                        raise
+
+                    delay = min(2 ** retries, self.MAX_RETRY_DELAY)
+                    retries += 1
+                    logging.debug('Download of %s interrupted at %d: %r, '
+                                  'retrying in %d seconds', self._url,
+                                  segment.position, err, delay)
+                    if self._stop.wait(delay):
+                        raise _Cancelled()
+        except _Cancelled:
+            pass
+        except Exception, err:
+            errors.append(err)
+            # Stop the other segments
+            self._stop.set()
+        finally:
+            if response is not None:
+                response.close()
+
+    def _copy(self, response, segment):
+        while segment.end is None or segment.position < segment.end:
+            size = self._buffer_size
+            if segment.end is not None:
+                size = min(size, segment.end - segment.position)
+
+            data = response.read(size)
+            if not data:
+                if segment.end is not None:
+                    raise _Interrupted('Connection closed at %d of %d' %
+                                       (segment.position, segment.end))
+                return
+
+            self._write(segment.position, data)
+            segment.position += len(data)
+
+    def _write(self, position, data):
+        with self._lock:
+            if self._stop.is_set() or self._outf is None:
+                raise _Cancelled()
+            os.lseek(self._outf, position, os.SEEK_SET)
+            while data:
+                count = os.write(self._outf, data)
+                data = data[count:]
+                self._written += count
+
+    def _verify_checksum(self):
+        algorithm, digest = self._checksum
+        checksum = hashlib.new(algorithm)
+        with open(self._fname, 'rb') as downloaded:
+            while True:
+                data = downloaded.read(self._buffer_size)
+                if not data:
+                    break
+                checksum.update(data)
+        if checksum.hexdigest() != digest:
+            raise _ChecksumMismatch('Checksum mismatch, %s expected %s, '
+                                    'got %s' % (algorithm, digest,
+                                                checksum.hexdigest()))
+
+    def _get_progress(self):
+        now = time.time()
+        written = self._written
+        elapsed = now - self._progress_time
+        if elapsed > 0:
+            rate = (written - self._progress_written) / elapsed
+            # Smooth the rate, the reads arrive in bursts
+            if self._rate:
+                rate = 0.3 * rate + 0.7 * self._rate
+            self._rate = rate
+        self._progress_time = now
+        self._progress_written = written
+
+        eta = None
+        if self._total is not None and self._rate > 0:
+            eta = max(self._total - written, 0) / self._rate
+        return DownloadProgress(written, self._total, self._rate, eta)
+
+    def __progress_cb(self):
+        if self._written != self._progress_written:
+            self.emit('progress', self._get_progress())
         return True
 
+    def __finished_cb(self):
+        if not self._running:
+            return False
+        self.emit('progress', self._get_progress())
+        self.cleanup()
+        self.emit('finished', self._fname, self._suggested_fname)
+        return False
+
+    def __error_cb(self, message, remove):
+        if not self._running:
+            return False
+        self.cleanup(remove=remove)
+        self.emit('error', message)
+        return False
+
     def cleanup(self, remove=False):
-        if self._srcid > 0:
-            GObject.source_remove(self._srcid)
-            self._srcid = 0
-        del self._info
-        self._info = None
-        os.close(self._outf)
+        self._running = False
+        if self._progress_id > 0:
+            GObject.source_remove(self._progress_id)
+            self._progress_id = 0
+        with self._lock:
+            self._stop.set()
+            if self._outf is not None:
+                os.close(self._outf)
+                self._outf = None
         if remove:
             os.remove(self._fname)
-        self._outf = None
@@ -0,0 +1,360 @@
+# Copyright (C) 2016, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Benchmark the sugar3.graphics.icon rendering pipeline.
+
+The icons of tests/data and a set of generated SVG icons of growing
+complexity are rendered into offscreen cairo surfaces, plain, coloured,
+with a badge and insensitive:
+
+* cold: the memory and disk caches are emptied before every round
+* disk: only the memory caches are emptied, the surfaces come from disk
+* warm: the surfaces come from the memory cache
+
+The badge variant needs the icon theme, so it is only measured when a
+display is available, as are the Icon.do_draw, EventIcon.do_draw and
+CellRendererIcon.do_render methods, drawing into an offscreen surface.
+
+For each case the latency per icon, the throughput, the hit rates of
+the icon caches and the number of objects left allocated are reported.
+The results can be saved as JSON and compared with a previous run:
+
+    python iconbenchmark.py --output before.json
+    (upgrade)
+    python iconbenchmark.py --compare before.json
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import timeit
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+
+# Keep the disk cache away from the profile, so that it can be emptied
+_cache_dir = tempfile.mkdtemp(prefix='iconbenchmark-')
+os.environ['SUGAR_ICON_CACHE_DIR'] = _cache_dir
+
+from gi.repository import Gtk
+from gi.repository import Gdk
+import cairo
+
+from sugar3.graphics import icon
+from sugar3.graphics import style
+from sugar3.graphics.xocolor import XoColor
+
+_RESULTS_VERSION = 1
+
+_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, 'data')
+
+_DATA_ICONS = [os.path.join(_DATA_DIR, 'mime.svg'),
+               os.path.join(_DATA_DIR, 'sample.activity', 'activity',
+                            'activity-sample.svg')]
+
+# Number of shapes of the generated icons
+_SYNTHETIC_SHAPES = [1, 10, 50, 200]
+
+_XO_COLOR = XoColor('#FF8F00,#FF2B34')
+
+_VARIANTS = [
+    ('plain', {}, True),
+    ('colored', {'fill_color': _XO_COLOR.get_fill_color(),
+                 'stroke_color': _XO_COLOR.get_stroke_color()}, True),
+    ('badge', {'badge_name': 'emblem-favorite'}, True),
+    ('insensitive', {}, False),
+]
+
+_SVG_HEADER = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN"
+  "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd" [
+  <!ENTITY stroke_color "#010101">
+  <!ENTITY fill_color "#FFFFFF">
+]>
+<svg xmlns="http://www.w3.org/2000/svg" width="55" height="55">
+'''
+
+
+def _write_synthetic_icon(path, shapes):
+    with open(path, 'w') as f:
+        f.write(_SVG_HEADER)
+        for i in range(shapes):
+            x = 5 + (i * 7) % 45
+            y = 5 + (i * 13) % 45
+            f.write('<circle cx="%d" cy="%d" r="%d" fill="&fill_color;" '
+                    'stroke="&stroke_color;" stroke-width="1.5"/>\n' %
+                    (x, y, 3 + i % 5))
+        f.write('</svg>\n')
+
+
+def _get_icon_files(temp_dir):
+    file_names = list(_DATA_ICONS)
+    for shapes in _SYNTHETIC_SHAPES:
+        path = os.path.join(temp_dir, 'synthetic-%d.svg' % shapes)
+        _write_synthetic_icon(path, shapes)
+        file_names.append(path)
+    return file_names
+
+
+def _empty_memory_caches():
+    icon.flush_cache()
+
+
+def _empty_all_caches():
+    icon.flush_cache()
+    for name in os.listdir(_cache_dir):
+        shutil.rmtree(os.path.join(_cache_dir, name))
+
+
+def _get_hit_rate(before, after):
+    hits = after['hits'] - before['hits']
+    misses = after['misses'] - before['misses']
+    if hits + misses == 0:
+        return None
+    return float(hits) / (hits + misses)
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def _measure(prepare, run, count, rounds):
+    """Call prepare() then run(), which draws count icons, rounds times.
+    Returns a dict of statistics, latencies are in milliseconds per icon.
+    """
+    # Warm up the code paths, eg. imports and theme lookups
+    prepare()
+    run()
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    stats_before = icon.get_cache_stats()
+
+    latencies = []
+    total = 0.0
+    for i in range(rounds):
+        prepare()
+        start = timeit.default_timer()
+        run()
+        elapsed = timeit.default_timer() - start
+        total += elapsed
+        latencies.append(elapsed * 1000.0 / count)
+
+    stats_after = icon.get_cache_stats()
+    gc.collect()
+
+    return {
+        'rounds': rounds,
+        'icons': count,
+        'min_ms': min(latencies),
+        'median_ms': _percentile(latencies, 50),
+        'p95_ms': _percentile(latencies, 95),
+        'max_ms': max(latencies),
+        'icons_per_second': count * rounds / total if total else None,
+        'surface_hit_rate': _get_hit_rate(stats_before['surfaces'],
+                                          stats_after['surfaces']),
+        'svg_hit_rate': _get_hit_rate(stats_before['svg'],
+                                      stats_after['svg']),
+        'handle_hit_rate': _get_hit_rate(stats_before['handles'],
+                                         stats_after['handles']),
+        'allocated_objects': len(gc.get_objects()) - objects_before,
+    }
+
+
+def _run_buffer_cases(file_names, rounds, has_display):
+    results = {}
+
+    for variant, properties, sensitive in _VARIANTS:
+        if 'badge_name' in properties and not has_display:
+            continue
+
+        buffers = []
+        for file_name in file_names:
+            icon_buffer = icon._IconBuffer()
+            icon_buffer.file_name = file_name
+            icon_buffer.width = style.STANDARD_ICON_SIZE
+            icon_buffer.height = style.STANDARD_ICON_SIZE
+            for key, value in properties.items():
+                setattr(icon_buffer, key, value)
+            buffers.append(icon_buffer)
+
+        def run():
+            for icon_buffer in buffers:
+                icon_buffer.get_surface(sensitive, block=True)
+
+        for case, prepare in (('cold', _empty_all_caches),
+                              ('disk', _empty_memory_caches),
+                              ('warm', lambda: None)):
+            name = 'buffer.%s.%s' % (variant, case)
+            results[name] = _measure(prepare, run, len(buffers), rounds)
+
+    # The public function builds a new buffer on every call
+    def run_get_surface():
+        for file_name in file_names:
+            icon.get_surface(file_name=file_name,
+                             width=style.STANDARD_ICON_SIZE,
+                             height=style.STANDARD_ICON_SIZE)
+
+    results['get_surface.warm'] = _measure(lambda: None, run_get_surface,
+                                           len(file_names), rounds)
+    return results
+
+
+def _run_widget_cases(file_names, rounds):
+    results = {}
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 200, 200)
+    window = Gtk.OffscreenWindow()
+    box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+    window.add(box)
+
+    icons = []
+    event_icons = []
+    for file_name in file_names:
+        icon_widget = icon.Icon(file=file_name,
+                                pixel_size=style.STANDARD_ICON_SIZE,
+                                xo_color=_XO_COLOR)
+        box.pack_start(icon_widget, False, False, 0)
+        icons.append(icon_widget)
+
+        event_icon = icon.EventIcon(file_name=file_name,
+                                    pixel_size=style.STANDARD_ICON_SIZE,
+                                    xo_color=_XO_COLOR)
+        box.pack_start(event_icon, False, False, 0)
+        event_icons.append(event_icon)
+
+    store = Gtk.ListStore(str)
+    for file_name in file_names:
+        store.append([file_name])
+    tree_view = Gtk.TreeView(model=store)
+    cell_renderer = icon.CellRendererIcon()
+    cell_renderer.props.size = style.STANDARD_ICON_SIZE
+    cell_renderer.props.xo_color = _XO_COLOR
+    column = Gtk.TreeViewColumn()
+    column.pack_start(cell_renderer, True)
+    tree_view.append_column(column)
+    box.pack_start(tree_view, False, False, 0)
+
+    window.show_all()
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+    def draw(widgets):
+        def run():
+            for widget in widgets:
+                cr = cairo.Context(surface)
+                widget.do_draw(cr)
+        return run
+
+    cell_area = Gdk.Rectangle()
+    cell_area.x = cell_area.y = 0
+    cell_area.width = cell_area.height = style.STANDARD_ICON_SIZE
+
+    def render_cells():
+        for file_name in file_names:
+            cell_renderer.props.file_name = file_name
+            cr = cairo.Context(surface)
+            cell_renderer.do_render(cr, tree_view, cell_area, cell_area, 0)
+
+    for name, run in (('Icon.do_draw', draw(icons)),
+                      ('EventIcon.do_draw', draw(event_icons)),
+                      ('CellRendererIcon.do_render', render_cells)):
+        results[name + '.cold'] = _measure(_empty_all_caches, run,
+                                           len(file_names), rounds)
+        results[name + '.warm'] = _measure(lambda: None, run,
+                                           len(file_names), rounds)
+
+    window.destroy()
+    return results
+
+
+def _compare(results, baseline):
+    print
+    print '%-40s %12s %12s %8s' % ('case', 'median ms', 'baseline', 'change')
+    for name in sorted(results):
+        median = results[name]['median_ms']
+        if name not in baseline:
+            print '%-40s %12.4f %12s %8s' % (name, median, '-', '-')
+            continue
+
+        old_median = baseline[name]['median_ms']
+        change = ''
+        if old_median:
+            change = '%+.1f%%' % ((median - old_median) * 100.0 / old_median)
+        print '%-40s %12.4f %12.4f %8s' % (name, median, old_median, change)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the icon rendering pipeline.')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='number of rounds of each case')
+    parser.add_argument('--output', help='save the results to this file')
+    parser.add_argument('--compare',
+                        help='compare with the results saved in this file')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix='iconbenchmark-')
+    try:
+        file_names = _get_icon_files(temp_dir)
+
+        has_display = Gtk.init_check(sys.argv)[0]
+        results = _run_buffer_cases(file_names, args.rounds, has_display)
+        if has_display:
+            results.update(_run_widget_cases(file_names, args.rounds))
+    finally:
+        shutil.rmtree(temp_dir)
+        shutil.rmtree(_cache_dir)
+
+    for name in sorted(results):
+        result = results[name]
+        print '%-40s %10.4f ms %10.1f icons/s  surface hits %s' % (
+            name, result['median_ms'], result['icons_per_second'] or 0,
+            result['surface_hit_rate'])
+    if not has_display:
+        print 'No display, the badge and widget cases were skipped'
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'version': _RESULTS_VERSION,
+                       'time': time.time(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'max_rss_kb': resource.getrusage(
+                           resource.RUSAGE_SELF).ru_maxrss,
+                       'results': results}, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != _RESULTS_VERSION:
+            print 'Cannot compare with results of version %s' % \
+                baseline.get('version')
+        else:
+            _compare(results, baseline['results'])
+
+
+if __name__ == '__main__':
+    main()
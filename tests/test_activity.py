@@ -0,0 +1,336 @@
+# Copyright (C) 2016, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import time
+import functools
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from gi.repository import GLib
+from gi.repository import Gtk
+
+from sugar3.activity import activity
+from sugar3.datastore import datastore
+from sugar3.graphics.window import Window
+
+# Only imported when first used, see sugar3.activity.activity
+_DEFERRED_MODULES = ['telepathy',
+                     'sugar3.presence',
+                     'sugar3.datastore',
+                     'sugar3.graphics.alert',
+                     'sugar3.power',
+                     'sugar3.bundle.helpers']
+
+_IMPORT_SCRIPT = '''
+import sys
+import sugar3.activity.activity
+for name, module in sys.modules.items():
+    if module is not None:
+        print name
+'''
+
+
+class TestActivity(unittest.TestCase):
+
+    def test_import_is_minimal(self):
+        # Use a new interpreter, other tests may have loaded the modules
+        output = subprocess.check_output([sys.executable, '-c',
+                                          _IMPORT_SCRIPT])
+        modules = output.split()
+
+        for name in _DEFERRED_MODULES:
+            loaded = [module for module in modules
+                      if module == name or module.startswith(name + '.')]
+            self.assertEqual(loaded, [])
+
+
+class _JournalObject(object):
+
+    def __init__(self):
+        self.object_id = 'uid'
+        self.file_path = None
+        self.metadata = {'spent-times': '0'}
+
+    def destroy(self):
+        pass
+
+
+class _Session(object):
+
+    def __init__(self):
+        self.will_quit_calls = []
+
+    def will_quit(self, activity, will_quit):
+        self.will_quit_calls.append(will_quit)
+
+
+class _TestActivity(activity.Activity):
+    """The save and preview state of Activity, without a shell or a
+    datastore"""
+
+    def __init__(self):
+        Window.__init__(self)
+        self._init_save_state()
+        self._init_preview()
+        self._activity_id = 'activity'
+        self._jobject = _JournalObject()
+        self._session = _Session()
+        self.shared_activity = None
+        self._read_file_called = False
+        self.snapshot = None
+        self.write_error = None
+        self.closed = False
+        self.failed_dialogs = 0
+        self.renders = 0
+
+    def _render_canvas(self):
+        self.renders += 1
+        return activity.Activity._render_canvas(self)
+
+    def write_file(self, file_path):
+        if self.write_error is not None:
+            raise self.write_error
+
+    def get_save_snapshot(self):
+        return self.snapshot
+
+    def write_snapshot(self, snapshot, file_path):
+        raise IOError('disk full')
+
+    def _show_keep_failed_dialog(self):
+        self.failed_dialogs += 1
+
+    def _complete_close(self):
+        self.closed = True
+
+
+class TestSave(unittest.TestCase):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self._old_root = os.environ.get('SUGAR_ACTIVITY_ROOT')
+        os.environ['SUGAR_ACTIVITY_ROOT'] = self._root
+
+        self._writes = []
+        self._datastore_write = datastore.write
+        datastore.write = self._write_cb
+        self._activity = _TestActivity()
+
+    def tearDown(self):
+        datastore.write = self._datastore_write
+        if self._old_root is None:
+            del os.environ['SUGAR_ACTIVITY_ROOT']
+        else:
+            os.environ['SUGAR_ACTIVITY_ROOT'] = self._old_root
+        shutil.rmtree(self._root)
+
+    def _write_cb(self, jobject, transfer_ownership=False,
+                  reply_handler=None, error_handler=None):
+        self._writes.append((jobject.object_id, reply_handler,
+                             error_handler))
+
+    def _reply(self):
+        object_id_, reply_handler, error_handler = self._writes.pop(0)
+        reply_handler()
+
+    def _fail(self):
+        object_id_, reply_handler, error_handler = self._writes.pop(0)
+        self.assertRaises(RuntimeError, error_handler, IOError('failed'))
+
+    def test_coalesced_saves(self):
+        self._activity.save()
+        self._activity.save()
+        self._activity.save()
+        self.assertEqual(len(self._writes), 1)
+        self.assertTrue(self._activity._save_pending)
+
+        # The latest state is saved once the first save completes
+        self._reply()
+        self.assertEqual(len(self._writes), 1)
+        self._reply()
+        self.assertEqual(self._writes, [])
+
+        stats = self._activity.get_save_stats()
+        self.assertEqual((stats['requests'], stats['coalesced'],
+                          stats['saved']), (3, 1, 2))
+        self.assertFalse(self._activity._updating_jobject)
+
+    def test_pending_copy(self):
+        self._activity.save()
+        self._activity.copy()
+        self.assertEqual(self._activity._jobject.object_id, 'uid')
+        self._reply()
+
+        # Only the coalesced save is a copy
+        self.assertEqual(self._writes[0][0], 'uid')
+        self.assertIsNone(self._activity._jobject.object_id)
+        self.assertFalse(self._activity._copy_requested)
+
+    def test_close_waits(self):
+        self._activity.save()
+        self.assertTrue(self._activity._prepare_close())
+        self.assertEqual(len(self._writes), 1)
+
+        self._reply()
+        self.assertFalse(self._activity.closed)
+        self._reply()
+        self.assertTrue(self._activity.closed)
+
+    def test_failed_save_retried(self):
+        self._activity.save()
+        self._activity.save()
+
+        # The pending save may still succeed
+        self._fail()
+        self.assertEqual(len(self._writes), 1)
+        self._reply()
+
+        stats = self._activity.get_save_stats()
+        self.assertEqual((stats['saved'], stats['failed']), (1, 1))
+
+    def test_failed_retry(self):
+        self._activity.save()
+        self._activity.save()
+        self._activity.write_error = ValueError('cannot write')
+
+        # The error of the datastore is still raised
+        object_id_, reply_handler, error_handler = self._writes.pop(0)
+        try:
+            error_handler(IOError('failed'))
+        except RuntimeError as e:
+            self.assertIn('failed', str(e))
+        else:
+            self.fail('The error was not raised')
+
+        self.assertEqual(self._writes, [])
+        self.assertFalse(self._activity._save_pending)
+        self.assertFalse(self._activity._updating_jobject)
+
+    def test_failed_snapshot(self):
+        self._activity.snapshot = 'state'
+        self._activity._prepare_close()
+        self.assertTrue(self._activity._updating_jobject)
+
+        context = GLib.MainContext.default()
+        while self._activity._updating_jobject:
+            context.iteration(True)
+
+        self.assertEqual(self._writes, [])
+        self.assertEqual(self._activity.failed_dialogs, 1)
+        self.assertFalse(self._activity._closing)
+        self.assertEqual(self._activity.get_save_stats()['failed'], 1)
+
+
+def _decorated(func):
+    @functools.wraps(func)
+    def wrapper(*args):
+        return func(*args)
+    return wrapper
+
+
+class _DecoratedActivity(_TestActivity):
+
+    @_decorated
+    def get_preview(self):
+        return 'decorated'
+
+
+class _PreviewMixin(object):
+
+    def get_preview(self):
+        return 'mixin'
+
+
+class _MixinActivity(_PreviewMixin, _TestActivity):
+    pass
+
+
+class TestPreview(unittest.TestCase):
+
+    def _show(self, test_activity):
+        canvas = Gtk.DrawingArea()
+        canvas.set_size_request(400, 300)
+        test_activity.set_canvas(canvas)
+        test_activity.show_all()
+        self.addCleanup(test_activity.destroy)
+        self._iterate_until(canvas.get_mapped)
+        return canvas
+
+    def _iterate_until(self, condition, timeout=10):
+        context = GLib.MainContext.default()
+        end = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), end, 'Timed out')
+            context.iteration(False)
+            time.sleep(0.01)
+        while context.pending():
+            context.iteration(False)
+
+    def test_png(self):
+        test_activity = _TestActivity()
+        self._show(test_activity)
+        self.assertEqual(test_activity.get_preview_format(),
+                         (activity.PREVIEW_FORMAT_PNG, None))
+        self.assertTrue(test_activity.get_preview().startswith('\x89PNG'))
+
+        test_activity.set_preview_format(activity.PREVIEW_FORMAT_PNG, 1)
+        self.assertTrue(
+            test_activity._start_preview()().startswith('\x89PNG'))
+
+    def test_jpeg(self):
+        test_activity = _TestActivity()
+        self._show(test_activity)
+        test_activity.set_preview_format(activity.PREVIEW_FORMAT_JPEG, 50)
+        self.assertEqual(test_activity.get_preview_format(),
+                         (activity.PREVIEW_FORMAT_JPEG, 50))
+        self.assertTrue(
+            test_activity._start_preview()().startswith('\xff\xd8'))
+
+        self.assertRaises(ValueError, test_activity.set_preview_format,
+                          'gif')
+
+    def test_not_damaged(self):
+        test_activity = _TestActivity()
+        canvas = self._show(test_activity)
+        preview = test_activity._start_preview()()
+        self.assertIsNotNone(preview)
+        self.assertEqual(test_activity.renders, 1)
+
+        # Nothing was drawn since the last preview
+        self.assertIs(test_activity._start_preview()(), preview)
+        self.assertIs(test_activity.get_preview(), preview)
+        self.assertEqual(test_activity.renders, 1)
+
+        canvas.queue_draw()
+        self._iterate_until(lambda: test_activity._preview_damaged)
+        self.assertIsNotNone(test_activity._start_preview()())
+        self.assertEqual(test_activity.renders, 2)
+
+        # The preview is encoded again in the new format
+        test_activity.set_preview_format(activity.PREVIEW_FORMAT_JPEG)
+        test_activity._start_preview()()
+        self.assertEqual(test_activity.renders, 3)
+
+    def test_overridden(self):
+        for test_activity, preview in [(_DecoratedActivity(), 'decorated'),
+                                       (_MixinActivity(), 'mixin')]:
+            self._show(test_activity)
+            self.assertEqual(test_activity._start_preview()(), preview)
+            self.assertEqual(test_activity.renders, 0)
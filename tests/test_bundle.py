@@ -15,12 +15,19 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import stat
+import shutil
 import unittest
+import warnings
 import subprocess
+import tempfile
+import zipfile
 
 from sugar3.bundle.helpers import bundle_from_dir, bundle_from_archive
 from sugar3.bundle.activitybundle import ActivityBundle
 from sugar3.bundle.contentbundle import ContentBundle
+from sugar3.bundle.bundleindex import BundleIndex
+from sugar3.bundle.bundle import Bundle, ZipExtractException
 
 tests_dir = os.path.dirname(__file__)
 data_dir = os.path.join(tests_dir, "data")
@@ -47,3 +54,197 @@ class TestBundle(unittest.TestCase):
         subprocess.check_call(["zip", "-r", "sample-1.xol", "sample.content"])
         bundle = bundle_from_archive("./sample-1.xol")
         self.assertIsInstance(bundle, ContentBundle)
+
+    def test_bundle_index(self):
+        index_path = os.path.join(tempfile.mkdtemp(), 'bundle-index')
+
+        index = BundleIndex(index_path)
+        bundle = index.get_bundle(SAMPLE_ACTIVITY_PATH)
+        self.assertEqual(bundle.get_bundle_id(), 'org.sugarlabs.Sample')
+        index.save()
+        self.assertTrue(os.path.exists(index_path))
+
+        index = BundleIndex(index_path)
+        index.load()
+        bundles = index.get_bundles([SAMPLE_ACTIVITY_PATH])
+        self.assertEqual(len(bundles), 1)
+        self.assertEqual(bundles[0].get_metadata(), bundle.get_metadata())
+        self.assertEqual(bundles[0].get_path(), SAMPLE_ACTIVITY_PATH)
+
+    def test_zipped_bundle_index(self):
+        xo_path = os.path.join(tempfile.mkdtemp(), 'Sample-1.xo')
+        with zipfile.ZipFile(xo_path, 'w') as xo_file:
+            for root, dirs, files in os.walk(SAMPLE_ACTIVITY_PATH):
+                for name in files:
+                    path = os.path.join(root, name)
+                    arcname = os.path.relpath(path, data_dir)
+                    xo_file.write(path, arcname)
+
+        bundle = ActivityBundle(xo_path)
+        self.assertTrue(bundle.is_dir('activity'))
+        self.assertTrue(bundle.is_dir('po/'))
+        self.assertFalse(bundle.is_dir('activity/activity.info'))
+        self.assertTrue(bundle.is_file('activity/activity.info'))
+        self.assertFalse(bundle.is_file('activity'))
+        self.assertItemsEqual(bundle.listdir('po'), ['Sample.pot', 'es.po'])
+
+        info_file = bundle.open_file('activity/activity.info')
+        self.assertEqual(info_file.readline().strip(), '[Activity]')
+        self.assertIsNone(bundle.open_file('activity/missing'))
+
+        index = BundleIndex(os.path.join(os.path.dirname(xo_path),
+                                         'bundle-index'))
+        index.get_bundle(xo_path)
+        bundle = index.get_bundle(xo_path)
+        # Restored from the index, without opening the zip file
+        self.assertIsNone(bundle._opened_zip_file)
+        self.assertEqual(bundle.get_installation_time(),
+                         os.stat(xo_path).st_mtime)
+        self.assertTrue(bundle.is_file('activity/activity.info'))
+
+    def test_translated_bundle_index(self):
+        bundle_path = os.path.join(tempfile.mkdtemp(), 'sample.activity')
+        shutil.copytree(SAMPLE_ACTIVITY_PATH, bundle_path)
+        linfo_path = os.path.join(bundle_path, 'locale', 'es',
+                                  'activity.linfo')
+
+        def write_linfo(name, mtime):
+            with open(linfo_path, 'w') as linfo_file:
+                linfo_file.write('[Activity]\nname = %s\n' % name)
+            os.utime(linfo_path, (mtime, mtime))
+
+        old_language = os.environ.get('LANGUAGE')
+        os.environ['LANGUAGE'] = 'es'
+        try:
+            index = BundleIndex(os.path.join(bundle_path, 'bundle-index'))
+            write_linfo('Muestra', 1000)
+            self.assertEqual(index.get_bundle(bundle_path).get_name(),
+                             'Muestra')
+
+            write_linfo('Ejemplo', 2000)
+            self.assertEqual(index.get_bundle(bundle_path).get_name(),
+                             'Ejemplo')
+        finally:
+            if old_language is None:
+                del os.environ['LANGUAGE']
+            else:
+                os.environ['LANGUAGE'] = old_language
+
+
+def _add_member(xo_file, name, data='', mode=0644):
+    info = zipfile.ZipInfo(name)
+    info.external_attr = mode << 16
+    xo_file.writestr(info, data)
+
+
+def _add_link(xo_file, name, target):
+    _add_member(xo_file, name, target, stat.S_IFLNK | 0777)
+
+
+class TestUnzip(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._install_dir = os.path.join(self._temp_dir, 'install')
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _make_bundle(self, add_members):
+        path = os.path.join(self._temp_dir, 'Test-1.xo')
+        with zipfile.ZipFile(path, 'w') as xo_file:
+            _add_member(xo_file, 'Test.activity/', mode=stat.S_IFDIR | 0755)
+            add_members(xo_file)
+        return Bundle(path)
+
+    def test_unzip(self):
+        def add_members(xo_file):
+            _add_member(xo_file, 'Test.activity/run', '#!/bin/sh\n', 0755)
+            _add_member(xo_file, 'Test.activity/data/a', 'a' * 1000)
+            _add_member(xo_file, 'Test.activity/data/b', 'b' * 3000, 0600)
+            _add_link(xo_file, 'Test.activity/link', 'data/a')
+
+        progress = []
+        bundle = self._make_bundle(add_members)
+        bundle._unzip(self._install_dir,
+                      lambda done, total: progress.append((done, total)))
+
+        install_path = os.path.join(self._install_dir, 'Test.activity')
+        run_path = os.path.join(install_path, 'run')
+        self.assertEqual(stat.S_IMODE(os.stat(run_path).st_mode), 0755)
+        b_path = os.path.join(install_path, 'data', 'b')
+        self.assertEqual(stat.S_IMODE(os.stat(b_path).st_mode), 0600)
+        with open(os.path.join(install_path, 'link')) as link_file:
+            self.assertEqual(link_file.read(), 'a' * 1000)
+
+        self.assertEqual(len(progress), 4)
+        self.assertEqual(progress[-1], (4016, 4016))
+        self.assertEqual(progress, sorted(progress))
+
+        # The temporary directory is removed
+        self.assertEqual(os.listdir(self._install_dir), ['Test.activity'])
+
+    def test_replace(self):
+        install_path = os.path.join(self._install_dir, 'Test.activity')
+        os.makedirs(install_path)
+        with open(os.path.join(install_path, 'old'), 'w') as old_file:
+            old_file.write('old')
+
+        bundle = self._make_bundle(
+            lambda xo_file: _add_member(xo_file, 'Test.activity/new', 'new'))
+        bundle._unzip(self._install_dir)
+        # Replaced, the files of the previous version are not kept
+        self.assertEqual(os.listdir(install_path), ['new'])
+
+        # A failed extraction keeps the installed version
+        bundle = self._make_bundle(
+            lambda xo_file: _add_link(xo_file, 'Test.activity/new', '..'))
+        self.assertRaises(ZipExtractException, bundle._unzip,
+                          self._install_dir)
+        self.assertEqual(os.listdir(install_path), ['new'])
+        self.assertEqual(os.listdir(self._install_dir), ['Test.activity'])
+
+    def _assert_rejected(self, add_members):
+        bundle = self._make_bundle(add_members)
+        self.assertRaises(ZipExtractException, bundle._unzip,
+                          self._install_dir)
+        self.assertFalse(os.path.exists(os.path.join(self._temp_dir,
+                                                     'escaped')))
+
+    def test_traversal(self):
+        self._assert_rejected(
+            lambda xo_file: _add_member(
+                xo_file, 'Test.activity/../escaped', 'x'))
+
+    def test_absolute_link(self):
+        self._assert_rejected(
+            lambda xo_file: _add_link(
+                xo_file, 'Test.activity/link',
+                os.path.join(self._temp_dir, 'escaped')))
+
+    def test_outer_link(self):
+        self._assert_rejected(
+            lambda xo_file: _add_link(
+                xo_file, 'Test.activity/link', '../../escaped'))
+
+    def test_chained_links(self):
+        def add_members(xo_file):
+            _add_member(xo_file, 'Test.activity/sub/', mode=stat.S_IFDIR)
+            _add_link(xo_file, 'Test.activity/sub/up', '..')
+            _add_link(xo_file, 'Test.activity/link', 'sub/up/..')
+        self._assert_rejected(add_members)
+
+    def test_duplicate_link(self):
+        def add_members(xo_file):
+            _add_link(xo_file, 'Test.activity/link', '.')
+            _add_member(xo_file, 'Test.activity/link', 'x')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self._assert_rejected(add_members)
+
+    def test_unreadable_archive(self):
+        bundle = self._make_bundle(
+            lambda xo_file: _add_member(xo_file, 'Test.activity/a', 'a'))
+        # The workers open the archive again
+        os.unlink(bundle.get_path())
+        self.assertRaises(ZipExtractException, bundle._unzip,
+                          self._install_dir)
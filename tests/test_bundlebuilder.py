@@ -21,6 +21,10 @@ import subprocess
 import tempfile
 import tarfile
 import zipfile
+import zlib
+import StringIO
+
+from sugar3.activity import bundlebuilder
 
 tests_dir = os.path.dirname(__file__)
 data_dir = os.path.join(tests_dir, "data")
@@ -92,6 +96,72 @@ class TestGit(unittest.TestCase):
 
         os.chdir(cwd)
 
+    def _test_dist_xo_incremental(self, source_path, build_path):
+        cwd = os.getcwd()
+        os.chdir(build_path)
+
+        setup_path = os.path.join(source_path, "setup.py")
+        subprocess.call([setup_path, "dist_xo", "--incremental"])
+
+        # Store the entries of the first bundle uncompressed, the reused
+        # ones are copied as they are
+        xo_path = os.path.join(build_path, "dist", "Sample-1.xo")
+        with zipfile.ZipFile(xo_path) as bundle_zip:
+            entries = [(info, bundle_zip.read(info))
+                       for info in bundle_zip.infolist()]
+        with zipfile.ZipFile(xo_path, "w", zipfile.ZIP_STORED) as bundle_zip:
+            for info, data in entries:
+                info.compress_type = zipfile.ZIP_STORED
+                bundle_zip.writestr(info, data)
+
+        activity_path = os.path.join(source_path, "activity.py")
+        with open(activity_path, "a") as f:
+            f.write("# Changed\n")
+        subprocess.call([setup_path, "dist_xo", "--incremental"])
+
+        bundle_zip = zipfile.ZipFile(xo_path)
+        self.assertIsNone(bundle_zip.testzip())
+
+        for info in bundle_zip.infolist():
+            if info.filename == "Sample.activity/activity.py":
+                self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            else:
+                self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+        stripped_filenames = self._strip_root_dir(bundle_zip.namelist())
+        expected = self._source_files[:]
+        expected.extend(self._get_all_locale_files())
+        self.assertItemsEqual(stripped_filenames, expected)
+
+        for name in self._source_files:
+            with open(os.path.join(source_path, name)) as f:
+                self.assertEqual(
+                    bundle_zip.read(os.path.join("Sample.activity", name)),
+                    f.read())
+
+        os.chdir(cwd)
+
+    def _test_dist_xo_reproducible(self, source_path, build_path):
+        cwd = os.getcwd()
+        os.chdir(build_path)
+
+        env = os.environ.copy()
+        env["SOURCE_DATE_EPOCH"] = "1500000000"
+
+        setup_path = os.path.join(source_path, "setup.py")
+        xo_path = os.path.join(build_path, "dist", "Sample-1.xo")
+
+        subprocess.call([setup_path, "dist_xo"], env=env)
+        with open(xo_path, "rb") as f:
+            first = f.read()
+
+        os.utime(os.path.join(source_path, "activity.py"), None)
+        subprocess.call([setup_path, "dist_xo", "--jobs", "3"], env=env)
+        with open(xo_path, "rb") as f:
+            self.assertEqual(f.read(), first)
+
+        os.chdir(cwd)
+
     def _test_dist_source(self, source_path, build_path):
         cwd = os.getcwd()
         os.chdir(build_path)
@@ -107,12 +177,12 @@ class TestGit(unittest.TestCase):
 
         os.chdir(cwd)
 
-    def _test_build(self, source_path, build_path):
+    def _test_build(self, source_path, build_path, args=None):
         cwd = os.getcwd()
         os.chdir(build_path)
 
         setup_path = os.path.join(source_path, "setup.py")
-        subprocess.call([setup_path, "build"])
+        subprocess.call([setup_path, "build"] + (args or []))
 
         locale_path = os.path.join(build_path, "locale")
 
@@ -199,6 +269,16 @@ class TestGit(unittest.TestCase):
         build_path = tempfile.mkdtemp()
         self._test_dist_xo(repo_path, build_path)
 
+    def test_dist_xo_incremental(self):
+        repo_path = self._create_repo()
+        build_path = tempfile.mkdtemp()
+        self._test_dist_xo_incremental(repo_path, build_path)
+
+    def test_dist_xo_reproducible(self):
+        repo_path = self._create_repo()
+        build_path = tempfile.mkdtemp()
+        self._test_dist_xo_reproducible(repo_path, build_path)
+
     def test_dist_source_in_source(self):
         repo_path = self._create_repo()
         self._test_dist_source(repo_path, repo_path)
@@ -226,6 +306,11 @@ class TestGit(unittest.TestCase):
         build_path = tempfile.mkdtemp()
         self._test_build(repo_path, build_path)
 
+    def test_build_builtin_msgfmt(self):
+        repo_path = self._create_repo()
+        build_path = tempfile.mkdtemp()
+        self._test_build(repo_path, build_path, ["--builtin-msgfmt"])
+
     def test_dev_in_source(self):
         repo_path = self._create_repo()
         self._test_genpot(repo_path, repo_path)
@@ -243,3 +328,84 @@ class TestGit(unittest.TestCase):
         repo_path = self._create_repo()
         build_path = tempfile.mkdtemp()
         self._test_genpot(repo_path, build_path)
+
+
+class TestZipWriter(unittest.TestCase):
+
+    def test_write(self):
+        path = os.path.join(tempfile.mkdtemp(), "test.zip")
+        writer = bundlebuilder._ZipWriter(path)
+        for name, compress_type in [("stored", zipfile.ZIP_STORED),
+                                    (u"deflated-\xf1", zipfile.ZIP_DEFLATED)]:
+            data = name.encode("utf-8") * 100
+            info = zipfile.ZipInfo(name, (2016, 1, 2, 3, 4, 6))
+            info.external_attr = 0644 << 16L
+            info.compress_type = compress_type
+            info.CRC = zlib.crc32(data) & 0xffffffff
+            info.file_size = len(data)
+            if compress_type == zipfile.ZIP_DEFLATED:
+                compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+                data = compressor.compress(data) + compressor.flush()
+            info.compress_size = len(data)
+            writer.write(info, StringIO.StringIO(data))
+        writer.close()
+
+        with zipfile.ZipFile(path) as bundle_zip:
+            self.assertIsNone(bundle_zip.testzip())
+            self.assertEqual(bundle_zip.namelist(),
+                             ["stored", u"deflated-\xf1"])
+            info = bundle_zip.getinfo(u"deflated-\xf1")
+            self.assertEqual(info.date_time, (2016, 1, 2, 3, 4, 6))
+            self.assertEqual(info.external_attr >> 16, 0644)
+            self.assertEqual(bundle_zip.read("stored"), "stored" * 100)
+
+            # Read back as the incremental builds do
+            with open(path, "rb") as f:
+                f.seek(bundlebuilder._find_zip_data(f, info))
+                data = f.read(info.compress_size)
+            self.assertEqual(zlib.decompress(data, -15),
+                             u"deflated-\xf1".encode("utf-8") * 100)
+
+    def _get_info(self, name, data):
+        info = zipfile.ZipInfo(name, (2016, 1, 2, 3, 4, 6))
+        info.compress_type = zipfile.ZIP_STORED
+        info.CRC = zlib.crc32(data) & 0xffffffff
+        info.file_size = info.compress_size = len(data)
+        return info
+
+    def test_write_chunks(self):
+        path = os.path.join(tempfile.mkdtemp(), "test.zip")
+        data = os.urandom(bundlebuilder._ZIP_CHUNK_SIZE * 3 + 1)
+        writer = bundlebuilder._ZipWriter(path)
+        writer.write(self._get_info("large", data),
+                     StringIO.StringIO(data + "trailing"))
+        writer.close()
+
+        with zipfile.ZipFile(path) as bundle_zip:
+            self.assertIsNone(bundle_zip.testzip())
+            self.assertEqual(bundle_zip.read("large"), data)
+
+    def test_write_short_data(self):
+        path = os.path.join(tempfile.mkdtemp(), "test.zip")
+        writer = bundlebuilder._ZipWriter(path)
+        info = self._get_info("short", "data")
+        self.assertRaises(IOError, writer.write, info,
+                          StringIO.StringIO("dat"))
+        writer.close()
+
+
+class TestPoString(unittest.TestCase):
+
+    def _parse(self, line):
+        return bundlebuilder._parse_po_string(line, 'es.po', 1)
+
+    def test_escapes(self):
+        self.assertEqual(self._parse(r'"a\"b\\c\n\t"'), 'a"b\\c\n\t')
+        self.assertEqual(self._parse(r'"\101\x42\0"'), 'AB\0')
+        self.assertEqual(self._parse('"\xc3\xb1"'), '\xc3\xb1')
+        self.assertEqual(self._parse('""'), '')
+
+    def test_invalid(self):
+        for line in ['"a" "b"', '"a', 'a"', '"a\\"', "'a'", 'u"a"',
+                     r'"\q"', r'"\u00f1"', r'"\777"', '"a"b"']:
+            self.assertRaises(ValueError, self._parse, line)
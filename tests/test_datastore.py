@@ -0,0 +1,427 @@
+# Copyright (C) 2016, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+
+from gi.repository import GLib
+
+from sugar3.datastore import datastore
+
+
+class _SignalMatch(object):
+
+    def remove(self):
+        pass
+
+
+class _FakeDataStore(object):
+    """Replies to the calls from the main loop, like the D-Bus service"""
+
+    def __init__(self, count=0):
+        self.entries = [{'uid': 'uid%d' % i, 'title': 'Entry %d' % i}
+                        for i in range(count)]
+        self.find_calls = []
+        self.write_calls = []
+        self.properties_calls = []
+        self.error = None
+
+    def connect_to_signal(self, *args, **kwargs):
+        return _SignalMatch()
+
+    def create(self, properties, file_path, transfer_ownership,
+               reply_handler=None, error_handler=None, timeout=-1):
+        self.write_calls.append(('create', None, dict(properties)))
+        object_id = 'uid%d' % len(self.entries)
+        self.entries.append({'uid': object_id})
+        if reply_handler is None:
+            return object_id
+
+        def reply_cb():
+            if self.error is not None:
+                error_handler(self.error)
+            else:
+                reply_handler(object_id)
+            return False
+
+        GLib.idle_add(reply_cb)
+
+    def update(self, object_id, properties, file_path, transfer_ownership,
+               reply_handler=None, error_handler=None, timeout=-1):
+        self.write_calls.append(('update', object_id, dict(properties)))
+        if reply_handler is not None:
+            GLib.idle_add(lambda: reply_handler() and False)
+
+    def get_properties(self, object_id, byte_arrays=False):
+        self.properties_calls.append(object_id)
+        for entry in self.entries:
+            if entry['uid'] == object_id:
+                return dict(entry)
+        raise KeyError(object_id)
+
+    def delete(self, object_id):
+        self.entries = [entry for entry in self.entries
+                        if entry['uid'] != object_id]
+
+    def find(self, query, properties, reply_handler=None,
+             error_handler=None, byte_arrays=False):
+        self.find_calls.append(query)
+        offset = query.get('offset', 0)
+        entries = [dict(entry) for entry in
+                   self.entries[offset:offset + query['limit']]]
+        if reply_handler is None:
+            return entries, len(self.entries)
+
+        def reply_cb():
+            if self.error is not None:
+                error_handler(self.error)
+            else:
+                reply_handler(entries, len(self.entries))
+            return False
+
+        GLib.idle_add(reply_cb)
+
+
+def _flush_main_loop():
+    context = GLib.MainContext.default()
+    while context.iteration(False):
+        pass
+
+
+class TestIterFind(unittest.TestCase):
+
+    def setUp(self):
+        self._data_store = _FakeDataStore(250)
+        datastore._data_store = self._data_store
+
+    def tearDown(self):
+        datastore._data_store = None
+
+    def _get_uids(self, ds_objects):
+        uids = []
+        for ds_object in ds_objects:
+            uids.append(ds_object.object_id)
+            ds_object.destroy()
+        return uids
+
+    def test_pages(self):
+        uids = self._get_uids(datastore.iter_find({}, page_size=100))
+        self.assertEqual(uids, ['uid%d' % i for i in range(250)])
+        self.assertEqual([query['offset'] for query in
+                          self._data_store.find_calls], [0, 100, 200])
+
+    def test_prefetch(self):
+        iterator = datastore.iter_find({}, page_size=100)
+        self._get_uids([next(iterator)])
+        # The second page is requested before the first one is consumed
+        self.assertEqual(len(self._data_store.find_calls), 2)
+
+    def test_early_stop(self):
+        iterator = datastore.iter_find({'offset': 10}, page_size=100)
+        uids = self._get_uids(next(iterator) for i in range(5))
+        self.assertEqual(uids, ['uid%d' % i for i in range(10, 15)])
+        iterator.close()
+
+        # Let the pending reply arrive
+        _flush_main_loop()
+        self.assertEqual(len(self._data_store.find_calls), 2)
+
+    def test_error(self):
+        self._data_store.error = ValueError('find failed')
+        iterator = datastore.iter_find({})
+        self.assertRaises(ValueError, next, iterator)
+
+    def test_reentrant_wait(self):
+        errors = []
+
+        def nested_cb():
+            try:
+                datastore._wait_until(lambda: True)
+            except RuntimeError as e:
+                errors.append(e)
+            return False
+
+        GLib.idle_add(nested_cb)
+        self._get_uids(datastore.iter_find({}, page_size=100))
+        self.assertEqual(len(errors), 1)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self._calls = []
+        self._in_flight = 0
+        self._max_in_flight = 0
+
+    def _start_call(self, item, reply_cb, error_cb):
+        self._calls.append((item, reply_cb, error_cb))
+        self._in_flight += 1
+        self._max_in_flight = max(self._max_in_flight, self._in_flight)
+
+    def _complete(self, index=0):
+        item, reply_cb, error_cb = self._calls.pop(index)
+        self._in_flight -= 1
+        if isinstance(item, Exception):
+            error_cb(item)
+        else:
+            reply_cb(item * 2)
+
+    def _run(self, items, max_in_flight=3):
+        replies = []
+        progress = []
+        operation = datastore._BatchOperation(
+            items, self._start_call, max_in_flight,
+            lambda completed, total: progress.append((completed, total)),
+            lambda results, errors: replies.append((results, errors)))
+        operation.start()
+        return operation, replies, progress
+
+    def test_in_flight_bound(self):
+        operation, replies, progress = self._run(range(10))
+        self.assertEqual(len(self._calls), 3)
+
+        # Out of order replies
+        self._complete(1)
+        while self._calls:
+            self._complete()
+
+        self.assertTrue(operation.is_done())
+        self.assertEqual(self._max_in_flight, 3)
+        self.assertEqual(replies, [([i * 2 for i in range(10)], [])])
+        self.assertEqual(progress, [(i, 10) for i in range(1, 11)])
+
+    def test_errors(self):
+        error = ValueError('failed')
+        operation, replies, progress = self._run([1, error, 3])
+        while self._calls:
+            self._complete()
+
+        self.assertEqual(replies, [([2, None, 6], [(error, error)])])
+        self.assertEqual(progress[-1], (3, 3))
+
+    def test_start_call_raises(self):
+        def start_call(item, reply_cb, error_cb):
+            if item == 2:
+                raise ValueError('cannot start')
+            reply_cb(item)
+
+        replies = []
+        operation = datastore._BatchOperation(
+            [1, 2, 3], start_call, 1, None,
+            lambda results, errors: replies.append((results, errors)))
+        operation.start()
+
+        results, errors = replies[0]
+        self.assertEqual(results, [1, None, 3])
+        self.assertEqual([item for item, error in errors], [2])
+
+    def test_synchronous_replies(self):
+        def start_call(item, reply_cb, error_cb):
+            reply_cb(item)
+
+        replies = []
+        operation = datastore._BatchOperation(
+            range(1000), start_call, 8, None,
+            lambda results, errors: replies.append((results, errors)))
+        operation.start()
+        self.assertEqual(replies, [(range(1000), [])])
+
+    def test_empty(self):
+        operation, replies, progress = self._run([])
+        self.assertEqual(replies, [([], [])])
+        self.assertEqual(progress, [])
+
+    def test_wait(self):
+        def start_call(item, reply_cb, error_cb):
+            GLib.idle_add(lambda: reply_cb(item * 2) and False)
+
+        results, errors = datastore._run_batch(range(20), start_call, 4,
+                                               None, None)
+        self.assertEqual(results, [i * 2 for i in range(20)])
+        self.assertEqual(errors, [])
+
+
+class TestWrite(unittest.TestCase):
+
+    def setUp(self):
+        self._data_store = _FakeDataStore()
+        datastore._data_store = self._data_store
+        self._ds_object = datastore.create()
+        self._ds_object.metadata['title'] = 'first'
+
+    def tearDown(self):
+        self._ds_object.destroy()
+        datastore._data_store = None
+
+    def _write_async(self, events, name):
+        datastore.write(self._ds_object,
+                        reply_handler=lambda: events.append(name),
+                        error_handler=lambda error: events.append(
+                            (name, error)))
+
+    def test_queued_updates(self):
+        events = []
+        self._write_async(events, 'create')
+        self.assertIsNone(self._ds_object.object_id)
+
+        self._ds_object.metadata['title'] = 'second'
+        self._write_async(events, 'update')
+        self.assertEqual(len(self._data_store.write_calls), 1)
+
+        _flush_main_loop()
+        self.assertEqual(events, ['create', 'update'])
+        self.assertEqual(self._ds_object.object_id, 'uid0')
+        kind, object_id, properties = self._data_store.write_calls[1]
+        self.assertEqual((kind, object_id), ('update', 'uid0'))
+        self.assertEqual(properties['title'], 'second')
+
+    def test_created_signal(self):
+        created = []
+
+        def created_cb(sender, object_id, **kwargs):
+            created.append(object_id)
+
+        datastore.created.connect(created_cb)
+        try:
+            self._write_async([], 'create')
+            _flush_main_loop()
+
+            ds_object = datastore.create()
+            datastore.write(ds_object)
+            ds_object.destroy()
+        finally:
+            datastore.created.disconnect(created_cb)
+
+        # Only for the asynchronous creates
+        self.assertEqual(created, ['uid0'])
+
+    def test_synchronous_update_waits(self):
+        events = []
+        self._write_async(events, 'create')
+
+        self._ds_object.metadata['title'] = 'second'
+        datastore.write(self._ds_object)
+        self.assertEqual(self._ds_object.object_id, 'uid0')
+        self.assertEqual(events, ['create'])
+        self.assertEqual([call[:2] for call in self._data_store.write_calls],
+                         [('create', None), ('update', 'uid0')])
+
+    def test_failed_create(self):
+        error = ValueError('create failed')
+        self._data_store.error = error
+
+        events = []
+        self._write_async(events, 'create')
+        self._write_async(events, 'update')
+        _flush_main_loop()
+
+        self.assertEqual(events, [('create', error), ('update', error)])
+        self.assertIsNone(self._ds_object.object_id)
+
+        # Written again from scratch
+        self._data_store.error = None
+        datastore.write(self._ds_object)
+        self.assertEqual(self._ds_object.object_id, 'uid1')
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self._data_store = _FakeDataStore(3)
+        self._data_store.entries[0]['preview'] = 'p' * 5000
+        datastore._data_store = self._data_store
+        datastore._metadata_cache = datastore.LRU(
+            datastore._METADATA_CACHE_SIZE)
+
+    def tearDown(self):
+        datastore._data_store = None
+        datastore._metadata_cache = datastore.LRU(
+            datastore._METADATA_CACHE_SIZE)
+
+    def _get_title(self, object_id, use_cache=True):
+        ds_object = datastore.get(object_id, use_cache)
+        title = ds_object.metadata['title']
+        ds_object.destroy()
+        return title
+
+    def test_hit(self):
+        self.assertEqual(self._get_title('uid1'), 'Entry 1')
+        self.assertEqual(self._get_title('uid1'), 'Entry 1')
+        self.assertEqual(self._data_store.properties_calls, ['uid1'])
+
+    def test_use_cache(self):
+        self._get_title('uid1', use_cache=False)
+        self.assertNotIn('uid1', datastore._metadata_cache)
+        self._get_title('uid1')
+        self._get_title('uid1', use_cache=False)
+        self.assertEqual(self._data_store.properties_calls, ['uid1'] * 3)
+
+    def test_find(self):
+        ds_objects, count_ = datastore.find({}, limit=10)
+        for ds_object in ds_objects:
+            ds_object.destroy()
+
+        self.assertEqual(self._get_title('uid2'), 'Entry 2')
+        self.assertEqual(self._data_store.properties_calls, [])
+
+    def test_large_values(self):
+        self._get_title('uid0')
+        properties, omitted = datastore._metadata_cache['uid0']
+        self.assertNotIn('preview', properties)
+        self.assertEqual(omitted, set(['preview']))
+
+        # Only fetched again when used
+        ds_object = datastore.get('uid0')
+        self.assertIn('preview', ds_object.metadata)
+        self.assertEqual(self._data_store.properties_calls, ['uid0'])
+        self.assertEqual(ds_object.metadata['preview'], 'p' * 5000)
+        self.assertEqual(ds_object.metadata.get_dictionary()['preview'],
+                         'p' * 5000)
+        self.assertEqual(self._data_store.properties_calls, ['uid0'] * 2)
+        ds_object.destroy()
+
+        # Written with the preview, unless replaced
+        ds_object = datastore.get('uid0')
+        ds_object.metadata['preview'] = 'new'
+        datastore.write(ds_object)
+        ds_object.destroy()
+        self.assertEqual(self._data_store.properties_calls, ['uid0'] * 2)
+        kind_, object_id_, properties = self._data_store.write_calls[0]
+        self.assertEqual(properties['preview'], 'new')
+
+    def test_write(self):
+        ds_object = datastore.get('uid1')
+        ds_object.metadata['title'] = 'Changed'
+        self._data_store.entries[1]['title'] = 'Changed'
+        datastore.write(ds_object)
+        ds_object.destroy()
+
+        self.assertEqual(self._get_title('uid1'), 'Changed')
+        self.assertEqual(self._data_store.properties_calls, ['uid1'] * 2)
+
+    def test_delete(self):
+        self._get_title('uid1')
+        datastore.delete('uid1')
+        self.assertNotIn('uid1', datastore._metadata_cache)
+
+    def test_signals(self):
+        self._get_title('uid1')
+        self._data_store.entries[1]['title'] = 'Changed'
+        getattr(datastore, '__datastore_updated_cb')('uid1')
+        self.assertEqual(self._get_title('uid1'), 'Changed')
+        self.assertEqual(self._data_store.properties_calls, ['uid1'] * 2)
+
+        getattr(datastore, '__datastore_deleted_cb')('uid1')
+        self.assertNotIn('uid1', datastore._metadata_cache)
@@ -0,0 +1,464 @@
+# Copyright (C) 2016, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import re
+import time
+import shutil
+import tempfile
+import unittest
+
+# Keep the disk cache away from the profile
+_cache_dir = tempfile.mkdtemp(prefix='test-icon-')
+os.environ['SUGAR_ICON_CACHE_DIR'] = _cache_dir
+
+from gi.repository import GLib
+from gi.repository import Gtk
+import cairo
+
+from sugar3.graphics import icon
+
+tests_dir = os.path.dirname(__file__)
+data_dir = os.path.join(tests_dir, 'data')
+ICON_PATH = os.path.join(data_dir, 'mime.svg')
+
+
+def tearDownModule():
+    shutil.rmtree(_cache_dir)
+
+
+def _make_buffer(**kwargs):
+    icon_buffer = icon._IconBuffer()
+    for key, value in kwargs.items():
+        setattr(icon_buffer, key, value)
+    return icon_buffer
+
+
+def _iterate_until(condition, timeout=5):
+    context = GLib.MainContext.default()
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        context.iteration(False)
+        time.sleep(0.01)
+    return condition()
+
+
+class TestSizedCache(unittest.TestCase):
+
+    def _make_cache(self, budget=10):
+        return icon._SizedCache(budget, len)
+
+    def test_eviction_order(self):
+        cache = self._make_cache()
+        cache.set('a', 'aaa')
+        cache.set('b', 'bbb')
+        cache.set('c', 'ccc')
+        # Used recently, so not evicted
+        self.assertEqual(cache.get('a'), 'aaa')
+
+        cache.set('d', 'ddd')
+        self.assertIsNone(cache.get('b'))
+        for key in ['a', 'c', 'd']:
+            self.assertEqual(cache.get(key), key * 3)
+        self.assertEqual(cache.get_stats()['size'], 9)
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_replace(self):
+        cache = self._make_cache()
+        cache.set('a', 'aaaa')
+        cache.set('a', 'aa')
+        self.assertEqual(cache.get_stats()['size'], 2)
+        self.assertEqual(cache.get_stats()['entries'], 1)
+
+    def test_too_large(self):
+        cache = self._make_cache()
+        cache.set('a', 'a' * 11)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_stats()['size'], 0)
+
+    def test_set_budget(self):
+        cache = self._make_cache()
+        for key in 'abc':
+            cache.set(key, key * 3)
+
+        cache.set_budget(6)
+        self.assertIsNone(cache.peek('a'))
+        self.assertEqual(cache.get_stats()['entries'], 2)
+        self.assertEqual(cache.get_stats()['budget'], 6)
+
+        cache.set_budget(0)
+        self.assertEqual(cache.get_stats()['entries'], 0)
+        self.assertEqual(cache.get_stats()['evictions'], 3)
+
+    def test_stats(self):
+        cache = self._make_cache()
+        cache.set('a', 'aaa')
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        # Not counted
+        cache.peek('a')
+        cache.peek('b')
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+        cache.flush()
+        stats = cache.get_stats()
+        self.assertEqual(stats['entries'], 0)
+        self.assertEqual(stats['size'], 0)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_peek_order(self):
+        cache = self._make_cache(6)
+        cache.set('a', 'aaa')
+        cache.set('b', 'bbb')
+        cache.peek('a')
+        cache.set('c', 'ccc')
+        self.assertIsNone(cache.peek('a'))
+
+    def test_uncached_loads(self):
+        loader = icon._SVGLoader()
+        loader.load(ICON_PATH, {}, False)
+        stats = loader._cache.get_stats()
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(stats['entries'], 0)
+
+        loader.load(ICON_PATH, {'fill_color': '#FF8F00'}, True)
+        loader.load(ICON_PATH, {'fill_color': '#FF2B34'}, True)
+        self.assertEqual(loader._cache.get_stats()['entries'], 1)
+        self.assertEqual(loader._cache.get_stats()['hits'], 1)
+        self.assertEqual(loader._handles.get_stats()['entries'], 2)
+        self.assertEqual(loader._handles.get_stats()['size'], 2)
+
+
+class _TestBuffer(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def _get_cache_key(self, sensitive):
+        return (self._name, sensitive)
+
+
+class _TestAtlas(icon._IconAtlas):
+    _INITIAL_SIZE = 100
+    _MAX_SIZE = 400
+
+
+class TestAtlas(unittest.TestCase):
+
+    def _add(self, atlas, name, width, height):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        return atlas.add(_TestBuffer(name), surface)
+
+    def test_shelves(self):
+        atlas = _TestAtlas()
+        self.assertIsNone(atlas.get_region(_TestBuffer('a')))
+
+        self.assertEqual(self._add(atlas, 'a', 40, 30), (0, 0, 40, 30))
+        self.assertEqual(self._add(atlas, 'b', 40, 50), (40, 0, 40, 50))
+        # Doesn't fit in the first shelf, which is as high as its
+        # highest icon
+        self.assertEqual(self._add(atlas, 'c', 40, 10), (0, 50, 40, 10))
+        self.assertEqual(self._add(atlas, 'd', 60, 10), (40, 50, 60, 10))
+
+        self.assertEqual(atlas.get_region(_TestBuffer('b')), (40, 0, 40, 50))
+        self.assertEqual(atlas.surface.get_width(), 100)
+        self.assertEqual(atlas.surface.get_height(), 100)
+
+    def test_too_large(self):
+        atlas = _TestAtlas()
+        self.assertIsNone(self._add(atlas, 'a', 101, 10))
+        self.assertIsNone(atlas.get_region(_TestBuffer('a')))
+
+    def test_growth(self):
+        atlas = _TestAtlas()
+        for i in range(3):
+            self._add(atlas, i, 100, 40)
+        self.assertEqual(atlas.surface.get_height(), 200)
+        self.assertEqual(atlas.get_region(_TestBuffer(2)), (0, 80, 100, 40))
+        self.assertEqual(atlas.get_region(_TestBuffer(0)), (0, 0, 100, 40))
+
+        for i in range(3, 10):
+            self._add(atlas, i, 100, 40)
+        self.assertEqual(atlas.surface.get_height(), 400)
+
+        # Started over when full
+        self.assertEqual(self._add(atlas, 10, 100, 40), (0, 0, 100, 40))
+        self.assertEqual(atlas.surface.get_height(), 100)
+        self.assertIsNone(atlas.get_region(_TestBuffer(0)))
+
+    def test_theme_change(self):
+        atlas = _TestAtlas()
+        self._add(atlas, 'a', 10, 10)
+        icon._theme_cache.clear()
+        self.assertIsNone(atlas.get_region(_TestBuffer('a')))
+        self.assertEqual(self._add(atlas, 'b', 10, 10), (0, 0, 10, 10))
+
+
+class TestThemeLookupCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # mime.svg is found as the "mime" icon
+        Gtk.IconTheme.get_default().append_search_path(data_dir)
+
+    def setUp(self):
+        self._cache = icon._ThemeLookupCache()
+
+    def test_hits(self):
+        result = self._cache.lookup('mime', 55)
+        self.assertEqual(result[0], ICON_PATH)
+        self.assertIs(self._cache.lookup('mime', 55.0), result)
+        self.assertIsNot(self._cache.lookup('mime', 33), result)
+
+        self.assertTrue(self._cache.has_icon('mime'))
+        self.assertFalse(self._cache.has_icon('no-such-icon'))
+        self.assertEqual(self._cache._has_icon,
+                         {'mime': True, 'no-such-icon': False})
+
+    def test_theme_changed(self):
+        result = self._cache.lookup('mime', 55)
+        self._cache.has_icon('mime')
+        serial = self._cache.serial
+        icon._theme_cache.lookup('mime', 55)
+        global_serial = icon._theme_cache.serial
+
+        Gtk.IconTheme.get_default().emit('changed')
+        self.assertEqual(self._cache.serial, serial + 1)
+        self.assertEqual(icon._theme_cache.serial, global_serial + 1)
+        self.assertEqual(self._cache._has_icon, {})
+
+        new_result = self._cache.lookup('mime', 55)
+        self.assertEqual(new_result, result)
+        self.assertIsNot(new_result, result)
+        self.assertEqual(self._cache.serial, serial + 1)
+
+
+_ICON_SVG = '''<?xml version="1.0" ?><!DOCTYPE svg
+  PUBLIC '-//W3C//DTD SVG 1.1//EN'
+  'http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd' [
+    <!ENTITY stroke_color "#010101">
+    <!ENTITY fill_color "#FFFFFF">
+]><svg height="55px" width="55px" xmlns="http://www.w3.org/2000/svg">
+<rect fill="&fill_color;" stroke="&stroke_color;" height="40" width="40"/>
+</svg>
+'''
+
+_STROKE_SVG = '''<?xml version="1.0" ?><!DOCTYPE svg [
+<!ENTITY stroke_color "#000000"> ]>
+<svg height="55px" width="55px" xmlns="http://www.w3.org/2000/svg">
+<circle cx="27" cy="27" r="20" fill="none" stroke="&stroke_color;"/>
+</svg>
+'''
+
+
+def _substitute_entities(data, entities):
+    # How the icons were recoloured before the templates
+    for entity, value in entities.items():
+        if isinstance(value, basestring):
+            xml = '<!ENTITY %s "%s">' % (entity, value)
+            data = re.sub('<!ENTITY %s .*>' % entity, xml, data)
+    return data
+
+
+class TestSVGTemplate(unittest.TestCase):
+
+    def _check(self, data):
+        template = icon._SVGTemplate(data)
+        self.assertEqual(template.size, len(data))
+        for entities in [{},
+                         {'fill_color': '#FF8F00'},
+                         {'stroke_color': '#FF2B34'},
+                         {'fill_color': '#FF8F00',
+                          'stroke_color': '#FF2B34'},
+                         {'fill_color': u'#00FF00', 'stroke_color': None},
+                         {'stroke_color': 10, 'other_color': '#123456'}]:
+            self.assertEqual(template.substitute('test.svg', entities),
+                             _substitute_entities(data, entities))
+
+    def test_fill_and_stroke(self):
+        self._check(_ICON_SVG)
+        template = icon._SVGTemplate(_ICON_SVG)
+        result = template.substitute('test.svg', {'fill_color': '#FF8F00'})
+        self.assertIn('<!ENTITY fill_color "#FF8F00">', result)
+        self.assertIn('<!ENTITY stroke_color "#010101">', result)
+
+    def test_stroke_only(self):
+        self._check(_STROKE_SVG)
+
+    def test_no_entities(self):
+        with open(ICON_PATH) as icon_file:
+            data = icon_file.read()
+        self._check(data)
+        self.assertEqual(
+            icon._SVGTemplate(data).substitute('mime.svg',
+                                               {'fill_color': '#FF8F00'}),
+            data)
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        icon.flush_cache()
+
+    def test_prefetch(self):
+        done = []
+        spec = {'file_name': ICON_PATH, 'width': 55, 'height': 55,
+                'fill_color': '#FF8F00', 'stroke_color': '#FF2B34'}
+        icon.prefetch([spec, dict(spec, width=33, height=33)],
+                      lambda: done.append(True))
+
+        self.assertTrue(_iterate_until(lambda: done))
+        self.assertEqual(done, [True])
+
+        hits = icon.get_cache_stats()['surfaces']['hits']
+        surface = _make_buffer(**spec).get_surface()
+        self.assertIsNotNone(surface)
+        self.assertEqual(icon.get_cache_stats()['surfaces']['hits'],
+                         hits + 1)
+
+    def test_prefetch_nothing(self):
+        done = []
+        icon.prefetch([], lambda: done.append(True))
+        self.assertEqual(done, [True])
+
+    def test_waiter_called_once(self):
+        prefetcher = icon._IconPrefetcher(workers=0)
+        icon_buffer = _make_buffer(file_name=ICON_PATH, width=55, height=55)
+        cache_key = icon_buffer._get_cache_key(True)
+
+        calls = []
+
+        def callback():
+            calls.append(True)
+
+        done = []
+        prefetcher.prefetch([icon_buffer], lambda: done.append(True))
+        self.assertTrue(prefetcher.is_pending(cache_key))
+        # Added again on every draw
+        for i in range(3):
+            self.assertTrue(prefetcher.add_waiter(cache_key, callback))
+
+        prefetcher._workers = 1
+        prefetcher._start_workers()
+        self.assertTrue(_iterate_until(lambda: done))
+        self.assertEqual(calls, [True])
+        self.assertFalse(prefetcher.add_waiter(cache_key, callback))
+
+    def test_failure_not_pending(self):
+        prefetcher = icon._IconPrefetcher(workers=1)
+        icon_buffer = _make_buffer(file_name='/nonexistent/icon.svg',
+                                   width=55, height=55)
+        cache_key = icon_buffer._get_cache_key(True)
+
+        prefetcher.prefetch([icon_buffer], None)
+        # Without iterating the main loop, the theme lookup of the
+        # fallback icon times out
+        end = time.time() + icon._MAIN_THREAD_TIMEOUT * 2
+        while prefetcher.is_pending(cache_key) and time.time() < end:
+            time.sleep(0.01)
+        self.assertFalse(prefetcher.is_pending(cache_key))
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+        self._cache = icon._SurfaceDiskCache(self._path)
+
+    def tearDown(self):
+        shutil.rmtree(self._path)
+
+    def _make_surface(self, width=10, height=20):
+        stride = cairo.ImageSurface.format_stride_for_width(
+            cairo.FORMAT_ARGB32, width)
+        data = bytearray(i % 256 for i in range(stride * height))
+        return cairo.ImageSurface.create_for_data(
+            data, cairo.FORMAT_ARGB32, width, height, stride)
+
+    def test_round_trip(self):
+        surface = self._make_surface()
+        self._cache.save(('icon', 1), surface)
+
+        loaded = self._cache.load(('icon', 1))
+        self.assertEqual(loaded.get_format(), surface.get_format())
+        self.assertEqual(loaded.get_width(), 10)
+        self.assertEqual(loaded.get_height(), 20)
+        self.assertEqual(loaded.get_stride(), surface.get_stride())
+        self.assertEqual(bytearray(loaded.get_data()),
+                         bytearray(surface.get_data()))
+
+        self.assertIsNone(self._cache.load(('icon', 2)))
+
+    def _rewrite_entry(self, key, rewrite):
+        path = self._cache._get_entry_path(key)
+        with open(path, 'rb') as entry_file:
+            data = entry_file.read()
+        with open(path, 'wb') as entry_file:
+            entry_file.write(rewrite(data))
+
+    def test_corrupt_trailer(self):
+        self._cache.save('icon', self._make_surface())
+        self._rewrite_entry('icon', lambda data: data[:-1])
+        self.assertIsNone(self._cache.load('icon'))
+
+        self._cache.save('icon', self._make_surface())
+        self._rewrite_entry('icon', lambda data: 'XXXX' + data[4:])
+        self.assertIsNotNone(self._cache.load('icon'))
+        trailer_size = icon._SURFACE_CACHE_TRAILER.size
+        self._rewrite_entry(
+            'icon', lambda data: data[:-trailer_size] + 'XXXX' +
+            data[-trailer_size + 4:])
+        self.assertIsNone(self._cache.load('icon'))
+
+        self._rewrite_entry('icon', lambda data: '')
+        self.assertIsNone(self._cache.load('icon'))
+
+    def test_version_mismatch(self):
+        surface = self._make_surface()
+        self._cache.save('icon', surface)
+
+        def rewrite(data):
+            trailer_size = icon._SURFACE_CACHE_TRAILER.size
+            magic, version, format_, width, height, stride = \
+                icon._SURFACE_CACHE_TRAILER.unpack(data[-trailer_size:])
+            return data[:-trailer_size] + icon._SURFACE_CACHE_TRAILER.pack(
+                magic, version + 1, format_, width, height, stride)
+
+        self._rewrite_entry('icon', rewrite)
+        self.assertIsNone(self._cache.load('icon'))
+
+    def test_prune(self):
+        entry_size = len(self._make_surface().get_data()) + \
+            icon._SURFACE_CACHE_TRAILER.size
+        self._cache = icon._SurfaceDiskCache(self._path, entry_size * 4)
+
+        for i in range(4):
+            self._cache.save(i, self._make_surface())
+            path = self._cache._get_entry_path(i)
+            os.utime(path, (i, i))
+        # Used recently
+        self.assertIsNotNone(self._cache.load(0))
+
+        self._cache.save(4, self._make_surface())
+        self.assertIsNotNone(self._cache.load(0))
+        self.assertIsNone(self._cache.load(1))
+        self.assertIsNone(self._cache.load(2))
+        self.assertIsNotNone(self._cache.load(3))
+        self.assertIsNotNone(self._cache.load(4))
@@ -0,0 +1,88 @@
+# Copyright (C) 2016, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from sugar3 import logger
+
+
+class TestStartupTrace(unittest.TestCase):
+
+    def setUp(self):
+        self._logs_dir = tempfile.mkdtemp()
+        self._environ = dict(os.environ)
+        os.environ['SUGAR_LOGS_DIR'] = self._logs_dir
+        os.environ['SUGAR_STARTUP_TRACE'] = '1'
+        logger.restart_startup_trace()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self._environ)
+        logger.restart_startup_trace()
+        shutil.rmtree(self._logs_dir)
+
+    def _load_trace(self):
+        path = os.path.join(self._logs_dir,
+                            'org.sugarlabs.Test-%d.trace.json' % os.getpid())
+        with open(path) as trace_file:
+            return json.load(trace_file)
+
+    def test_trace(self):
+        self.assertTrue(logger.is_startup_traced())
+        with logger.startup_phase('outer'):
+            with logger.startup_phase('inner'):
+                pass
+            logger.mark_startup_event('ready')
+        try:
+            with logger.startup_phase('failed'):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        logger.save_startup_trace('org.sugarlabs.Test')
+        self.assertFalse(logger.is_startup_traced())
+
+        trace = self._load_trace()
+        self.assertEqual(trace['displayTimeUnit'], 'ms')
+        events = trace['traceEvents']
+        self.assertEqual([(event['name'], event['ph']) for event in events],
+                         [('outer', 'B'), ('inner', 'B'), ('inner', 'E'),
+                          ('ready', 'i'), ('outer', 'E'), ('failed', 'B'),
+                          ('failed', 'E')])
+        self.assertEqual(events[3]['s'], 'p')
+
+        # The fields needed by the Chrome trace event format
+        for event in events:
+            self.assertEqual(event['pid'], os.getpid())
+            self.assertEqual(event['cat'], 'startup')
+            self.assertIsInstance(event['ts'], (int, long))
+            self.assertIsInstance(event['tid'], (int, long))
+        timestamps = [event['ts'] for event in events]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_disabled(self):
+        del os.environ['SUGAR_STARTUP_TRACE']
+        logger.restart_startup_trace()
+        self.assertFalse(logger.is_startup_traced())
+
+        with logger.startup_phase('phase'):
+            logger.mark_startup_event('event')
+        logger.save_startup_trace('org.sugarlabs.Test')
+        self.assertEqual(os.listdir(self._logs_dir), [])
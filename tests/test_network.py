@@ -0,0 +1,498 @@
+# Copyright (C) 2016, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import errno
+import select
+import socket
+import httplib
+import threading
+import shutil
+import hashlib
+import tempfile
+import unittest
+import urllib2
+
+from gi.repository import GLib
+
+from sugar3 import network
+
+
+class TestRange(unittest.TestCase):
+
+    def test_parse_range(self):
+        self.assertEqual(network._parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(network._parse_range('bytes=500-', 1000),
+                         (500, 999))
+        self.assertEqual(network._parse_range('bytes=900-2000', 1000),
+                         (900, 999))
+        self.assertEqual(network._parse_range('bytes=-100', 1000),
+                         (900, 999))
+        self.assertEqual(network._parse_range('bytes=-2000', 1000),
+                         (0, 999))
+
+    def test_parse_range_ignored(self):
+        for header in ['bytes=0-9,20-29', 'items=0-9', 'bytes=9-0',
+                       'bytes=a-b', 'bytes=-', 'bytes=5']:
+            self.assertEqual(network._parse_range(header, 1000), None)
+
+    def test_parse_range_unsatisfiable(self):
+        self.assertRaises(ValueError, network._parse_range,
+                          'bytes=1000-', 1000)
+        self.assertRaises(ValueError, network._parse_range, 'bytes=-0', 1000)
+        self.assertRaises(ValueError, network._parse_range, 'bytes=-10', 0)
+
+
+class TestDownloader(unittest.TestCase):
+
+    def test_parse_checksum(self):
+        self.assertEqual(network._parse_checksum('sha256:ABCD'),
+                         ('sha256', 'abcd'))
+        self.assertRaises(ValueError, network._parse_checksum, 'abcd')
+        self.assertRaises(ValueError, network._parse_checksum, 'nohash:ab')
+
+    def test_progress(self):
+        progress = network.DownloadProgress(500, total=1000, rate=100.0,
+                                            eta=5.0)
+        self.assertEqual(progress, 500)
+        self.assertEqual(progress + 1, 501)
+        self.assertEqual(progress.total, 1000)
+        self.assertEqual(progress.eta, 5.0)
+
+
+class _Response(object):
+
+    def __init__(self, code, headers, data=''):
+        self._code = code
+        self._headers = headers
+        self._data = data
+        self.closed = False
+
+    def getcode(self):
+        return self._code
+
+    def info(self):
+        return self._headers
+
+    def read(self, size):
+        data, self._data = self._data[:size], self._data[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class TestRequests(unittest.TestCase):
+    """The responses to the range requests, without a server"""
+
+    def setUp(self):
+        self._requests = []
+        self._responses = []
+        self._urlopen = urllib2.urlopen
+        urllib2.urlopen = self._urlopen_cb
+
+        fd, self._path = tempfile.mkstemp()
+        os.write(fd, 'x' * 1000)
+        self._downloader = network.GlibURLDownloader('http://host/file')
+        self._downloader._outf = fd
+
+    def tearDown(self):
+        urllib2.urlopen = self._urlopen
+        os.close(self._downloader._outf)
+        os.remove(self._path)
+
+    def _urlopen_cb(self, request, timeout=None):
+        self._requests.append(request)
+        response = self._responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def _get_size(self):
+        return os.fstat(self._downloader._outf).st_size
+
+    def test_partial(self):
+        self._responses.append(_Response(206, {
+            'Content-Range': 'bytes 1000-1999/2000',
+            'ETag': '"v1"'}))
+        segment = network._Segment(1000, None)
+        self._downloader._open(segment, first=True)
+
+        self.assertEqual(self._requests[0].get_header('Range'),
+                         'bytes=1000-')
+        self.assertEqual(segment.end, 2000)
+        self.assertEqual(self._downloader._total, 2000)
+        self.assertTrue(self._downloader._resumable)
+        self.assertEqual(self._downloader._validator, '"v1"')
+
+    def test_unexpected_range(self):
+        response = _Response(206, {'Content-Range': 'bytes 0-1999/2000'})
+        self._responses.append(response)
+        self.assertRaises(IOError, self._downloader._open,
+                          network._Segment(1000, None), True)
+        self.assertTrue(response.closed)
+
+    def test_whole_file(self):
+        self._responses.append(_Response(200, {'Content-Length': '3000'}))
+        segment = network._Segment(1000, None)
+        self._downloader._open(segment, first=True)
+
+        # Downloaded again from the beginning
+        self.assertEqual((segment.position, segment.end), (0, 3000))
+        self.assertEqual(self._get_size(), 0)
+        self.assertFalse(self._downloader._resumable)
+
+    def test_ranges_not_accepted(self):
+        self._responses.append(_Response(200, {'Content-Length': '3000'}))
+        self.assertRaises(IOError, self._downloader._open,
+                          network._Segment(1000, 2000))
+
+    def _unsatisfiable(self, content_range):
+        return urllib2.HTTPError('http://host/file', 416, 'Unsatisfiable',
+                                 {'Content-Range': content_range}, None)
+
+    def test_complete(self):
+        self._responses.append(self._unsatisfiable('bytes */1000'))
+        segment = network._Segment(1000, None)
+        self.assertIsNone(self._downloader._open_first(segment))
+
+        self.assertEqual(segment.end, 1000)
+        self.assertEqual(self._downloader._total, 1000)
+        self.assertEqual(self._get_size(), 1000)
+        self.assertEqual(len(self._requests), 1)
+
+    def test_replaced(self):
+        self._responses.append(self._unsatisfiable('bytes */500'))
+        self._responses.append(_Response(200, {'Content-Length': '500'}))
+        segment = network._Segment(1000, None)
+        self.assertIsNotNone(self._downloader._open_first(segment))
+
+        self.assertEqual((segment.position, segment.end), (0, 500))
+        self.assertEqual(self._get_size(), 0)
+        self.assertFalse(self._requests[1].has_header('Range'))
+
+    def test_unsatisfiable_from_start(self):
+        self._responses.append(self._unsatisfiable('bytes */0'))
+        self.assertRaises(urllib2.HTTPError, self._downloader._open_first,
+                          network._Segment(0, None))
+
+
+class TestSplit(unittest.TestCase):
+
+    def _split(self, segment, connections=4, resumable=True):
+        downloader = network.GlibURLDownloader('http://host/file',
+                                               connections=connections)
+        downloader._resumable = resumable
+        return [(other.position, other.end)
+                for other in downloader._split(segment)]
+
+    def test_split(self):
+        size = network.GlibURLDownloader.MIN_SEGMENT_SIZE
+        segments = self._split(network._Segment(100, 100 + 4 * size + 3))
+        self.assertEqual(segments, [(100, 100 + size),
+                                    (100 + size, 100 + 2 * size),
+                                    (100 + 2 * size, 100 + 3 * size),
+                                    (100 + 3 * size, 100 + 4 * size + 3)])
+
+    def test_small(self):
+        size = network.GlibURLDownloader.MIN_SEGMENT_SIZE
+        self.assertEqual(self._split(network._Segment(0, 2 * size + 1)),
+                         [(0, size), (size, 2 * size + 1)])
+        self.assertEqual(self._split(network._Segment(0, size)),
+                         [(0, size)])
+
+    def test_not_split(self):
+        size = 8 * network.GlibURLDownloader.MIN_SEGMENT_SIZE
+        self.assertEqual(self._split(network._Segment(0, size),
+                                     connections=1), [(0, size)])
+        self.assertEqual(self._split(network._Segment(0, size),
+                                     resumable=False), [(0, size)])
+        self.assertEqual(self._split(network._Segment(0, None)),
+                         [(0, None)])
+
+
+def _iterate_until(condition, timeout=10):
+    context = GLib.MainContext.default()
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timeout waiting for the main loop')
+        if not context.iteration(False):
+            time.sleep(0.005)
+
+
+class _FileHandler(network.ChunkedGlibHTTPRequestHandler):
+    """Serves the files of server.root, closing the connection after
+    server.fail_at bytes of the next response if set"""
+
+    def translate_path(self, path):
+        return os.path.join(self.server.root, path.lstrip('/'))
+
+    def log_error(self, *args):
+        pass
+
+    def send_head(self):
+        f = network.ChunkedGlibHTTPRequestHandler.send_head(self)
+        if f is not None and self.server.fail_at is not None:
+            self._end = min(self._end, self.server.fail_at)
+            self.close_connection = 1
+            self.server.fail_at = None
+        return f
+
+
+class _KeepAliveHandler(_FileHandler):
+
+    KEEP_ALIVE_TIMEOUT = 0.2
+
+
+def _start_server(root, server_class=network.ThreadedGlibTCPServer,
+                  handler_class=_FileHandler, **kwargs):
+    server = server_class(('127.0.0.1', 0), handler_class, **kwargs)
+    server.root = root
+    server.fail_at = None
+    return server
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self._data = os.urandom(300000)
+        with open(os.path.join(self._root, 'file.bin'), 'wb') as f:
+            f.write(self._data)
+        self._server = _start_server(self._root)
+        self._url = 'http://127.0.0.1:%d/file.bin' % \
+            self._server.server_address[1]
+        self._dest = os.path.join(self._root, 'download.bin')
+
+    def tearDown(self):
+        self._server.server_close()
+        shutil.rmtree(self._root)
+
+    def _download(self, resume=False, checksum=None):
+        results = []
+        downloader = network.GlibURLDownloader(self._url, checksum=checksum)
+        downloader.MAX_RETRIES = 0
+        downloader.connect('finished', lambda downloader, *args:
+                           results.append('finished'))
+        downloader.connect('error', lambda downloader, message:
+                           results.append(message))
+        downloader.start(self._dest, resume=resume)
+        _iterate_until(lambda: results)
+        return results[0]
+
+    def _read_dest(self):
+        with open(self._dest, 'rb') as f:
+            return f.read()
+
+    def test_resume_after_failure(self):
+        self._server.fail_at = 100000
+        result = self._download()
+        self.assertNotEqual(result, 'finished')
+
+        # The partial file is kept
+        self.assertEqual(self._read_dest(), self._data[:100000])
+
+        checksum = 'sha256:' + hashlib.sha256(self._data).hexdigest()
+        self.assertEqual(self._download(True, checksum), 'finished')
+        self.assertEqual(self._read_dest(), self._data)
+
+        # Already complete
+        self.assertEqual(self._download(True, checksum), 'finished')
+        self.assertEqual(self._read_dest(), self._data)
+
+    def test_checksum_mismatch(self):
+        checksum = 'sha256:' + hashlib.sha256('other').hexdigest()
+        self.assertNotEqual(self._download(checksum=checksum), 'finished')
+        self.assertFalse(os.path.exists(self._dest))
+
+
+class TestThreadedServer(unittest.TestCase):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        with open(os.path.join(self._root, 'file.bin'), 'wb') as f:
+            f.write('x' * 1000)
+        self._server = None
+        self._sockets = []
+
+    def tearDown(self):
+        for sock in self._sockets:
+            sock.close()
+        if self._server is not None:
+            self._server.server_close()
+        shutil.rmtree(self._root)
+
+    def _start(self, **kwargs):
+        self._server = _start_server(self._root, **kwargs)
+
+    def _connect(self, host='127.0.0.1'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((host, 0))
+        sock.connect(self._server.server_address)
+        self._sockets.append(sock)
+        return sock
+
+    def _wait_connections(self, count):
+        _iterate_until(
+            lambda: self._server.get_connection_count() == count)
+
+    def _read_response(self, sock):
+        # The refused connections are answered from the main loop
+        _iterate_until(lambda: select.select([sock], [], [], 0)[0])
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        return response.status, response.read()
+
+    def _get(self, sock):
+        sock.sendall('GET /file.bin HTTP/1.1\r\nHost: test\r\n\r\n')
+        return self._read_response(sock)
+
+    def test_max_connections(self):
+        self._start(max_connections=2, max_client_connections=16)
+        first = self._connect()
+        self._connect()
+        self._wait_connections(2)
+
+        status, body = self._read_response(self._connect())
+        self.assertEqual((status, body), (503, ''))
+
+        # The slot is released when a connection is closed
+        first.close()
+        self._wait_connections(1)
+        sock = self._connect()
+        self._wait_connections(2)
+        self.assertEqual(self._get(sock), (200, 'x' * 1000))
+
+    def test_max_client_connections(self):
+        self._start(max_client_connections=1)
+        first = self._connect()
+        self._wait_connections(1)
+        self.assertEqual(self._read_response(self._connect())[0], 503)
+
+        # Other clients are still served
+        sock = self._connect('127.0.0.2')
+        self._wait_connections(2)
+        self.assertEqual(self._get(sock)[0], 200)
+
+        first.close()
+        self._wait_connections(1)
+        sock = self._connect()
+        self._wait_connections(2)
+        self.assertEqual(self._get(sock)[0], 200)
+
+    def test_keep_alive(self):
+        self._start(handler_class=_KeepAliveHandler)
+        sock = self._connect()
+        self.assertEqual(self._get(sock)[0], 200)
+        self.assertEqual(self._get(sock)[0], 200)
+
+        # Closed after KEEP_ALIVE_TIMEOUT without requests
+        self._wait_connections(0)
+        self.assertEqual(sock.recv(1), '')
+
+
+class TestRequestHandler(unittest.TestCase):
+    """Responses of ChunkedGlibHTTPRequestHandler, sending from the main
+    loop or from threads"""
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self._data = os.urandom(200000)
+        with open(os.path.join(self._root, 'file.bin'), 'wb') as f:
+            f.write(self._data)
+        self._servers = []
+        self._sendfile = network._sendfile
+        self._send_file_range = network._send_file_range
+
+    def tearDown(self):
+        network._sendfile = self._sendfile
+        network._send_file_range = self._send_file_range
+        for server in self._servers:
+            server.server_close()
+        shutil.rmtree(self._root)
+
+    def _fetch(self, server_class, headers=None):
+        server = _start_server(self._root, server_class)
+        self._servers.append(server)
+        url = 'http://127.0.0.1:%d/file.bin' % server.server_address[1]
+        request = urllib2.Request(url, headers=headers or {})
+
+        # The client blocks, the main loop serves the requests
+        result = []
+
+        def fetch():
+            try:
+                response = urllib2.urlopen(request, timeout=10)
+            except urllib2.HTTPError as response:
+                pass
+            result.append((response.getcode(), response.info(),
+                           response.read()))
+            response.close()
+
+        thread = threading.Thread(target=fetch)
+        thread.daemon = True
+        thread.start()
+        _iterate_until(lambda: result)
+        return result[0]
+
+    def _test_responses(self, server_class):
+        status, headers, body = self._fetch(server_class)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(body, self._data)
+
+        status, headers, body = self._fetch(server_class,
+                                            {'Range': 'bytes=1000-'})
+        self.assertEqual(status, 206)
+        self.assertEqual(headers['Content-Range'],
+                         'bytes 1000-199999/200000')
+        self.assertEqual(body, self._data[1000:])
+
+        status, headers, body = self._fetch(server_class,
+                                            {'Range': 'bytes=-10'})
+        self.assertEqual((status, body), (206, self._data[-10:]))
+
+        status, headers, body = self._fetch(server_class,
+                                            {'Range': 'bytes=200000-'})
+        self.assertEqual((status, body), (416, ''))
+        self.assertEqual(headers['Content-Range'], 'bytes */200000')
+
+        # The range is ignored if the file changed
+        status, headers, body = self._fetch(server_class, {
+            'Range': 'bytes=1000-',
+            'If-Range': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual((status, body), (200, self._data))
+
+    def test_mainloop(self):
+        self._test_responses(network.GlibTCPServer)
+
+    def test_threaded(self):
+        self._test_responses(network.ThreadedGlibTCPServer)
+
+    def test_without_sendfile(self):
+        network._sendfile = None
+        self._test_responses(network.GlibTCPServer)
+        self._test_responses(network.ThreadedGlibTCPServer)
+
+    def test_sendfile_unsupported(self):
+        def send_file_range(out_fd, in_fd, offset, count):
+            raise OSError(errno.EINVAL, 'Not supported')
+
+        network._send_file_range = send_file_range
+        self._test_responses(network.GlibTCPServer)
+        self._test_responses(network.ThreadedGlibTCPServer)
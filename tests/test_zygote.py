@@ -0,0 +1,183 @@
+# Copyright (C) 2016, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import logging
+import tempfile
+import unittest
+
+from gi.repository import GLib
+
+from sugar3.activity import zygote
+
+
+def _main():
+    print ' '.join(sys.argv)
+    print os.getcwd()
+    print os.environ['SUGAR_BUNDLE_ID']
+
+
+class _TestZygote(zygote.Zygote):
+
+    # The activity itself needs a display
+    def _run_child(self):
+        self._main_cb()
+        sys.stdout.flush()
+        return 3
+
+
+def _iterate_until(condition, timeout=10):
+    context = GLib.MainContext.default()
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        context.iteration(False)
+        time.sleep(0.01)
+    return condition()
+
+
+class TestZygote(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._socket_path = os.path.join(self._temp_dir, 'zygote')
+        os.environ['SUGAR_ACTIVITY_ZYGOTE'] = self._socket_path
+
+        self._pid = os.fork()
+        if self._pid == 0:
+            try:
+                _TestZygote(self._socket_path, _main).run()
+            finally:
+                os._exit(1)
+
+        for i in range(100):
+            if os.path.exists(self._socket_path):
+                break
+            time.sleep(0.1)
+
+    def tearDown(self):
+        os.kill(self._pid, signal.SIGTERM)
+        os.waitpid(self._pid, 0)
+        del os.environ['SUGAR_ACTIVITY_ZYGOTE']
+        shutil.rmtree(self._temp_dir)
+
+    def test_launch(self):
+        command = ['sugar-activity', 'activity.Activity', '-b', 'org.test']
+        self.assertTrue(zygote.can_launch(command))
+        self.assertFalse(zygote.can_launch(['sugar-activity-web'] +
+                                           command[1:]))
+
+        log_path = os.path.join(self._temp_dir, 'log')
+        replies = []
+        zygote.launch(command, {'SUGAR_BUNDLE_ID': 'org.test'},
+                      self._temp_dir, log_path,
+                      lambda pid, sock: replies.append((pid, sock)),
+                      replies.append)
+        self.assertTrue(_iterate_until(lambda: replies))
+        pid, sock = replies[0]
+        status = zygote.read_status(sock)
+
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 3)
+        with open(log_path) as log_file:
+            self.assertEqual(log_file.read().splitlines(),
+                             [' '.join(command),
+                              os.path.realpath(self._temp_dir),
+                              'org.test'])
+
+
+class TestUnresponsiveZygote(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._socket_path = os.path.join(self._temp_dir, 'zygote')
+        os.environ['SUGAR_ACTIVITY_ZYGOTE'] = self._socket_path
+        self._request_timeout = zygote._REQUEST_TIMEOUT
+        zygote._REQUEST_TIMEOUT = 1
+
+    def tearDown(self):
+        zygote._REQUEST_TIMEOUT = self._request_timeout
+        del os.environ['SUGAR_ACTIVITY_ZYGOTE']
+        shutil.rmtree(self._temp_dir)
+
+    def _launch(self):
+        errors = []
+        zygote.launch(['sugar-activity'], {}, self._temp_dir,
+                      os.path.join(self._temp_dir, 'log'),
+                      lambda pid, sock: self.fail('Launched'),
+                      errors.append)
+        return errors
+
+    def test_no_reply(self):
+        # Accepted by the kernel, never read
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        server.listen(1)
+        try:
+            start = time.time()
+            errors = self._launch()
+            self.assertLess(time.time() - start, 1)
+            self.assertTrue(_iterate_until(lambda: errors))
+            self.assertIsInstance(errors[0], zygote.ZygoteError)
+        finally:
+            server.close()
+
+    def test_closed(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        server.listen(1)
+        try:
+            errors = self._launch()
+            conn = server.accept()[0]
+            conn.makefile('r', 0).readline()
+            conn.close()
+            self.assertTrue(_iterate_until(lambda: errors))
+            self.assertIsInstance(errors[0], zygote.ZygoteError)
+        finally:
+            server.close()
+
+    def test_not_listening(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        server.close()
+        self.assertRaises(socket.error, self._launch)
+
+
+class TestPreload(unittest.TestCase):
+
+    def setUp(self):
+        self._modules = zygote._PRELOAD_MODULES
+        self._gi = sys.modules.get('gi')
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        zygote._PRELOAD_MODULES = self._modules
+        if self._gi is None:
+            del sys.modules['gi']
+        else:
+            sys.modules['gi'] = self._gi
+        logging.disable(logging.NOTSET)
+
+    def test_failed_imports(self):
+        sys.modules['gi'] = None
+        zygote._PRELOAD_MODULES = ['sugar3.no_such_module', 'json']
+        sys.modules.pop('json', None)
+        zygote._preload()
+        self.assertIn('json', sys.modules)